@@ -0,0 +1,130 @@
+"""
+Задержка точечных выборок на 100k доменов с индексами и без.
+
+    python -m bench.lookup_latency [--domains 100000] [--samples 200]
+
+Данные создаются в отдельной схеме wpg_bench базы из config.ini и удаляются после прогона.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from database import DATABASE_URL
+from models import Base
+
+SCHEMA = "wpg_bench"
+
+# Индексы из models.py, которые проверяем (pk не трогаем)
+INDEXES = [
+    "ix_domain_domain", "ix_domain_server_id", "ix_domain_cf_id", "ix_domain_owner_id",
+    "ix_domain_domain_trgm", "ix_domain_cf_pending",
+    "ix_server_ip", "ix_server_owner_id", "ix_server_ip_trgm", "ix_server_name_trgm",
+    "ix_cloudflare_email", "ix_cloudflare_owner_id",
+]
+
+QUERIES = {
+    "domain by name": ("SELECT id FROM domain WHERE domain = :value", lambda n: f"site{random.randrange(n)}.com"),
+    "server by ip": ("SELECT id FROM server WHERE ip = :value", lambda n: _ip(random.randrange(n // 100))),
+    "cloudflare by email": ("SELECT id FROM cloudflare WHERE email = :value",
+                            lambda n: f"cf{random.randrange(n)}@mail.com"),
+    "domains of server": ("SELECT id FROM domain WHERE server_id = :value",
+                          lambda n: random.randrange(1, n // 100 + 1)),
+    "domain ilike": ("SELECT id FROM domain WHERE domain ILIKE :value LIMIT 50",
+                     lambda n: f"%site{random.randrange(n)}%"),
+    "server ip like": ("SELECT id FROM server WHERE ip LIKE :value", lambda n: f"%.{random.randrange(256)}.%"),
+}
+
+
+def _ip(number):
+    return f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}"
+
+
+async def seed(conn, domains):
+    servers = max(1, domains // 100)
+    await conn.execute(text(
+        "INSERT INTO \"user\" (id, email, username, hashed_password, is_active, is_superuser, is_verified) "
+        "VALUES (1, 'bench@mail.com', 'bench', '-', true, false, true)"
+    ))
+    await conn.execute(text(
+        "INSERT INTO server (ip, login, password, port, owner_id, added_at, server_name) "
+        "SELECT '10.' || (n / 65536 % 256) || '.' || (n / 256 % 256) || '.' || (n % 256), "
+        "'root', '-', 22, 1, now(), 'server ' || n FROM generate_series(0, :count - 1) n"
+    ), {"count": servers})
+    await conn.execute(text(
+        "INSERT INTO cloudflare (email, password, api_key, owner_id, added_at, domains_count) "
+        "SELECT 'cf' || n || '@mail.com', '-', '-', 1, now(), 1 FROM generate_series(0, :count - 1) n"
+    ), {"count": domains})
+    await conn.execute(text(
+        "INSERT INTO domain (domain, keyword, server_id, cf_id, cf_connected, ns_record_first, ns_record_second, "
+        "plugins_installed, theme_changed, posts_created, form_added, owner_id, added_at) "
+        "SELECT 'site' || n || '.com', 'bench', n % :servers + 1, n + 1, n % 10 <> 0, 'ns1', 'ns2', "
+        "false, false, false, false, 1, now() FROM generate_series(0, :count - 1) n"
+    ), {"count": domains, "servers": servers})
+
+
+async def measure(conn, domains, samples):
+    timings = {}
+    for name, (sql, value) in QUERIES.items():
+        statement = text(sql)
+        values = []
+        for _ in range(samples):
+            started = time.perf_counter()
+            await conn.execute(statement, {"value": value(domains)})
+            values.append((time.perf_counter() - started) * 1000)
+        values.sort()
+        timings[name] = (statistics.median(values), values[int(len(values) * 0.95) - 1])
+    return timings
+
+
+async def main(domains, samples):
+    engine = create_async_engine(DATABASE_URL, connect_args={"server_settings": {"search_path": f"{SCHEMA},public"}})
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+            # Расширение ставим в public, иначе оно окажется в схеме бенчмарка и удалится вместе с ней
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public"))
+            # checkfirst=False: таблицы public видны через search_path, с проверкой create_all их пропустит
+            # и данные бенчмарка попадут в рабочие таблицы
+            await conn.run_sync(lambda sync_conn: Base.metadata.create_all(sync_conn, checkfirst=False))
+            print(f"Seeding {domains} domains...")
+            await seed(conn, domains)
+
+        # Индексы созданы до вставки: без VACUUM строки остаются в pending list GIN индексов
+        # и поиск по подстроке просматривает его целиком, в рабочей базе так не бывает
+        async with engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text(f"VACUUM ANALYZE {SCHEMA}.domain, {SCHEMA}.server, {SCHEMA}.cloudflare"))
+
+        async with engine.connect() as conn:
+            indexed = await measure(conn, domains, samples)
+
+        async with engine.begin() as conn:
+            for index in INDEXES:
+                await conn.execute(text(f"DROP INDEX IF EXISTS {index} CASCADE"))
+            await conn.execute(text("ANALYZE"))
+
+        async with engine.connect() as conn:
+            plain = await measure(conn, domains, samples)
+
+        print(f"\n{'query':<22}{'no index p50/p95, ms':>24}{'indexed p50/p95, ms':>24}")
+        for name in QUERIES:
+            print(f"{name:<22}{plain[name][0]:>12.2f}{plain[name][1]:>12.2f}"
+                  f"{indexed[name][0]:>12.2f}{indexed[name][1]:>12.2f}")
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domains", type=int, default=100000)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.domains, args.samples))
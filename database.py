@@ -2,6 +2,7 @@ from typing import AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from tools.config import config_read
 
 config = config_read("config.ini")
@@ -19,6 +20,11 @@ DATABASE_URL = f"" \
 engine = create_async_engine(DATABASE_URL)
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Celery задачи запускают новый event loop на каждый вызов,
+# соединения asyncpg между loop'ами не переиспользуются
+worker_engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+worker_session_maker = sessionmaker(worker_engine, class_=AsyncSession, expire_on_commit=False)
+
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
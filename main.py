@@ -1,4 +1,5 @@
-import aioredis
+import asyncio
+
 from fastapi import FastAPI, Request
 from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,6 +14,12 @@ from modules.servers.router import router as router_servers
 from modules.cloudflare.router import router as router_cloudflare
 from modules.users.router import router as router_users
 from modules.system.router import router as router_system
+from modules.events.router import router as router_events
+from modules.tasks.router import router as router_tasks
+from tools.cache import CACHE_PREFIX, cache_key_builder
+from tools.cloudflare import close_session as close_cloudflare_session
+from tools.redis_client import async_redis
+from tools.status_consumer import run_status_consumer
 
 
 app = FastAPI(
@@ -54,6 +61,8 @@ app.include_router(router_servers)
 app.include_router(router_cloudflare)
 app.include_router(router_users)
 app.include_router(router_system)
+app.include_router(router_events)
+app.include_router(router_tasks)
 
 
 @app.middleware("http")
@@ -75,7 +84,18 @@ async def handle_errors(request: Request, call_next):
 
 @app.on_event("startup")
 async def startup_event():
-    redis = aioredis.from_url("redis://localhost", encoding="utf8", decode_responses=True)
-    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    FastAPICache.init(RedisBackend(async_redis), prefix=CACHE_PREFIX, key_builder=cache_key_builder)
+    # Статусы от Celery воркеров
+    app.state.status_consumer = asyncio.create_task(run_status_consumer(async_redis))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.status_consumer.cancel()
+    try:
+        await app.state.status_consumer
+    except asyncio.CancelledError:
+        pass
+    await close_cloudflare_session()
 
 
@@ -0,0 +1,99 @@
+"""baseline
+
+Схема до индексов и новых колонок. Базу, созданную до появления миграций,
+помечаем этой ревизией без изменений: alembic stamp 0001
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _keywords_table(name):
+    op.create_table(
+        name,
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+    )
+    op.create_index(f"ix_{name}_id", name, ["id"])
+
+
+def upgrade() -> None:
+    op.create_table(
+        "user",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("registered_at", sa.TIMESTAMP()),
+        sa.Column("hashed_password", sa.String(length=1024), nullable=False),
+        sa.Column("is_active", sa.Boolean(), nullable=False),
+        sa.Column("is_superuser", sa.Boolean(), nullable=False),
+        sa.Column("is_verified", sa.Boolean(), nullable=False),
+        sa.Column("namecheap_username", sa.String()),
+        sa.Column("namecheap_api", sa.String()),
+    )
+    op.create_table(
+        "server",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("ip", sa.String(), nullable=False),
+        sa.Column("login", sa.String(), nullable=False),
+        sa.Column("password", sa.String(), nullable=False),
+        sa.Column("port", sa.Integer()),
+        sa.Column("status", sa.Enum("ADDED", "CONFIGURE", "ERROR", name="serverstatus")),
+        sa.Column("owner_id", sa.Integer(), sa.ForeignKey("user.id")),
+        sa.Column("added_at", sa.DateTime(), nullable=False),
+        sa.Column("payment_date", sa.Date()),
+        sa.Column("server_name", sa.String()),
+    )
+    op.create_index("ix_server_id", "server", ["id"])
+    op.create_table(
+        "cloudflare",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("password", sa.String(), nullable=False),
+        sa.Column("api_key", sa.String(), nullable=False),
+        sa.Column("status", sa.Enum("ADDED", "ERROR", name="cloudflarestatus")),
+        sa.Column("dns_records", sa.Enum("NONE", "ADDED", "ERROR", name="cloudflarednsrecords")),
+        sa.Column("owner_id", sa.Integer(), sa.ForeignKey("user.id")),
+        sa.Column("added_at", sa.TIMESTAMP(), nullable=False),
+    )
+    op.create_index("ix_cloudflare_id", "cloudflare", ["id"])
+    op.create_table(
+        "domain",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("domain", sa.String(), nullable=False),
+        sa.Column("keyword", sa.String(), nullable=False),
+        sa.Column("server_id", sa.Integer(), sa.ForeignKey("server.id"), nullable=False),
+        sa.Column("cf_id", sa.Integer(), sa.ForeignKey("cloudflare.id"), nullable=False),
+        sa.Column("cf_connected", sa.Boolean(), nullable=False),
+        sa.Column("ns_record_first", sa.String(), nullable=False),
+        sa.Column("ns_record_second", sa.String(), nullable=False),
+        sa.Column("status", sa.Enum("DONE", "ADDED", "ERROR", "CONFIGURE", name="whitepagestatus")),
+        sa.Column("plugins_installed", sa.Boolean(), nullable=False),
+        sa.Column("theme_changed", sa.Boolean(), nullable=False),
+        sa.Column("posts_created", sa.Boolean(), nullable=False),
+        sa.Column("form_added", sa.Boolean(), nullable=False),
+        sa.Column("wp_login", sa.String()),
+        sa.Column("wp_pass", sa.String()),
+        sa.Column("namecheap_integration", sa.Boolean()),
+        sa.Column("owner_id", sa.Integer(), sa.ForeignKey("user.id")),
+        sa.Column("added_at", sa.TIMESTAMP(), nullable=False),
+    )
+    op.create_index("ix_domain_id", "domain", ["id"])
+    for name in ("white_keywords", "black_keywords", "themes", "blocked_themes"):
+        _keywords_table(name)
+
+
+def downgrade() -> None:
+    for name in ("blocked_themes", "themes", "black_keywords", "white_keywords", "domain", "cloudflare", "server", "user"):
+        op.drop_table(name)
+    for name in ("whitepagestatus", "cloudflarednsrecords", "cloudflarestatus", "serverstatus"):
+        op.execute(f"DROP TYPE IF EXISTS {name}")
@@ -0,0 +1,110 @@
+"""lookup indexes, cf_zone_id, domains_count
+
+Перед уникальными индексами проверяются дубли domain.domain, server.ip и cloudflare.email.
+Дубли доменов (это разные сайты), серверов разных владельцев и аккаунтов Cloudflare
+разных владельцев или с разными api_key миграция не трогает: она останавливается со списком,
+их нужно разобрать вручную. Остальные дубли (одна и та же запись, добавленная дважды одним
+владельцем) сливаются в запись с меньшим id, домены переносятся на нее. Удаленные строки
+и прежние server_id/cf_id перенесенных доменов сохраняются в таблицах *_dedup_backup.
+Индексы строятся CREATE INDEX CONCURRENTLY без блокировки записи. Если сборка упала
+(например, между чисткой и индексом появился новый дубль), индекс остается INVALID -
+повторный upgrade удаляет его и строит заново.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+# (имя, DDL) - те же индексы, что объявлены в models.py
+INDEXES = [
+    ("ix_domain_domain", "CREATE UNIQUE INDEX CONCURRENTLY ix_domain_domain ON domain (domain)"),
+    ("ix_domain_server_id", "CREATE INDEX CONCURRENTLY ix_domain_server_id ON domain (server_id)"),
+    ("ix_domain_cf_id", "CREATE INDEX CONCURRENTLY ix_domain_cf_id ON domain (cf_id)"),
+    ("ix_domain_owner_id", "CREATE INDEX CONCURRENTLY ix_domain_owner_id ON domain (owner_id)"),
+    ("ix_domain_domain_trgm", "CREATE INDEX CONCURRENTLY ix_domain_domain_trgm ON domain USING gin (domain gin_trgm_ops)"),
+    ("ix_domain_cf_pending", "CREATE INDEX CONCURRENTLY ix_domain_cf_pending ON domain (cf_id) WHERE cf_connected = false"),
+    ("ix_server_ip", "CREATE UNIQUE INDEX CONCURRENTLY ix_server_ip ON server (ip)"),
+    ("ix_server_owner_id", "CREATE INDEX CONCURRENTLY ix_server_owner_id ON server (owner_id)"),
+    ("ix_server_ip_trgm", "CREATE INDEX CONCURRENTLY ix_server_ip_trgm ON server USING gin (ip gin_trgm_ops)"),
+    ("ix_server_name_trgm", "CREATE INDEX CONCURRENTLY ix_server_name_trgm ON server USING gin (server_name gin_trgm_ops)"),
+    ("ix_cloudflare_email", "CREATE UNIQUE INDEX CONCURRENTLY ix_cloudflare_email ON cloudflare (email)"),
+    ("ix_cloudflare_owner_id", "CREATE INDEX CONCURRENTLY ix_cloudflare_owner_id ON cloudflare (owner_id)"),
+    ("ix_cloudflare_free", "CREATE INDEX CONCURRENTLY ix_cloudflare_free ON cloudflare (id) WHERE domains_count = 0"),
+]
+
+
+# Дубли, которые нельзя слить автоматически: (описание, запрос)
+CONFLICTS = [
+    ("domain.domain", "SELECT domain, array_agg(id ORDER BY id) FROM domain GROUP BY domain HAVING count(*) > 1"),
+    ("server.ip with different owners",
+     "SELECT ip, array_agg(id ORDER BY id) FROM server GROUP BY ip "
+     "HAVING count(DISTINCT coalesce(owner_id, 0)) > 1"),
+    ("cloudflare.email with different owners or api keys",
+     "SELECT email, array_agg(id ORDER BY id) FROM cloudflare GROUP BY email "
+     "HAVING count(DISTINCT coalesce(owner_id, 0)) > 1 OR count(DISTINCT api_key) > 1"),
+]
+
+
+def _check_conflicts():
+    bind = op.get_bind()
+    report = []
+    for title, query in CONFLICTS:
+        rows = bind.execute(sa.text(query)).fetchall()
+        if rows:
+            report.append(f"{title}: " + "; ".join(f"{value} -> ids {list(ids)}" for value, ids in rows[:50]))
+            if len(rows) > 50:
+                report.append(f"... and {len(rows) - 50} more")
+    if report:
+        raise RuntimeError("Resolve duplicates before upgrading:\n" + "\n".join(report))
+
+
+def _merge_duplicates(table, column, domain_column):
+    """Сливает дубли table.column одного владельца в запись с меньшим id, сохраняя удаляемое."""
+    duplicates = f"SELECT s.id FROM {table} s JOIN {table} k ON k.{column} = s.{column} AND k.id < s.id"
+    op.execute(f"CREATE TABLE IF NOT EXISTS {table}_dedup_backup (LIKE {table})")
+    op.execute(f"INSERT INTO {table}_dedup_backup SELECT * FROM {table} WHERE id IN ({duplicates})")
+    op.execute("CREATE TABLE IF NOT EXISTS domain_dedup_backup (id integer, server_id integer, cf_id integer)")
+    op.execute(f"INSERT INTO domain_dedup_backup SELECT id, server_id, cf_id FROM domain "
+               f"WHERE {domain_column} IN ({duplicates})")
+    op.execute(f"""
+        UPDATE domain d SET {domain_column} = k.keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY {column}) AS keep_id FROM {table}) k
+        WHERE d.{domain_column} = k.id AND k.id <> k.keep_id
+    """)
+    op.execute(f"DELETE FROM {table} WHERE id IN ({duplicates})")
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # IF NOT EXISTS: повтор после упавшей сборки индекса снова проходит этот шаг
+    op.execute("ALTER TABLE domain ADD COLUMN IF NOT EXISTS cf_zone_id VARCHAR")
+    op.execute("ALTER TABLE cloudflare ADD COLUMN IF NOT EXISTS domains_count INTEGER NOT NULL DEFAULT 0")
+
+    _check_conflicts()
+    _merge_duplicates("server", "ip", "server_id")
+    _merge_duplicates("cloudflare", "email", "cf_id")
+
+    # Счетчик для аллокатора аккаунтов (modules/cloudflare/allocator.py)
+    op.execute("UPDATE cloudflare c SET domains_count = (SELECT count(*) FROM domain d WHERE d.cf_id = c.id)")
+
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        for name, ddl in INDEXES:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            op.execute(ddl)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, _ in reversed(INDEXES):
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    op.drop_column("cloudflare", "domains_count")
+    op.drop_column("domain", "cf_zone_id")
@@ -2,13 +2,16 @@ import enum
 from datetime import datetime
 
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTable
-from sqlalchemy import Column, Integer, String, DateTime, Enum, ForeignKey, Date, Boolean, TIMESTAMP, Index, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Enum, ForeignKey, Date, Boolean, TIMESTAMP, Index, JSON, text, \
+    event, DDL
 from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy.orm import relationship
 
 
 Base = declarative_base()
+# Триграммные индексы (gin_trgm_ops) требуют расширения pg_trgm
+event.listen(Base.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
 
 
 class CloudflareStatus(str, enum.Enum):
@@ -50,52 +53,66 @@ class User(SQLAlchemyBaseUserTable[int], Base):
     namecheap_username = Column(String, nullable=True)
     namecheap_api = Column(String, nullable=True)
 
-    domains = relationship("Domain", back_populates='user', lazy="selectin")
-    servers = relationship("Server", back_populates='user', lazy="selectin")
-    cf_accounts = relationship("Cloudflare", back_populates='user', lazy="selectin")
+    domains = relationship("Domain", back_populates='user', lazy="raise")
+    servers = relationship("Server", back_populates='user', lazy="raise")
+    cf_accounts = relationship("Cloudflare", back_populates='user', lazy="raise")
 
 
 
 class Server(Base):
     __tablename__ = "server"
     id = Column(Integer, primary_key=True, index=True)
-    ip = Column(String, nullable=False)
+    ip = Column(String, nullable=False, unique=True, index=True)
     login = Column(String, nullable=False)
     password = Column(String, nullable=False)
     port = Column(Integer)
     status = Column(Enum(ServerStatus))
-    owner_id = Column(Integer, ForeignKey("user.id"))
+    owner_id = Column(Integer, ForeignKey("user.id"), index=True)
     added_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     payment_date = Column(Date, nullable=True)  # Новое поле
     server_name = Column(String, nullable=True)  # Новое поле
 
-    domains = relationship("Domain", back_populates="server", lazy="selectin")
-    user = relationship("User", back_populates="servers", lazy="selectin")
+    domains = relationship("Domain", back_populates="server", lazy="raise")
+    user = relationship("User", back_populates="servers", lazy="raise")
+
+    __table_args__ = (
+        # Поиск по подстроке ip/названия в get_servers (like '%...%')
+        Index("ix_server_ip_trgm", "ip", postgresql_using="gin", postgresql_ops={"ip": "gin_trgm_ops"}),
+        Index("ix_server_name_trgm", "server_name", postgresql_using="gin",
+              postgresql_ops={"server_name": "gin_trgm_ops"}),
+    )
 
 
 class Cloudflare(Base):
     __tablename__ = "cloudflare"
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, nullable=False)
+    email = Column(String, nullable=False, unique=True, index=True)
     password = Column(String, nullable=False)
     api_key = Column(String, nullable=False)
     status = Column(Enum(CloudflareStatus), default=CloudflareStatus.ADDED)
     dns_records = Column(Enum(CloudflareDNSRecords), default=CloudflareDNSRecords.NONE)
-    owner_id = Column(Integer, ForeignKey("user.id"))
+    owner_id = Column(Integer, ForeignKey("user.id"), index=True)
     added_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow())
+    # Число доменов на аккаунте, поддерживается modules/cloudflare/allocator.py
+    domains_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    domain = relationship("Domain", back_populates="cloudflare", lazy="raise")
+    user = relationship("User", back_populates="cf_accounts", lazy="raise")
 
-    domain = relationship("Domain", back_populates="cloudflare", lazy="selectin")
-    user = relationship("User", back_populates="cf_accounts", lazy="selectin")
+    __table_args__ = (
+        Index("ix_cloudflare_free", "id", postgresql_where=text("domains_count = 0")),
+    )
 
 
 class Domain(Base):
     __tablename__ = "domain"
     id = Column(Integer, primary_key=True, index=True)
-    domain = Column(String, nullable=False)
+    domain = Column(String, nullable=False, unique=True, index=True)
     keyword = Column(String, nullable=False)
-    server_id = Column(Integer, ForeignKey(Server.id), nullable=False)
-    cf_id = Column(Integer, ForeignKey(Cloudflare.id), nullable=False)
+    server_id = Column(Integer, ForeignKey(Server.id), nullable=False, index=True)
+    cf_id = Column(Integer, ForeignKey(Cloudflare.id), nullable=False, index=True)
     cf_connected = Column(Boolean, nullable=False, default=False)
+    cf_zone_id = Column(String, nullable=True)
     ns_record_first = Column(String, nullable=False)
     ns_record_second = Column(String, nullable=False)
     status = Column(Enum(WhitePageStatus), default=WhitePageStatus.ADDED)
@@ -107,12 +124,19 @@ class Domain(Base):
     wp_pass = Column(String, nullable=True)
     namecheap_integration = Column(Boolean, nullable=True, default=False)
     # menu_created = Column(Boolean, nullable=False, default=False)
-    owner_id = Column(Integer, ForeignKey("user.id"))
-    added_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow())
-
-    server = relationship("Server", back_populates="domains", lazy="selectin")
-    cloudflare = relationship("Cloudflare", back_populates="domain", lazy="selectin")
-    user = relationship("User", back_populates="domains", lazy="selectin")
+    owner_id = Column(Integer, ForeignKey("user.id"), index=True)
+    added_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+
+    server = relationship("Server", back_populates="domains", lazy="raise")
+    cloudflare = relationship("Cloudflare", back_populates="domain", lazy="raise")
+    user = relationship("User", back_populates="domains", lazy="raise")
+
+    __table_args__ = (
+        # Поиск домена по подстроке в get_domains (ilike '%...%')
+        Index("ix_domain_domain_trgm", "domain", postgresql_using="gin", postgresql_ops={"domain": "gin_trgm_ops"}),
+        # NS поллер выбирает только неподключенные домены
+        Index("ix_domain_cf_pending", "cf_id", postgresql_where=text("cf_connected = false")),
+    )
 
 
 class WhiteKeywords(Base):
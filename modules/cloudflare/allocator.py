@@ -0,0 +1,53 @@
+from typing import Iterable, List, Optional
+
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Cloudflare, Domain
+
+
+async def lock_free_cf_accounts(session: AsyncSession, count: int) -> List[Cloudflare]:
+    """
+    Блокирует до count свободных аккаунтов Cloudflare до конца транзакции.
+    Параллельные транзакции пропускают заблокированные строки (SKIP LOCKED) и берут следующие.
+    """
+    query = (
+        select(Cloudflare)
+        .where(Cloudflare.domains_count == 0)
+        .order_by(Cloudflare.id)
+        .limit(count)
+        .with_for_update(skip_locked=True)
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+async def allocate_cf_account(session: AsyncSession) -> Optional[Cloudflare]:
+    """Выдает свободный аккаунт Cloudflare и помечает его занятым. При rollback аккаунт снова свободен."""
+    cf_accounts = await lock_free_cf_accounts(session, 1)
+    if not cf_accounts:
+        return None
+
+    cf_account = cf_accounts[0]
+    cf_account.domains_count += 1
+    await session.flush()
+
+    return cf_account
+
+
+async def recount_cf_accounts(session: AsyncSession, cf_ids: Optional[Iterable[int]] = None):
+    """Пересчитывает domains_count по таблице domain (для указанных аккаунтов или для всех)."""
+    domains_count = (
+        select(func.count(Domain.id))
+        .where(Domain.cf_id == Cloudflare.id)
+        .scalar_subquery()
+    )
+    stmt = update(Cloudflare).values(domains_count=domains_count)
+
+    if cf_ids is not None:
+        cf_ids = set(cf_id for cf_id in cf_ids if cf_id is not None)
+        if not cf_ids:
+            return
+        stmt = stmt.where(Cloudflare.id.in_(cf_ids))
+
+    await session.execute(stmt.execution_options(synchronize_session=False))
@@ -2,6 +2,7 @@ from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, Header, File, UploadFile
 from fastapi_cache.decorator import cache
 from sqlalchemy import insert, select, desc, update, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi_pagination.ext.async_sqlalchemy import paginate
 from fastapi_pagination import Params, Page
@@ -10,7 +11,9 @@ from modules.auth.base_config import fastapi_users
 from models import User, Domain, Cloudflare, CloudflareStatus
 from database import get_async_session
 from modules.cloudflare.schemas import AddCloudflare, EditCloudflare, ReturnCloudflare
+from tools.cache import CACHE_TTL, CLOUDFLARE, DOMAINS, cache_key_builder, invalidate_cache
 from tools.cloudflare import validate_credentials
+from tools.fanout import fan_out
 
 router = APIRouter(
     prefix="/cf",
@@ -19,9 +22,14 @@ router = APIRouter(
 
 current_user = fastapi_users.current_user()
 
+# Проверка ключей идет через общую сессию tools.cloudflare, лимит - чтобы не упереться в rate limit
+VALIDATE_CONCURRENCY = 20
+# 5 колонок на строку, лимит Postgres - 32767 параметров на запрос
+INSERT_CHUNK = 1000
+
 
 @router.get("", response_model=Page[ReturnCloudflare])
-@cache(expire=600)
+@cache(expire=CACHE_TTL, namespace=CLOUDFLARE, key_builder=cache_key_builder)
 async def get_cf(user: User = Depends(current_user), params: Params = Depends(), session: AsyncSession = Depends(get_async_session)):
     if not user.is_active:
         raise (HTTPException(status_code=403, detail={
@@ -77,6 +85,7 @@ async def add_cf(cf: AddCloudflare, user: User = Depends(current_user), session:
     stmt = insert(Cloudflare).values(**cf_info)
     await session.execute(stmt)
     await session.commit()
+    await invalidate_cache(CLOUDFLARE)
 
     return {"status": "success", "data": None, "msg": f"Аккаунт Cloudflare {cf_info['email']} добавлен."}
 
@@ -94,33 +103,51 @@ async def upload_accounts(file: UploadFile = File(...), user: User = Depends(cur
     content = content.decode("utf-8")
     lines = content.splitlines()
 
+    accounts = {}
     for line in lines:
-        email, password, api_key = map(str.strip, line.split("|"))
-
-        query = select(Cloudflare).where(Cloudflare.email == email)
+        try:
+            email, password, api_key = map(str.strip, line.split("|"))
+        except ValueError:
+            continue
+        accounts.setdefault(email, (password, api_key))
+
+    if accounts:
+        query = select(Cloudflare.email).where(Cloudflare.email.in_(list(accounts)))
         result = await session.execute(query)
-        cf_current = result.scalar_one_or_none()
+        for email in result.scalars().all():
+            del accounts[email]  # Пропустить, если аккаунт уже существует
 
-        if cf_current is not None:
-            continue  # Пропустить, если аккаунт уже существует
+    async def validate(email):
+        return await validate_credentials(email, accounts[email][1])
 
-        cf_valid = await validate_credentials(email, api_key)
-        status = CloudflareStatus.ADDED if cf_valid else CloudflareStatus.ERROR
+    validated = await fan_out(accounts, validate, per_server=VALIDATE_CONCURRENCY)
 
-        cf_info = {
+    rows = [
+        {
             'email': email,
             'password': password,
             'api_key': api_key,
-            'status': status,
+            'status': CloudflareStatus.ADDED if validated.results.get(email) else CloudflareStatus.ERROR,
             'owner_id': user.id
         }
-
-        stmt = insert(Cloudflare).values(**cf_info)
-        await session.execute(stmt)
+        for email, (password, api_key) in accounts.items()
+    ]
+
+    added = 0
+    for start in range(0, len(rows), INSERT_CHUNK):
+        stmt = (
+            pg_insert(Cloudflare)
+            .values(rows[start:start + INSERT_CHUNK])
+            .on_conflict_do_nothing(index_elements=[Cloudflare.email])
+            .returning(Cloudflare.id)
+        )
+        result = await session.execute(stmt)
+        added += len(result.scalars().all())
 
     await session.commit()
+    await invalidate_cache(CLOUDFLARE)
 
-    return {"status": "success", "data": None, "msg": f"Акаунты Cloudflare были добавлены из файла {file.filename}."}
+    return {"status": "success", "data": None, "msg": f"Акаунты Cloudflare были добавлены из файла {file.filename}: {added}."}
 
 
 @router.patch("")
@@ -156,6 +183,7 @@ async def edit_cf(cf: EditCloudflare, user: User = Depends(current_user), sessio
         cf_current.status = CloudflareStatus.ERROR
 
     await session.commit()
+    await invalidate_cache(CLOUDFLARE, DOMAINS)
 
     return {"status": "success", "data": None, "msg": f"Аккаунт Cloudflare {cf.email} изменен."}
 
@@ -183,5 +211,6 @@ async def delete_server(cf_id: int, user: User = Depends(current_user), session:
     stmt = delete(Cloudflare).where(Cloudflare.id == cf_id)
     await session.execute(stmt)
     await session.commit()
+    await invalidate_cache(CLOUDFLARE, DOMAINS)
 
     return {"status": "success", "data": None, "msg": f"Аккаунт Cloudflare c ID {cf_id} удален."}
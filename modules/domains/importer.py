@@ -0,0 +1,337 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import List, Optional
+
+from sqlalchemy import insert, select
+
+from database import worker_session_maker
+from models import Domain, Server, User
+from modules.cloudflare.allocator import lock_free_cf_accounts, recount_cf_accounts
+from tools.cache import DOMAINS, invalidate_cache_sync
+from tools.cloudflare import add_domain_cf, delete_zone
+from tools.config import config_read
+from tools.fanout import fan_out
+from tools.namecheap import update_ns_records_on_namecheap
+from tools.redis_client import async_redis, redis_client
+
+config = config_read("config.ini")
+
+IMPORT_CONCURRENCY = config.getint('IMPORT', 'concurrency', fallback=8)
+IMPORT_CHUNK = config.getint('IMPORT', 'chunk', fallback=50)
+JOB_TTL = 24 * 3600
+# Загрузка, которая дольше не отмечала прогресс, считается остановленной и запускается заново
+STALL_TIMEOUT = config.getint('IMPORT', 'stall_timeout', fallback=600)
+# Незавершенные загрузки, которые проверяет resume_import_jobs
+JOBS_KEY = "wpg:import:jobs"
+
+
+def _job_key(job_id: str) -> str:
+    return f"wpg:import:{job_id}"
+
+
+def _results_key(job_id: str) -> str:
+    return f"wpg:import:{job_id}:results"
+
+
+def _lines_key(job_id: str) -> str:
+    return f"wpg:import:{job_id}:lines"
+
+
+def _entries_key(job_id: str) -> str:
+    return f"wpg:import:{job_id}:entries"
+
+
+def _lock_key(job_id: str) -> str:
+    return f"wpg:import:{job_id}:lock"
+
+
+async def create_import_job(owner_id: int, lines: List[str]) -> str:
+    """Сохраняет файл и состояние загрузки в Redis: задача import_domains работает только по job_id."""
+    job_id = uuid.uuid4().hex
+    pipe = async_redis.pipeline(transaction=True)
+    pipe.hset(_job_key(job_id), mapping={
+        "owner_id": owner_id,
+        "state": "running",
+        "total": sum(1 for line in lines if line.strip()),
+        "processed": 0,
+        "added": 0,
+        "failed": 0,
+        "updated_at": int(time.time()),
+    })
+    pipe.expire(_job_key(job_id), JOB_TTL)
+    pipe.set(_lines_key(job_id), json.dumps(lines, ensure_ascii=False), ex=JOB_TTL)
+    pipe.sadd(JOBS_KEY, job_id)
+    await pipe.execute()
+    return job_id
+
+
+async def get_import_job(job_id: str, owner_id: int) -> Optional[dict]:
+    job = await async_redis.hgetall(_job_key(job_id))
+    if not job or int(job["owner_id"]) != owner_id:
+        return None
+
+    results = await async_redis.lrange(_results_key(job_id), 0, -1)
+    return {
+        "job_id": job_id,
+        "state": job["state"],
+        "total": int(job["total"]),
+        "processed": int(job["processed"]),
+        "added": int(job["added"]),
+        "failed": int(job["failed"]),
+        "results": [json.loads(result) for result in results],
+    }
+
+
+def _report(pipe, job_id: str, results: List[dict]):
+    if not results:
+        return
+    added = sum(1 for result in results if result["status"] == "added")
+    pipe.rpush(_results_key(job_id), *(json.dumps(result, ensure_ascii=False) for result in results))
+    pipe.expire(_results_key(job_id), JOB_TTL)
+    pipe.hincrby(_job_key(job_id), "processed", len(results))
+    pipe.hincrby(_job_key(job_id), "added", added)
+    pipe.hincrby(_job_key(job_id), "failed", len(results) - added)
+
+
+def _commit_progress(job_id: str, results: List[dict], next_chunk: int):
+    """Результаты и номер следующей части пишутся одной транзакцией: после рестарта часть не повторяется."""
+    pipe = redis_client.pipeline(transaction=True)
+    _report(pipe, job_id, results)
+    pipe.hset(_job_key(job_id), mapping={"next_chunk": next_chunk, "updated_at": int(time.time())})
+    pipe.expire(_lock_key(job_id), STALL_TIMEOUT)
+    pipe.execute()
+
+
+def _touch(job_id: str):
+    redis_client.expire(_lock_key(job_id), STALL_TIMEOUT)
+
+
+def _finish(job_id: str, state: str):
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(_job_key(job_id), "state", state)
+    pipe.delete(_lines_key(job_id), _entries_key(job_id), _lock_key(job_id))
+    pipe.srem(JOBS_KEY, job_id)
+    pipe.execute()
+
+
+def _error(entry: dict, details: str) -> dict:
+    return {"line": entry["line"], "domain": entry.get("domain"), "status": "error", "details": details}
+
+
+def parse_import_lines(lines: List[str]):
+    """Разбирает строки domain|keyword|server_id|y/n. Возвращает (записи, ошибки разбора)."""
+    entries, errors = [], []
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            domain, keyword, server_id, nc_integration = map(str.strip, line.split("|"))
+            entries.append({
+                "line": number,
+                "domain": domain,
+                "keyword": keyword,
+                "server_id": int(server_id),
+                "namecheap_integration": nc_integration == 'y',
+            })
+        except ValueError:
+            errors.append({"line": number, "domain": None, "status": "error", "details": f"Неверный формат строки: {line}"})
+    return entries, errors
+
+
+async def _prefilter(entries: List[dict]):
+    """Одним запросом проверяет существующие домены и серверы для всего файла."""
+    async with worker_session_maker() as session:
+        result = await session.execute(
+            select(Domain.domain).where(Domain.domain.in_({entry["domain"] for entry in entries}))
+        )
+        existing = set(result.scalars().all())
+        result = await session.execute(
+            select(Server.id).where(Server.id.in_({entry["server_id"] for entry in entries}))
+        )
+        servers = set(result.scalars().all())
+
+    valid, errors = [], []
+    for entry in entries:
+        if entry["domain"] in existing:
+            errors.append(_error(entry, "Домен уже добавлен в систему."))
+        elif entry["server_id"] not in servers:
+            errors.append(_error(entry, "Указанный сервер не найден."))
+        else:
+            # Повтор домена внутри файла тоже считаем дублем
+            existing.add(entry["domain"])
+            valid.append(entry)
+    return valid, errors
+
+
+async def _already_imported(chunk: List[dict]):
+    """
+    Домены части, которые уже есть в базе. Бывает после рестарта, если часть сохранилась в базе,
+    но прогресс в Redis записать не успели: свои домены считаем добавленными, чужие - дублями.
+    """
+    async with worker_session_maker() as session:
+        result = await session.execute(
+            select(Domain.domain, Domain.owner_id).where(Domain.domain.in_({entry["domain"] for entry in chunk}))
+        )
+        return dict(result.all())
+
+
+async def _delete_zones(zones: List[tuple]):
+    """Откат: удаляет зоны Cloudflare, созданные для доменов, которые не попали в базу."""
+    deleted = await asyncio.gather(
+        *(delete_zone(domain, zone_id, cf_account.email, cf_account.api_key)
+          for domain, zone_id, cf_account in zones),
+        return_exceptions=True
+    )
+    for (domain, zone_id, cf_account), result in zip(zones, deleted):
+        if isinstance(result, Exception):
+            print(f"Ошибка удаления зоны {zone_id} ({domain}) из Cloudflare: {result}")
+
+
+async def _import_chunk(job_id: str, chunk: List[dict], owner_id: int, namecheap_username, namecheap_api):
+    results = []
+    existing = await _already_imported(chunk)
+    for entry in chunk:
+        if entry["domain"] in existing:
+            if existing[entry["domain"]] == owner_id:
+                results.append({"line": entry["line"], "domain": entry["domain"], "status": "added", "details": None})
+            else:
+                results.append(_error(entry, "Домен уже добавлен в систему."))
+    chunk = [entry for entry in chunk if entry["domain"] not in existing]
+    if not chunk:
+        return results
+
+    async with worker_session_maker() as session:
+        cf_accounts = await lock_free_cf_accounts(session, len(chunk))
+        for entry in chunk[len(cf_accounts):]:
+            results.append(_error(entry, "Нет доступных аккаунтов Cloudflare."))
+        assigned = dict(zip(range(len(cf_accounts)), zip(chunk, cf_accounts)))
+
+        async def register(index):
+            entry, cf_account = assigned[index]
+            zone = await add_domain_cf(entry["domain"], cf_account.email, cf_account.api_key)
+            if zone is None:
+                raise Exception("Не удалось добавить домен.")
+            ns_records = zone["name_servers"]
+
+            if entry["namecheap_integration"] and namecheap_api is not None:
+                try:
+                    await update_ns_records_on_namecheap(entry["domain"], ns_records[0], ns_records[1],
+                                                         namecheap_username, namecheap_api)
+                except Exception:
+                    await _delete_zones([(entry["domain"], zone["id"], cf_account)])
+                    raise
+
+            return {
+                "domain": entry["domain"],
+                "keyword": entry["keyword"],
+                "server_id": entry["server_id"],
+                "namecheap_integration": entry["namecheap_integration"],
+                "cf_connected": False,
+                "cf_id": cf_account.id,
+                "cf_zone_id": zone["id"],
+                "ns_record_first": ns_records[0],
+                "ns_record_second": ns_records[1],
+                "owner_id": owner_id,
+            }
+
+        # Внешние API параллельно, но не больше IMPORT_CONCURRENCY запросов одновременно
+        # Каждый обработанный домен продлевает блокировку загрузки
+        registered = await fan_out(assigned, register, per_server=IMPORT_CONCURRENCY,
+                                   on_progress=lambda result, index: _touch(job_id))
+        rows = [registered.results[index] for index in sorted(registered.results)]
+
+        try:
+            if rows:
+                await session.execute(insert(Domain), rows)
+                await recount_cf_accounts(session, [row["cf_id"] for row in rows])
+            await session.commit()
+        except Exception:
+            # Домены части не сохранены - созданные для них зоны удаляем
+            await _delete_zones([(row["domain"], row["cf_zone_id"], assigned[index][1])
+                                 for index, row in sorted(registered.results.items())])
+            raise
+    if rows:
+        invalidate_cache_sync(DOMAINS)
+
+    for index, (entry, cf_account) in assigned.items():
+        if index in registered.results:
+            results.append({"line": entry["line"], "domain": entry["domain"], "status": "added", "details": None})
+        else:
+            results.append(_error(entry, registered.errors[index]))
+    return results
+
+
+async def _namecheap_credentials(owner_id: int):
+    async with worker_session_maker() as session:
+        result = await session.execute(
+            select(User.namecheap_username, User.namecheap_api).where(User.id == owner_id)
+        )
+        return result.one()
+
+
+async def _prepare(job_id: str):
+    """Разбор и проверка файла при первом запуске. Записи сохраняются, чтобы продолжение их не перепроверяло."""
+    entries = redis_client.get(_entries_key(job_id))
+    if entries is not None:
+        return json.loads(entries)
+
+    entries, errors = parse_import_lines(json.loads(redis_client.get(_lines_key(job_id)) or "[]"))
+    if entries:
+        entries, prefilter_errors = await _prefilter(entries)
+        errors.extend(prefilter_errors)
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(_entries_key(job_id), json.dumps(entries, ensure_ascii=False), ex=JOB_TTL)
+    _report(pipe, job_id, errors)
+    pipe.hset(_job_key(job_id), mapping={"next_chunk": 0, "updated_at": int(time.time())})
+    pipe.execute()
+    return entries
+
+
+async def run_domain_import(job_id: str):
+    """
+    Загрузка доменов из файла в Celery задаче: каждые IMPORT_CHUNK строк сохраняются отдельной транзакцией.
+    После рестарта воркера продолжает с первой несохраненной части.
+    """
+    job = redis_client.hgetall(_job_key(job_id))
+    if not job or job["state"] != "running":
+        redis_client.srem(JOBS_KEY, job_id)
+        return
+    # Одну загрузку выполняет один воркер; блокировка продлевается после каждой части
+    if not redis_client.set(_lock_key(job_id), 1, nx=True, ex=STALL_TIMEOUT):
+        return
+
+    try:
+        owner_id = int(job["owner_id"])
+        namecheap_username, namecheap_api = await _namecheap_credentials(owner_id)
+        entries = await _prepare(job_id)
+
+        next_chunk = int(redis_client.hget(_job_key(job_id), "next_chunk") or 0)
+        for number in range(next_chunk, (len(entries) + IMPORT_CHUNK - 1) // IMPORT_CHUNK):
+            chunk = entries[number * IMPORT_CHUNK:(number + 1) * IMPORT_CHUNK]
+            try:
+                results = await _import_chunk(job_id, chunk, owner_id, namecheap_username, namecheap_api)
+            except Exception as e:
+                print(f"Ошибка загрузки доменов: {e}")
+                results = [_error(entry, "Ошибка сервера!") for entry in chunk]
+            _commit_progress(job_id, results, number + 1)
+
+        _finish(job_id, "done")
+    except Exception as e:
+        print(f"Ошибка загрузки доменов: {e}")
+        _finish(job_id, "error")
+
+
+def stalled_import_jobs() -> List[str]:
+    """Незавершенные загрузки без прогресса дольше STALL_TIMEOUT (воркер перезапущен или задача потеряна)."""
+    stalled = []
+    now = time.time()
+    for job_id in redis_client.smembers(JOBS_KEY):
+        job = redis_client.hmget(_job_key(job_id), "state", "updated_at")
+        if job[0] != "running":
+            redis_client.srem(JOBS_KEY, job_id)
+        elif now - int(job[1]) > STALL_TIMEOUT and not redis_client.exists(_lock_key(job_id)):
+            stalled.append(job_id)
+    return stalled
@@ -1,3 +1,4 @@
+from typing import Optional
 import paramiko
 from fastapi import APIRouter, Depends, HTTPException, Header, File, UploadFile, Query
 from fastapi_cache.decorator import cache
@@ -8,15 +9,21 @@ from sqlalchemy.sql import func
 from fastapi_pagination.ext.async_sqlalchemy import paginate
 from fastapi_pagination import Params, Page
 from modules.auth.base_config import fastapi_users
+from modules.cloudflare.allocator import allocate_cf_account, recount_cf_accounts
 from models import User, Domain, Server, Cloudflare, WhitePageStatus, WhiteKeywords, Themes
 from database import get_async_session
+from modules.domains.importer import create_import_job, get_import_job
 from modules.domains.schemas import DomainCreate, DomainChangeStatus, \
     DomainPostData, DomainAddForm, DomainAddWPAccess, DomainChangeKeyword, ReturnDomain, DomainTransfer
-from tasks import delete_domain, install_wordpress, install_plugins, \
-    change_theme, create_posts, add_form, configure_http, delete_posts, newadmin_wordpress, transfer_wordpress_site
+from tasks import delete_domain, install_wordpress, install_plugins, build_site, \
+    change_theme, create_posts, add_form, configure_http, delete_posts, newadmin_wordpress, transfer_wordpress_site, \
+    import_domains
+from tools.cache import CACHE_TTL, DOMAINS, cache_key_builder, invalidate_cache
 from tools.certbot import generate_lets_encrypt_cert, configure_ssl_in_apache
-from tools.cloudflare import check_ns_records, get_zone_id, delete_all_dns_records, add_a_records, get_ns_records, \
+from tools.cloudflare import check_ns_records, get_cached_zone_id, reconcile_dns_records, get_ns_records, \
     add_domain_cf, check_zone_status, set_ssl_full, get_ssl_certificate, get_certificate_id, set_ssl_flex
+from tools.idempotency import duplicate_response, enqueue_once
+from tools.pagination import CursorPage, MAX_PAGE_SIZE, paginate_by_id
 from tools.namecheap import check_domain_in_namecheap, update_ns_records_on_namecheap
 from tools.system_func import change_wp_status
 
@@ -28,8 +35,17 @@ router = APIRouter(
 current_user = fastapi_users.current_user()
 
 
+async def domain_zone_id(domain: Domain, session: AsyncSession) -> str:
+    """ID зоны из базы, для старых доменов - из кэша/API с сохранением в базу."""
+    if domain.cf_zone_id is None:
+        domain.cf_zone_id = await get_cached_zone_id(domain.domain, domain.cloudflare.email, domain.cloudflare.api_key)
+        await session.commit()
+        await invalidate_cache(DOMAINS)
+    return domain.cf_zone_id
+
+
 @router.get("", response_model=Page[ReturnDomain])
-@cache(expire=600)
+@cache(expire=CACHE_TTL, namespace=DOMAINS, key_builder=cache_key_builder)
 async def get_domains(
         user: User = Depends(current_user),
         params: Params = Depends(),
@@ -44,7 +60,7 @@ async def get_domains(
         }))
 
     try:
-        query = select(Domain).order_by(desc(Domain.id))
+        query = select(Domain).options(joinedload(Domain.server), joinedload(Domain.cloudflare)).order_by(desc(Domain.id))
 
         if domain_name:
             search_pattern = f"%{domain_name}%"
@@ -62,6 +78,30 @@ async def get_domains(
         }))
 
 
+@router.get("/cursor", response_model=CursorPage[ReturnDomain])
+async def get_domains_cursor(
+        user: User = Depends(current_user),
+        session: AsyncSession = Depends(get_async_session),
+        cursor: Optional[int] = Query(None, description="next_cursor from the previous page"),
+        size: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+        with_total: bool = Query(False, description="Return an approximate total"),
+        domain_name: str = Query(None, description="Name or partial name of the domain to search")
+):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    query = select(Domain).options(joinedload(Domain.server), joinedload(Domain.cloudflare))
+
+    if domain_name:
+        query = query.where(Domain.domain.ilike(f"%{domain_name}%"))
+
+    return await paginate_by_id(session, query, Domain.id, cursor, size, with_total)
+
+
 @router.post("")
 async def add_domain(domain: DomainCreate, user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
     if not user.is_active:
@@ -95,15 +135,7 @@ async def add_domain(domain: DomainCreate, user: User = Depends(current_user), s
             "details": "Указанный сервер не найден."
         }))
 
-    query = (
-        select(Cloudflare)
-        .outerjoin(Domain)
-        .options(joinedload(Cloudflare.domain))
-        .where(Domain.id == None)
-    )
-
-    result = await session.execute(query)
-    cf_current = result.first()
+    cf_current = await allocate_cf_account(session)
 
     if cf_current is None:
         raise (HTTPException(status_code=400, detail={
@@ -113,17 +145,19 @@ async def add_domain(domain: DomainCreate, user: User = Depends(current_user), s
         }))
 
     domain_info = domain.dict()
-    domain_info['cf_id'] = cf_current[0].id
+    domain_info['cf_id'] = cf_current.id
     domain_info['owner_id'] = user.id
-    ns_records = await add_domain_cf(domain_info['domain'], cf_current[0].email, cf_current[0].api_key)
-    if ns_records is None:
+    zone = await add_domain_cf(domain_info['domain'], cf_current.email, cf_current.api_key)
+    if zone is None:
         raise (HTTPException(status_code=400, detail={
             "status": "error",
             "data": None,
             "details": "Не удалось добавить домен."
         }))
 
+    ns_records = zone["name_servers"]
     domain_info['cf_connected'] = False
+    domain_info['cf_zone_id'] = zone["id"]
     domain_info['ns_record_first'] = ns_records[0]
     domain_info['ns_record_second'] = ns_records[1]
 
@@ -146,6 +180,7 @@ async def add_domain(domain: DomainCreate, user: User = Depends(current_user), s
     stmt = insert(Domain).values(**domain_info)
     await session.execute(stmt)
     await session.commit()
+    await invalidate_cache(DOMAINS)
 
     return {
         "status": "success",
@@ -158,112 +193,44 @@ async def add_domain(domain: DomainCreate, user: User = Depends(current_user), s
 
 
 @router.post("/upload")
-async def upload_accounts(file: UploadFile = File(...), user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
-    try:
-        if not user.is_active:
-            raise (HTTPException(status_code=403, detail={
-                "status": "error",
-                "data": None,
-                "details": "Ваш аккаунт не активирован!"
-            }))
+async def upload_accounts(file: UploadFile = File(...), user: User = Depends(current_user)):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
 
-        content = await file.read()
-        content = content.decode("utf-8")
-        lines = content.splitlines()
-
-        for line in lines:
-            try:
-                domain, keyword, server_id, nc_intregration = map(str.strip, line.split("|"))
-                server_id = int(server_id)
-
-                query = select(Domain).where(Domain.domain == domain)
-                result = await session.execute(query)
-                domain_current = result.scalar_one_or_none()
-
-                if domain_current is not None:
-                    raise (HTTPException(status_code=400, detail={
-                        "status": "error",
-                        "data": None,
-                        "details": "Домен уже добавлен в систему."
-                    }))
-
-                query = select(Server).where(Server.id == server_id)
-                result = await session.execute(query)
-                server = result.scalar_one_or_none()
-
-                if server is None:
-                    raise (HTTPException(status_code=404, detail={
-                        "status": "error",
-                        "data": None,
-                        "details": "Указанный сервер не найден."
-                    }))
-
-                query = (
-                    select(Cloudflare)
-                    .outerjoin(Domain)
-                    .options(joinedload(Cloudflare.domain))
-                    .where(Domain.id == None)
-                )
-
-                result = await session.execute(query)
-                cf_current = result.first()
-
-                if cf_current is None:
-                    raise (HTTPException(status_code=400, detail={
-                        "status": "error",
-                        "data": None,
-                        "details": "Нет доступных аккаунтов Cloudflare."
-                    }))
-
-                domain_info = {
-                    'domain': domain,
-                    'keyword': keyword,
-                    'server_id': server_id,
-                    'namecheap_integration': True if nc_intregration == 'y' else False,
-                    'cf_connected': False,
-                    'cf_id': cf_current[0].id,
-                    'owner_id': user.id
-                }
-
-                ns_records = await add_domain_cf(domain_info['domain'], cf_current[0].email, cf_current[0].api_key)
-                if ns_records is None:
-                    raise (HTTPException(status_code=400, detail={
-                        "status": "error",
-                        "data": None,
-                        "details": "Не удалось добавить домен."
-                    }))
-                domain_info['ns_record_first'] = ns_records[0]
-                domain_info['ns_record_second'] = ns_records[1]
-
-                if domain_info['namecheap_integration']:
-                    if user.namecheap_api is not None:
-                        await update_ns_records_on_namecheap(
-                            domain_info['domain'],
-                            ns_records[0],
-                            ns_records[1],
-                            user.namecheap_username,
-                            user.namecheap_api
-                        )
-
-                stmt = insert(Domain).values(**domain_info)
-                await session.execute(stmt)
-            except Exception as e:
-                print(f"Домен не добавлен")
-                print(line)
-                print(e)
-                continue
+    content = await file.read()
+    content = content.decode("utf-8")
+    lines = content.splitlines()
 
-        await session.commit()
+    job_id = await create_import_job(user.id, lines)
+    import_domains.delay(job_id)
 
-        return {"status": "success", "data": None, "msg": f"Домены были добавлены из файла {file.filename}."}
-    except Exception as e:
-        print(e)
-        raise (HTTPException(status_code=500, detail={
+    return {"status": "success", "data": {"job_id": job_id}, "msg": f"Загрузка доменов из файла {file.filename} запущена."}
+
+
+@router.get("/upload/{job_id}")
+async def get_upload_progress(job_id: str, user: User = Depends(current_user)):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    job = await get_import_job(job_id, user.id)
+
+    if job is None:
+        raise (HTTPException(status_code=404, detail={
             "status": "error",
             "data": None,
-            "details": "Ошибка сервера!"
+            "details": "Загрузка не найдена."
         }))
 
+    return {"status": "success", "data": job, "msg": None}
+
 
 @router.patch("/configure/{domain_id}")
 async def config_domain(domain_id: int, user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
@@ -301,9 +268,11 @@ async def config_domain(domain_id: int, user: User = Depends(current_user), sess
     # elif domain.status is WhitePageStatus.DONE:
     #     return {"status": "failed", "data": None, "msg": f"Настройка для домена {domain.domain} не требуется."}
     else:
-        install_wordpress.delay(domain.domain, domain.keyword, server.ip, server.login, server.password, server.port)
+        task_id, created = await enqueue_once(install_wordpress, domain.domain, domain.keyword, server.ip, server.login, server.password, server.port)
+        if not created:
+            return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началась конфигурация домена {domain.domain}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась конфигурация домена {domain.domain}."}
 
 
 @router.post("/check_ns/{domain_id}")
@@ -315,7 +284,7 @@ async def check_ns_domain(domain_id: int, user: User = Depends(current_user), se
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server), joinedload(Domain.cloudflare))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -327,16 +296,17 @@ async def check_ns_domain(domain_id: int, user: User = Depends(current_user), se
         }))
 
     if domain.cf_id is not None and not domain.cf_connected:
-        zone_id = await get_zone_id(domain.domain, domain.cloudflare.email, domain.cloudflare.api_key)
+        zone_id = await domain_zone_id(domain, session)
         print(zone_id)
         ns_check_result = await check_zone_status(zone_id, domain.cloudflare.email, domain.cloudflare.api_key)
         print(ns_check_result)
         domain.cf_connected = ns_check_result
         await session.commit()
+        await invalidate_cache(DOMAINS)
 
         if ns_check_result:
-            await delete_all_dns_records(zone_id, domain.cloudflare.email, domain.cloudflare.api_key)
-            await add_a_records(zone_id, domain.server.ip, domain.cloudflare.email, domain.cloudflare.api_key)
+            await reconcile_dns_records(zone_id, domain.domain, domain.server.ip, domain.cloudflare.email,
+                                        domain.cloudflare.api_key)
 
     return {"status": "success", "data": None, "msg": f"NS домена {domain.domain} проверены."}
 
@@ -350,7 +320,7 @@ async def transfer_domain(transfer_info: DomainTransfer, user: User = Depends(cu
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == transfer_info.domain_id)
+    query = select(Domain).where(Domain.id == transfer_info.domain_id).options(joinedload(Domain.server), joinedload(Domain.cloudflare))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -373,9 +343,9 @@ async def transfer_domain(transfer_info: DomainTransfer, user: User = Depends(cu
         }))
 
     if domain.cf_id is not None and domain.cf_connected:
-        zone_id = await get_zone_id(domain.domain, domain.cloudflare.email, domain.cloudflare.api_key)
-        await delete_all_dns_records(zone_id, domain.cloudflare.email, domain.cloudflare.api_key)
-        await add_a_records(zone_id, new_server.ip, domain.cloudflare.email, domain.cloudflare.api_key)
+        zone_id = await domain_zone_id(domain, session)
+        await reconcile_dns_records(zone_id, domain.domain, new_server.ip, domain.cloudflare.email,
+                                    domain.cloudflare.api_key)
 
         change_mode = await set_ssl_flex(zone_id, domain.cloudflare.email, domain.cloudflare.api_key)
         if not change_mode:
@@ -385,7 +355,8 @@ async def transfer_domain(transfer_info: DomainTransfer, user: User = Depends(cu
                 "details": "Ошибка смены SSL Mode!"
             }))
 
-        transfer_wordpress_site.delay(
+        task_id, created = await enqueue_once(
+            transfer_wordpress_site,
             domain.domain,
             domain.server.ip,
             domain.server.login,
@@ -396,6 +367,8 @@ async def transfer_domain(transfer_info: DomainTransfer, user: User = Depends(cu
             new_server.password,
             new_server.port
         )
+        if not created:
+            return duplicate_response(task_id)
 
     else:
         raise (HTTPException(status_code=400, detail={
@@ -404,7 +377,7 @@ async def transfer_domain(transfer_info: DomainTransfer, user: User = Depends(cu
             "details": "Cначала нужно дождаться привязки CloudFlare."
         }))
 
-    return {"status": "success", "data": None, "msg": f"NS домена {domain.domain} проверены."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"NS домена {domain.domain} проверены."}
 
 
 @router.post("/config_http/{domain_id}")
@@ -416,7 +389,7 @@ async def config_http_domain(domain_id: int, user: User = Depends(current_user),
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -427,9 +400,11 @@ async def config_http_domain(domain_id: int, user: User = Depends(current_user),
             "details": "Домен не найден."
         }))
 
-    configure_http.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(configure_http, domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Конфиг apache создан для {domain.domain}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Конфиг apache создан для {domain.domain}."}
 
 
 @router.patch("/set_full_ssl_mode/{domain_id}")
@@ -441,7 +416,7 @@ async def set_full_ssl_mode(domain_id: int, user: User = Depends(current_user),
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.cloudflare))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -452,7 +427,7 @@ async def set_full_ssl_mode(domain_id: int, user: User = Depends(current_user),
             "details": "Домен не найден."
         }))
 
-    zone_id = await get_zone_id(domain.domain, domain.cloudflare.email, domain.cloudflare.api_key)
+    zone_id = await domain_zone_id(domain, session)
     change_mode = await set_ssl_full(zone_id, domain.cloudflare.email, domain.cloudflare.api_key)
     if not change_mode:
         raise (HTTPException(status_code=400, detail={
@@ -473,7 +448,7 @@ async def set_flex_ssl_mode(domain_id: int, user: User = Depends(current_user),
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.cloudflare))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -484,7 +459,7 @@ async def set_flex_ssl_mode(domain_id: int, user: User = Depends(current_user),
             "details": "Домен не найден."
         }))
 
-    zone_id = await get_zone_id(domain.domain, domain.cloudflare.email, domain.cloudflare.api_key)
+    zone_id = await domain_zone_id(domain, session)
     change_mode = await set_ssl_flex(zone_id, domain.cloudflare.email, domain.cloudflare.api_key)
     if not change_mode:
         raise (HTTPException(status_code=400, detail={
@@ -524,6 +499,7 @@ async def change_status_domain(domain_info: DomainChangeStatus, session: AsyncSe
             pass
 
     await session.commit()
+    await invalidate_cache(DOMAINS)
 
     return {"status": "success", "data": None, "msg": None}
 
@@ -537,7 +513,7 @@ async def remove_domain(domain_id: int, user: User = Depends(current_user), sess
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -548,13 +524,22 @@ async def remove_domain(domain_id: int, user: User = Depends(current_user), sess
             "details": "Домен не найден."
         }))
 
-    delete_domain.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(delete_domain, domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        # Удаление и очистка делят одну задачу: запись в базе не тронута, вызывающий должен повторить
+        raise (HTTPException(status_code=409, detail={
+            "status": "error",
+            "data": {"task_id": task_id},
+            "details": "Файлы домена уже удаляются, повторите запрос после завершения задачи."
+        }))
 
     stmt = delete(Domain).where(Domain.id == domain_id)
     await session.execute(stmt)
+    await recount_cf_accounts(session, [domain.cf_id])
     await session.commit()
+    await invalidate_cache(DOMAINS)
 
-    return {"status": "success", "data": None, "msg": f"Домен с ID {domain_id} удален."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Домен с ID {domain_id} удален."}
 
 
 @router.delete("/posts/{domain_id}")
@@ -566,7 +551,7 @@ async def remove_domain(domain_id: int, user: User = Depends(current_user), sess
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -577,9 +562,11 @@ async def remove_domain(domain_id: int, user: User = Depends(current_user), sess
             "details": "Домен не найден."
         }))
 
-    delete_posts.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(delete_posts, domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Все посты у домена {domain.domain} будут удалены."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Все посты у домена {domain.domain} будут удалены."}
 
 
 @router.patch("/clear_all/{domain_id}")
@@ -591,7 +578,7 @@ async def clear_domain(domain_id: int, user: User = Depends(current_user), sessi
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -602,7 +589,14 @@ async def clear_domain(domain_id: int, user: User = Depends(current_user), sessi
             "details": "Домен не найден."
         }))
 
-    delete_domain.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(delete_domain, domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        # Удаление и очистка делят одну задачу: запись в базе не тронута, вызывающий должен повторить
+        raise (HTTPException(status_code=409, detail={
+            "status": "error",
+            "data": {"task_id": task_id},
+            "details": "Файлы домена уже удаляются, повторите запрос после завершения задачи."
+        }))
 
     domain.wp_pass = None
     domain.wp_login = None
@@ -611,8 +605,9 @@ async def clear_domain(domain_id: int, user: User = Depends(current_user), sessi
     domain.theme_changed = False
     domain.form_added = False
     await session.commit()
+    await invalidate_cache(DOMAINS)
 
-    return {"status": "success", "data": None, "msg": f"Домен с ID {domain_id} очищен."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Домен с ID {domain_id} очищен."}
 
 
 @router.put("/create_admin/{domain_id}")
@@ -624,7 +619,7 @@ async def new_admin_domain(domain_id: int, user: User = Depends(current_user), s
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -635,9 +630,11 @@ async def new_admin_domain(domain_id: int, user: User = Depends(current_user), s
             "details": "Домен не найден."
         }))
 
-    newadmin_wordpress.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(newadmin_wordpress, domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началось создания нового админа для домена {domain.domain}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началось создания нового админа для домена {domain.domain}."}
 
 
 @router.patch("/keyword")
@@ -669,6 +666,7 @@ async def change_keyword_domain(data: DomainChangeKeyword, user: User = Depends(
         domain.keyword = data.keyword
 
     await session.commit()
+    await invalidate_cache(DOMAINS)
 
     return {"status": "success", "data": None, "msg": f"Домен с ID {data.domain_id} изменен."}
 
@@ -690,6 +688,7 @@ async def add_cms_credentials(info: DomainAddWPAccess, session: AsyncSession = D
     domain.wp_pass = info.password
 
     await session.commit()
+    await invalidate_cache(DOMAINS)
 
     return {"status": "success", "data": None, "msg": None}
 
@@ -703,7 +702,7 @@ async def install_plugins_domain(domain_id: int, user: User = Depends(current_us
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -728,9 +727,11 @@ async def install_plugins_domain(domain_id: int, user: User = Depends(current_us
             "details": "Плагины уже установлены."
         }))
 
-    install_plugins.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(install_plugins, domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началась установка плагинов для вайта {domain.domain}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась установка плагинов для вайта {domain.domain}."}
 
 
 @router.put("/wp/{domain_id}/theme")
@@ -743,7 +744,7 @@ async def change_theme_domain(domain_id: int, user: User = Depends(current_user)
                 "details": "Ваш аккаунт не активирован!"
             }))
 
-        query = select(Domain).where(Domain.id == domain_id)
+        query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
         result = await session.execute(query)
         domain = result.scalar_one_or_none()
 
@@ -767,11 +768,14 @@ async def change_theme_domain(domain_id: int, user: User = Depends(current_user)
         print(theme_slug)
         print(theme_slug.name)
 
-        change_theme.delay(domain.domain, theme_slug.name, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+        task_id, created = await enqueue_once(change_theme, domain.domain, theme_slug.name, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+        if not created:
+            return duplicate_response(task_id)
         domain.form_added = False
         await session.commit()
+        await invalidate_cache(DOMAINS)
 
-        return {"status": "success", "data": None, "msg": f"Началась установка темы для вайта {domain.domain}."}
+        return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась установка темы для вайта {domain.domain}."}
     except:
         raise (HTTPException(status_code=500, detail={
             "status": "error",
@@ -789,7 +793,7 @@ async def create_posts_domain(domain_id: int, user: User = Depends(current_user)
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -807,9 +811,58 @@ async def create_posts_domain(domain_id: int, user: User = Depends(current_user)
             "details": "Сначала выполните конфигурацию домена или дождитесь ее завершения."
         }))
 
-    create_posts.delay(domain.domain, domain.keyword, 5, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(create_posts, domain.domain, domain.keyword, 5, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
+
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась генерация постов для вайта {domain.domain}."}
+
+
+@router.put("/wp/{domain_id}/build")
+async def build_site_domain(domain_id: int, posts_count: int = 5, user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
+    """Вся сборка сайта одной задачей: WordPress, HTTP, тема, посты и форма. Выполненные шаги пропускаются."""
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
+    result = await session.execute(query)
+    domain = result.scalar_one_or_none()
+
+    if domain is None:
+        raise (HTTPException(status_code=404, detail={
+            "status": "error",
+            "data": None,
+            "details": "Домен не найден."
+        }))
+
+    if domain.status is WhitePageStatus.CONFIGURE:
+        return {"status": "failed", "data": None, "msg": f"С доменом {domain.domain} в данный момент происходят автоматизированные действия."}
+
+    completed = [flag for flag in ("plugins_installed", "theme_changed", "posts_created", "form_added")
+                 if getattr(domain, flag)]
+
+    theme_slug = None
+    if not domain.theme_changed:
+        query = select(Themes.name).order_by(func.random()).limit(1)
+        result = await session.execute(query)
+        theme_slug = result.scalar_one_or_none()
+        if theme_slug is None:
+            raise (HTTPException(status_code=400, detail={
+                "status": "error",
+                "data": None,
+                "details": "Темы не добавлены."
+            }))
+
+    params = {"keyword": domain.keyword, "theme_slug": theme_slug, "posts_count": posts_count}
+    task_id, created = await enqueue_once(build_site, domain.domain, params, completed, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началась генерация постов для вайта {domain.domain}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась сборка вайта {domain.domain}."}
 
 
 @router.put("/wp/{domain_id}/form")
@@ -821,7 +874,7 @@ async def add_form_domain(domain_id: int, user: User = Depends(current_user), se
             "details": "Ваш аккаунт не активирован!"
         }))
 
-    query = select(Domain).where(Domain.id == domain_id)
+    query = select(Domain).where(Domain.id == domain_id).options(joinedload(Domain.server))
     result = await session.execute(query)
     domain = result.scalar_one_or_none()
 
@@ -846,6 +899,8 @@ async def add_form_domain(domain_id: int, user: User = Depends(current_user), se
             "details": "Форма уже добавлена."
         }))
 
-    add_form.delay(domain.domain, domain.keyword, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    task_id, created = await enqueue_once(add_form, domain.domain, domain.keyword, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началась генерация постов для вайта {domain.domain}."}
\ No newline at end of file
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась генерация постов для вайта {domain.domain}."}
\ No newline at end of file
@@ -0,0 +1,81 @@
+import json
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from modules.auth.base_config import fastapi_users
+from models import User
+from tools.config import config_read
+from tools.redis_client import async_redis
+from tools.system_func import EVENTS_CHANNEL
+
+router = APIRouter(
+    prefix="/events",
+    tags=["Events"]
+)
+
+current_user = fastapi_users.current_user()
+
+config = config_read("config.ini")
+
+# Комментарий-пинг, чтобы прокси не закрывали простаивающее соединение
+HEARTBEAT_INTERVAL = config.getfloat('EVENTS', 'heartbeat', fallback=15.0)
+
+
+async def event_stream(request: Request, domain: Optional[str], server: Optional[str]):
+    pubsub = async_redis.pubsub()
+    await pubsub.subscribe(EVENTS_CHANNEL)
+    try:
+        last_sent = time.monotonic()
+        while not await request.is_disconnected():
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is not None:
+                event = json.loads(message["data"])
+                if (domain is None or (event["kind"] == "domain" and event["name"] == domain)) and \
+                        (server is None or (event["kind"] == "server" and event["name"] == server)):
+                    last_sent = time.monotonic()
+                    yield f"event: {event['event']}\ndata: {message['data']}\n\n"
+                    continue
+
+            # Пинг и тогда, когда события идут, но все отфильтрованы
+            if time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                last_sent = time.monotonic()
+                yield ": ping\n\n"
+    finally:
+        await pubsub.unsubscribe(EVENTS_CHANNEL)
+        await pubsub.close()
+
+
+@router.get("")
+async def get_events(
+        request: Request,
+        domain: Optional[str] = None,
+        server: Optional[str] = None,
+        user: User = Depends(current_user),
+):
+    """
+    Server-Sent Events: смена статусов и шаги задач Celery в реальном времени.
+    domain/server - фильтр по имени домена или IP сервера, только один из них.
+    """
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    # Событие относится либо к домену, либо к серверу - оба фильтра сразу не совпадут ни с чем
+    if domain is not None and server is not None:
+        raise (HTTPException(status_code=400, detail={
+            "status": "error",
+            "data": None,
+            "details": "Укажите либо domain, либо server."
+        }))
+
+    return StreamingResponse(
+        event_stream(request, domain, server),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
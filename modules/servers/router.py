@@ -1,16 +1,21 @@
 from typing import Optional, List
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Query
 from fastapi_cache.decorator import cache
 from sqlalchemy import insert, select, desc, delete, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 from fastapi_pagination.ext.async_sqlalchemy import paginate
 from fastapi_pagination import Params, Page
-from tasks import configure_server, delete_domain, restart_apache, create_certs, install_wpcli, install_certbot, \
+from tasks import configure_server, delete_domains, restart_apache, create_certs, install_wpcli, install_certbot, \
     generate_private_key, reboot_system, selinux_off, multi_delete_plugin, multi_install_plugin, \
-    generate_csv_and_send_email
+    generate_csv_and_send_email, rebuild_golden_site
 from modules.auth.base_config import fastapi_users
+from modules.cloudflare.allocator import recount_cf_accounts
 from models import User, Domain, Server, ServerStatus
 from database import get_async_session
+from tools.cache import CACHE_TTL, DOMAINS, SERVERS, cache_key_builder, invalidate_cache
+from tools.idempotency import duplicate_response, enqueue_once
+from tools.pagination import CursorPage, MAX_PAGE_SIZE, paginate_by_id
 from .schemas import ReturnServer, ReturnDomain, AddServer, ServerChangeStatus, UpdateServer
 import logging
 
@@ -23,7 +28,7 @@ current_user = fastapi_users.current_user()
 
 
 @router.get("", response_model=Page[ReturnServer])
-@cache(expire=600)
+@cache(expire=CACHE_TTL, namespace=SERVERS, key_builder=cache_key_builder)
 async def get_servers(
     server_id: Optional[int] = None,
     ip: Optional[str] = None,
@@ -72,6 +77,34 @@ async def get_servers(
         }))
 
 
+@router.get("/cursor", response_model=CursorPage[ReturnServer])
+async def get_servers_cursor(
+    ip: Optional[str] = None,
+    server_name: Optional[str] = None,
+    cursor: Optional[int] = Query(None, description="next_cursor from the previous page"),
+    size: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    with_total: bool = Query(False, description="Return an approximate total"),
+    user: User = Depends(current_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Your account is not active!"
+        }))
+
+    query = select(Server)
+
+    if ip is not None:
+        query = query.where(Server.ip.like(f"%{ip}%"))
+
+    if server_name is not None:
+        query = query.where(Server.server_name.like(f"%{server_name}%"))
+
+    return await paginate_by_id(session, query, Server.id, cursor, size, with_total)
+
+
 @router.post("")
 async def add_server(
     server: AddServer,
@@ -112,11 +145,14 @@ async def add_server(
     stmt = insert(Server).values(**server_info)
     await session.execute(stmt)
     await session.commit()
+    await invalidate_cache(SERVERS)
 
     # Запуск асинхронной задачи
-    configure_server.delay(server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(configure_server, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Сервер {server.ip} добавлен."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Сервер {server.ip} добавлен."}
 
 @router.post("/ssh_key")
 async def create_ssh_key(server_id: int, user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
@@ -138,9 +174,11 @@ async def create_ssh_key(server_id: int, user: User = Depends(current_user), ses
             "details": "Сервер не найден."
         }))
 
-    generate_private_key.delay(server_current.ip, server_current.login, server_current.password, server_current.port)
+    task_id, created = await enqueue_once(generate_private_key, server_current.ip, server_current.login, server_current.password, server_current.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Сервер {server_current.ip} начал выпуск SSH Private Key."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Сервер {server_current.ip} начал выпуск SSH Private Key."}
 
 
 @router.post("/install_wp_cli/{server_id}")
@@ -163,9 +201,11 @@ async def install_wp_cli(server_id: int, user: User = Depends(current_user), ses
             "details": "Сервер не найден."
         }))
 
-    install_wpcli.delay(server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(install_wpcli, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началась установка WP-CLI на сервер {server.ip}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась установка WP-CLI на сервер {server.ip}."}
 
 
 @router.post("/install_certbot/{server_id}")
@@ -188,9 +228,38 @@ async def install_certbot_on_server(server_id: int, user: User = Depends(current
             "details": "Сервер не найден."
         }))
 
-    install_certbot.delay(server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(install_certbot, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
+
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась установка WP-CLI на сервер {server.ip}."}
+
+
+@router.post("/golden/{server_id}")
+async def rebuild_golden_site_on_server(server_id: int, user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Your account is not active!"
+        }))
+
+    query = select(Server).where(Server.id == server_id)
+    result = await session.execute(query)
+    server = result.scalar_one_or_none()
+
+    if server is None:
+        raise (HTTPException(status_code=404, detail={
+            "status": "error",
+            "data": None,
+            "details": "Сервер не найден."
+        }))
+
+    task_id, created = await enqueue_once(rebuild_golden_site, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": f"Началась установка WP-CLI на сервер {server.ip}."}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": f"Началась пересборка эталонного сайта на сервере {server.ip}."}
 
 
 @router.delete("/{server_id}")
@@ -213,21 +282,23 @@ async def delete_server(server_id: int, user: User = Depends(current_user), sess
             "details": "Сервер не найден."
         }))
 
-    query = select(Domain).where(Domain.server_id == server_id)
+    query = select(Domain.domain).where(Domain.server_id == server_id)
     result = await session.execute(query)
-    domains = result.all()
+    domains = result.scalars().all()
     if domains:
-        domains = domains[0]
-        for domain in domains:
-            delete_domain.delay(domain.domain, domain.server.ip, domain.server.login, domain.server.password, domain.server.port)
+        task_id, created = await enqueue_once(delete_domains, domains, server.ip, server.login, server.password, server.port)
+        if not created:
+            return duplicate_response(task_id)
 
-    stmt = delete(Domain).where(Domain.server_id == server_id)
-    await session.execute(stmt)
+    stmt = delete(Domain).where(Domain.server_id == server_id).returning(Domain.cf_id)
+    result = await session.execute(stmt)
+    await recount_cf_accounts(session, result.scalars().all())
 
     stmt = delete(Server).where(Server.id == server_id)
     await session.execute(stmt)
 
     await session.commit()
+    await invalidate_cache(SERVERS, DOMAINS)
 
     return {"status": "success", "data": None, "msg": f"Сервер c ID {server_id} удален."}
 
@@ -252,13 +323,15 @@ async def server_install_plugin_for_sites(server_id: int, plugin_name: str, user
             "details": "Сервер не найден."
         }))
 
-    domains = []
-    for domain in server.domains:
-        domains.append(domain.domain)
+    query = select(Domain.domain).where(Domain.server_id == server_id)
+    result = await session.execute(query)
+    domains = result.scalars().all()
 
-    multi_install_plugin.delay(domains, plugin_name, server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(multi_install_plugin, domains, plugin_name, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": "Установка плагина запущено"}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": "Установка плагина запущено"}
 
 
 @router.delete("/{server_id}/sites/plugins")
@@ -281,13 +354,15 @@ async def server_delete_plugin_from_sites(server_id: int, plugin_name: str, user
             "details": "Сервер не найден."
         }))
 
-    domains = []
-    for domain in server.domains:
-        domains.append(domain.domain)
+    query = select(Domain.domain).where(Domain.server_id == server_id)
+    result = await session.execute(query)
+    domains = result.scalars().all()
 
-    multi_delete_plugin.delay(domains, plugin_name, server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(multi_delete_plugin, domains, plugin_name, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": "Удаление плагина запущено"}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": "Удаление плагина запущено"}
 
 
 @router.post("/create_ssl/{server_id}")
@@ -310,13 +385,15 @@ async def server_create_ssl_for_domains(server_id: int, user: User = Depends(cur
             "details": "Сервер не найден."
         }))
 
-    domains = []
-    for domain in server.domains:
-        domains.append(domain.domain)
+    query = select(Domain.domain).where(Domain.server_id == server_id)
+    result = await session.execute(query)
+    domains = result.scalars().all()
 
-    create_certs.delay(domains, server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(create_certs, domains, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": None}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": None}
 
 
 @router.post("/restart_apache/{server_id}")
@@ -339,9 +416,11 @@ async def server_restart_apache(server_id: int, user: User = Depends(current_use
             "details": "Сервер не найден."
         }))
 
-    restart_apache.delay(server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(restart_apache, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": None}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": None}
 
 
 
@@ -401,6 +480,37 @@ async def get_domains_by_server(
         )
 
 
+@router.get("/{server_id}/domains/cursor", response_model=CursorPage[ReturnDomain])
+async def get_domains_by_server_cursor(
+    server_id: int,
+    cursor: Optional[int] = Query(None, description="next_cursor from the previous page"),
+    size: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    with_total: bool = Query(False, description="Return an approximate total"),
+    user: User = Depends(current_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Your account is not active!"
+        }))
+
+    query = select(Server.id).where(Server.id == server_id)
+    result = await session.execute(query)
+
+    if result.scalar_one_or_none() is None:
+        raise (HTTPException(status_code=404, detail={
+            "status": "error",
+            "data": None,
+            "details": "Сервер не найден."
+        }))
+
+    query = select(Domain).where(Domain.server_id == server_id)
+
+    return await paginate_by_id(session, query, Domain.id, cursor, size, with_total)
+
+
 @router.patch("/reboot/{server_id}")
 async def server_reboot(server_id: int, user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
     if not user.is_active:
@@ -421,9 +531,11 @@ async def server_reboot(server_id: int, user: User = Depends(current_user), sess
             "details": "Сервер не найден."
         }))
 
-    reboot_system.delay(server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(reboot_system, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": None}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": None}
 
 
 @router.patch("/selinux/off/{server_id}")
@@ -446,9 +558,11 @@ async def server_off_selinux(server_id: int, user: User = Depends(current_user),
             "details": "Сервер не найден."
         }))
 
-    selinux_off.delay(server.ip, server.login, server.password, server.port)
+    task_id, created = await enqueue_once(selinux_off, server.ip, server.login, server.password, server.port)
+    if not created:
+        return duplicate_response(task_id)
 
-    return {"status": "success", "data": None, "msg": None}
+    return {"status": "success", "data": {"task_id": task_id}, "msg": None}
 
 
 @router.patch("/change_status")
@@ -466,13 +580,14 @@ async def change_status_domain(server_info: ServerChangeStatus, session: AsyncSe
 
     server.status = server_info.status
     await session.commit()
+    await invalidate_cache(SERVERS)
 
     return {"status": "success", "data": None, "msg": None}
 
 
 @router.patch("/report/domains")
 async def get_domains_report(server_ids: List[int], user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
-    query = select(Domain).where(Domain.server_id.in_(server_ids))
+    query = select(Domain).where(Domain.server_id.in_(server_ids)).options(joinedload(Domain.server))
     result = await session.execute(query)
     domains = result.scalars().all()
 
@@ -543,6 +658,7 @@ async def update_server(
         stmt = update(Server).where(Server.id == server_id).values(**update_data)
         await session.execute(stmt)
         await session.commit()
+        await invalidate_cache(SERVERS, DOMAINS)
         
         # Получаем обновленные данные сервера
         query = select(Server).where(Server.id == server_id)
@@ -6,8 +6,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi_pagination.ext.async_sqlalchemy import paginate
 from fastapi_pagination import Params, Page
 from modules.auth.base_config import fastapi_users
+from modules.cloudflare.allocator import recount_cf_accounts
 from models import User, Domain, Server, ServerStatus, BlackKeywords, WhiteKeywords, Themes
 from database import get_async_session
+from tools.cache import CLOUDFLARE, invalidate_cache
 
 
 router = APIRouter(
@@ -415,4 +417,19 @@ async def add_themes(user: User = Depends(current_user), session: AsyncSession =
     session.add_all([Themes(name=theme) for theme in themes])
     await session.commit()
 
-    return {"status": "success", "data": None, "msg": f"Темы WP добавлены."}
\ No newline at end of file
+    return {"status": "success", "data": None, "msg": f"Темы WP добавлены."}
+
+@router.post("/cf_accounts/recount")
+async def recount_cf_domains(user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Your account is not active!"
+        }))
+
+    await recount_cf_accounts(session)
+    await session.commit()
+    await invalidate_cache(CLOUDFLARE)
+
+    return {"status": "success", "data": None, "msg": f"Счетчики доменов Cloudflare пересчитаны."}
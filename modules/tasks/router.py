@@ -0,0 +1,169 @@
+import json
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from modules.auth.base_config import fastapi_users
+from models import User
+from tasks import celery
+from tools.redis_client import async_redis
+from tools.task_tracking import TASKS_INDEX_KEY, steps_key, task_key, task_timings
+
+router = APIRouter(
+    prefix="/tasks",
+    tags=["Tasks"]
+)
+
+current_user = fastapi_users.current_user()
+
+MAX_TASKS = 1000
+
+
+async def load_tasks(task_ids) -> list:
+    pipe = async_redis.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.hgetall(task_key(task_id))
+        pipe.lrange(steps_key(task_id), 0, -1)
+    values = await pipe.execute()
+
+    tasks = []
+    for task_id, task, steps in zip(task_ids, values[::2], values[1::2]):
+        if not task:
+            continue
+        tasks.append(task_timings({**task, "task_id": task_id}, [json.loads(step) for step in steps]))
+    return tasks
+
+
+def _percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def _summary(values) -> Optional[dict]:
+    if not values:
+        return None
+    return {
+        "avg": sum(values) / len(values),
+        "p95": _percentile(values, 0.95),
+        "max": max(values),
+        "total": sum(values),
+    }
+
+
+def _group(tasks, key) -> list:
+    groups = {}
+    for task in tasks:
+        if task[key] is not None:
+            groups.setdefault(task[key], []).append(task)
+    result = [
+        {
+            key: name,
+            "count": len(items),
+            "failed": sum(1 for task in items if task["state"] == "FAILURE"),
+            "wait": _summary([task["wait"] for task in items if task["wait"] is not None]),
+            "runtime": _summary([task["runtime"] for task in items if task["runtime"] is not None]),
+        }
+        for name, items in groups.items()
+    ]
+    # Сверху то, на что суммарно уходит больше всего времени
+    return sorted(result, key=lambda item: item["runtime"]["total"] if item["runtime"] else 0, reverse=True)
+
+
+@router.get("")
+async def get_tasks(
+        state: Optional[str] = None,
+        name: Optional[str] = None,
+        server: Optional[str] = None,
+        domain: Optional[str] = None,
+        limit: int = 100,
+        user: User = Depends(current_user),
+):
+    """Последние задачи: в очереди, выполняются и завершенные, с ожиданием и временем выполнения."""
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    limit = max(1, min(limit, MAX_TASKS))
+    filters = {"state": state, "server": server, "domain": domain}
+    filtered = any(value is not None for value in filters.values()) or name is not None
+
+    # С фильтром просматриваем больше задач, чтобы набрать limit подходящих
+    task_ids = await async_redis.zrevrange(TASKS_INDEX_KEY, 0, (MAX_TASKS if filtered else limit) - 1)
+    tasks = [
+        task for task in await load_tasks(task_ids)
+        if all(value is None or task[field] == value for field, value in filters.items())
+        and (name is None or task["name"].endswith(name))
+    ]
+
+    return {"status": "success", "data": tasks[:limit], "msg": None}
+
+
+@router.get("/stats")
+async def get_tasks_stats(limit: int = MAX_TASKS, user: User = Depends(current_user)):
+    """Ожидание и время выполнения по задачам, серверам и шагам за последние limit задач."""
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    limit = max(1, min(limit, MAX_TASKS))
+    task_ids = await async_redis.zrevrange(TASKS_INDEX_KEY, 0, limit - 1)
+    tasks = await load_tasks(task_ids)
+
+    steps = {}
+    for task in tasks:
+        for step in task["steps"]:
+            if step["duration"] is not None:
+                steps.setdefault((task["name"], step["step"]), []).append(step["duration"])
+    steps = sorted(
+        ({"name": name, "step": step, "count": len(values), "duration": _summary(values)}
+         for (name, step), values in steps.items()),
+        key=lambda item: item["duration"]["total"],
+        reverse=True,
+    )
+
+    return {
+        "status": "success",
+        "data": {
+            "tasks": len(tasks),
+            "by_name": _group(tasks, "name"),
+            "by_server": _group(tasks, "server"),
+            "by_step": steps,
+        },
+        "msg": None
+    }
+
+
+@router.get("/{task_id}")
+async def get_task(task_id: str, user: User = Depends(current_user)):
+    if not user.is_active:
+        raise (HTTPException(status_code=403, detail={
+            "status": "error",
+            "data": None,
+            "details": "Ваш аккаунт не активирован!"
+        }))
+
+    tasks = await load_tasks([task_id])
+    if not tasks:
+        raise (HTTPException(status_code=404, detail={
+            "status": "error",
+            "data": None,
+            "details": "Задача не найдена."
+        }))
+    task = tasks[0]
+
+    # Итог из result backend: результат или traceback ошибки
+    result = celery.AsyncResult(task_id)
+    task["result_state"] = await run_in_threadpool(lambda: result.state)
+    if task["result_state"] == "SUCCESS":
+        task["result"] = await run_in_threadpool(lambda: result.result)
+    elif task["result_state"] == "FAILURE":
+        task["traceback"] = await run_in_threadpool(lambda: result.traceback)
+
+    return {"status": "success", "data": task, "msg": None}
@@ -4,6 +4,7 @@ import re
 import string
 import csv
 import smtplib
+import tempfile
 from datetime import datetime, timedelta
 
 import requests
@@ -11,33 +12,165 @@ import urllib.request
 import paramiko
 import random
 from celery import Celery
+from celery.signals import worker_process_shutdown
 from openai import OpenAI
 from fastapi import HTTPException
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from io import StringIO
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from database import worker_session_maker
 from models import ServerStatus, Server, Domain, WhitePageStatus
-from tools.certbot import generate_lets_encrypt_cert, configure_ssl_in_apache
+from modules.domains.importer import run_domain_import, stalled_import_jobs
+from tools.artifacts import PLUGIN, THEME, ensure_artifacts, evict_unused_blobs
+from tools.cache import DOMAINS, invalidate_cache_sync
+from tools.certbot import issue_lets_encrypt_cert, allow_https_in_firewall
+from tools.cloudflare import list_active_zones, reconcile_dns_records
 from tools.config import config_read
-from tools.system_func import change_wp_status, change_server_status, add_wp_creds
+from tools.fanout import fan_out, print_progress
+from tools.golden import build_golden_site, clone_golden_site, ensure_golden_site
+from tools.ssh_async import AsyncSSH, run_async, run_in_thread
+from tools.ssh_batch import run_batch
+from tools.redis_client import redis_client
+from tools.server_slots import WAKE_INTERVAL, ServerTask, wake_all_waiting
+from tools.ssh_pool import ssh_pool
+from tools.wpcli import import_posts, inactive_plugins, install_plugin_set
+from tools.system_func import change_wp_status, change_server_status, add_wp_creds, report_progress
+import tools.task_tracking  # подключает сигналы учета задач для /tasks
 
 config = config_read("config.ini")
-celery = Celery('tasks', broker='redis://localhost:6379')
+celery = Celery(
+    'tasks',
+    broker='redis://localhost:6379',
+    backend=config.get('CELERY', 'result_backend', fallback='redis://localhost:6379/1'),
+)
+celery.conf.result_expires = config.getint('TASKS', 'ttl', fallback=7 * 24 * 3600)
+celery.conf.task_track_started = True
+# Воркер берет по одной задаче: занятый сервер не держит в резерве задачи для остальных
+celery.conf.worker_prefetch_multiplier = 1
+celery.conf.beat_schedule = {
+    "poll-ns-propagation": {
+        "task": "tasks.poll_ns_propagation",
+        "schedule": 60.0,
+    },
+    "wake-waiting-tasks": {
+        "task": "tasks.wake_waiting_tasks",
+        "schedule": WAKE_INTERVAL,
+    },
+    "resume-import-jobs": {
+        "task": "tasks.resume_import_jobs",
+        "schedule": 60.0,
+    },
+}
 
 client = OpenAI(
     api_key=config.get('OPENAI', 'apikey'),
 )
 
+# Одновременных запросов к OpenAI при генерации постов одного домена
+POSTS_CONCURRENCY = config.getint('POSTS', 'concurrency', fallback=5)
+
+
+@worker_process_shutdown.connect
+def close_ssh_pool(**kwargs):
+    ssh_pool.close_all()
+
+
+def ns_check_interval(added_at: datetime) -> int:
+    """Первый час проверяем каждую минуту, первые сутки - раз в 10 минут, дальше раз в час."""
+    age = datetime.utcnow() - added_at
+    if age < timedelta(hours=1):
+        return 60
+    if age < timedelta(hours=24):
+        return 600
+    return 3600
+
+
+def ns_check_due(domain: Domain) -> bool:
+    # Ключ живет interval секунд: пока он есть, домен не проверяем
+    interval = ns_check_interval(domain.added_at)
+    return bool(redis_client.set(f"wpg:ns:checked:{domain.domain}", 1, nx=True, ex=interval - 5))
+
 
 @celery.task
+def wake_waiting_tasks():
+    """Подстраховка для задач, ждущих слот сервера, если воркер умер, не разбудив их."""
+    wake_all_waiting()
+
+
+@celery.task
+def import_domains(job_id):
+    run_async(run_domain_import(job_id))
+
+
+@celery.task
+def resume_import_jobs():
+    """Перезапускает загрузки доменов, остановленные рестартом воркера. Загрузка продолжается с несохраненной части."""
+    for job_id in stalled_import_jobs():
+        print(f"Resuming domain import {job_id}")
+        import_domains.delay(job_id)
+
+
+@celery.task
+def poll_ns_propagation():
+    return run_async(poll_ns_propagation_async())
+
+
+async def poll_ns_propagation_async():
+    async with worker_session_maker() as session:
+        query = (
+            select(Domain)
+            .where(Domain.cf_connected == False, Domain.cf_id != None)
+            .options(joinedload(Domain.server), joinedload(Domain.cloudflare))
+        )
+        result = await session.execute(query)
+        accounts = {}
+        for domain in result.scalars().all():
+            if ns_check_due(domain):
+                accounts.setdefault(domain.cf_id, []).append(domain)
+
+        async def check_account(cf_id):
+            # Один постраничный запрос активных зон на аккаунт вместо запроса на каждый домен
+            cloudflare = accounts[cf_id][0].cloudflare
+            zones = await list_active_zones(cloudflare.email, cloudflare.api_key)
+            activated = []
+            for domain in accounts[cf_id]:
+                zone_id = zones.get(domain.domain)
+                if zone_id is None:
+                    continue
+                try:
+                    await reconcile_dns_records(zone_id, domain.domain, domain.server.ip,
+                                                cloudflare.email, cloudflare.api_key)
+                except Exception as e:
+                    print(f"Error reconciling DNS for {domain.domain}: {e}")
+                    continue
+                domain.cf_zone_id = zone_id
+                domain.cf_connected = True
+                activated.append(domain.domain)
+            return activated
+
+        result = await fan_out(accounts, check_account)
+        await session.commit()
+
+    activated = [domain for domains in result.results.values() for domain in domains]
+    if activated:
+        invalidate_cache_sync(DOMAINS)
+        print(f"NS propagated: {activated}")
+    return {**result.summary(), "activated": activated}
+
+
+@celery.task(base=ServerTask)
 def configure_server(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    password_ssh = paramiko.SSHClient()
+    ssh = None
     try:
         # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(
+        password_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        password_ssh.connect(
             hostname=server_ip,
             username=server_login,
             password=server_password,
@@ -55,19 +188,13 @@ def configure_server(server_ip, server_login, server_password, server_port):
             public_key = f.read()
 
         # Добавление публичного ключа на сервер
-        ssh.exec_command("mkdir -p ~/.ssh && chmod 700 ~/.ssh")
-        ssh.exec_command(f"echo '{public_key}' >> ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys")
+        password_ssh.exec_command("mkdir -p ~/.ssh && chmod 700 ~/.ssh")
+        password_ssh.exec_command(f"echo '{public_key}' >> ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys")
 
-        ssh.close()
+        password_ssh.close()
 
         # Проверка подключения по ключу
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
         print(f"Successfully connected to {server_ip} using SSH key.")
 
         commands = [
@@ -115,33 +242,31 @@ def configure_server(server_ip, server_login, server_password, server_port):
         ]
 
         # Установка WP-CLI
-        for command in commands:
-            print(command)
-            stdin, stdout, stderr = ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
+        for result in run_batch(ssh, commands):
+            print(result.command)
+            if result.stderr:
+                print(f"Error executing command: {result.command}. Error: {result.stderr}")
                 continue
-            print(output)
+            print(result.stdout)
 
         change_server_status(server_ip, ServerStatus.ADDED)
     except Exception as e:
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        password_ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def generate_private_key(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    password_ssh = paramiko.SSHClient()
+    ssh = None
     try:
         # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(
+        password_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        password_ssh.connect(
             hostname=server_ip,
             username=server_login,
             password=server_password,
@@ -159,19 +284,13 @@ def generate_private_key(server_ip, server_login, server_password, server_port):
             public_key = f.read()
 
         # Добавление публичного ключа на сервер
-        ssh.exec_command("mkdir -p ~/.ssh && chmod 700 ~/.ssh")
-        ssh.exec_command(f"echo '{public_key}' >> ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys")
+        password_ssh.exec_command("mkdir -p ~/.ssh && chmod 700 ~/.ssh")
+        password_ssh.exec_command(f"echo '{public_key}' >> ~/.ssh/authorized_keys && chmod 600 ~/.ssh/authorized_keys")
 
-        ssh.close()
+        password_ssh.close()
 
         # Проверка подключения по ключу
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
         print(f"Successfully connected to {server_ip} using SSH key.")
 
         change_server_status(server_ip, ServerStatus.ADDED)
@@ -179,23 +298,16 @@ def generate_private_key(server_ip, server_login, server_password, server_port):
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        password_ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def install_certbot(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
         print(f"Successfully connected to {server_ip} using SSH key.")
 
         commands = [
@@ -203,39 +315,27 @@ def install_certbot(server_ip, server_login, server_password, server_port):
             "dnf install -y certbot python3-certbot-apache --nogpgcheck"
         ]
 
-        for command in commands:
-            print(command)
-            stdin, stdout, stderr = ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
+        for result in run_batch(ssh, commands):
+            print(result.command)
+            if result.stderr:
+                print(f"Error executing command: {result.command}. Error: {result.stderr}")
                 continue
-            print(output)
+            print(result.stdout)
 
         change_server_status(server_ip, ServerStatus.ADDED)
     except Exception as e:
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def install_wpcli(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
         print(f"Successfully connected to {server_ip} using SSH key.")
 
         commands = [
@@ -245,39 +345,27 @@ def install_wpcli(server_ip, server_login, server_password, server_port):
             "mv wp-cli.phar /usr/local/bin/wp"
         ]
 
-        for command in commands:
-            print(command)
-            stdin, stdout, stderr = ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
+        for result in run_batch(ssh, commands):
+            print(result.command)
+            if result.stderr:
+                print(f"Error executing command: {result.command}. Error: {result.stderr}")
                 continue
-            print(output)
+            print(result.stdout)
 
         change_server_status(server_ip, ServerStatus.ADDED)
     except Exception as e:
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def reboot_system(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
         print(f"Successfully connected to {server_ip} using SSH key.")
 
         stdin, stdout, stderr = ssh.exec_command(f"shutdown -r")
@@ -288,23 +376,15 @@ def reboot_system(server_ip, server_login, server_password, server_port):
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def selinux_off(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
         print(f"Successfully connected to {server_ip} using SSH key.")
 
         stdin, stdout, stderr = ssh.exec_command(f"setenforce 0")
@@ -315,165 +395,92 @@ def selinux_off(server_ip, server_login, server_password, server_port):
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def delete_posts(domain, server_ip, server_login, server_password, server_port):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
-
-        stdin, stdout, stderr = ssh.exec_command(f"wp post delete "
-                                                 f"$(wp post list --post_type=post --format=ids "
-                                                 f"--path=/var/www/{domain}) "
-                                                 f"--path=/var/www/{domain} --force --allow-root")
-        stdout.channel.recv_exit_status()
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
+        run_batch(ssh, [f"wp post delete "
+                        f"$(wp post list --post_type=post --format=ids "
+                        f"--path=/var/www/{domain}) "
+                        f"--path=/var/www/{domain} --force --allow-root"])
 
         change_wp_status(domain, WhitePageStatus.DONE)
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring domain {domain}: {e}")
+        raise
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
-def install_wordpress(domain, keyword, server_ip, server_login, server_password, server_port):
-    change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
-    try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+def step_install_wordpress(ssh, domain, keyword):
+    # Эталонный сайт собирается один раз на сервер, дальше домены клонируются из него
+    ensure_golden_site(ssh)
+    report_progress(domain, "install_wordpress", "golden site ready", 1, 3)
 
-        wp_cli_path = "/usr/local/bin/wp"
-
-        db_name = db_user = domain.replace('.', '_').replace('-', '_')
-        db_password = generate_random_password()
-
-        commands = [
-            f"mysql -e 'CREATE DATABASE {db_name};'",
-            f"mysql -e 'CREATE USER \"{db_user}\"@\"localhost\" IDENTIFIED BY \"{db_password}\";'",
-            f"mysql -e 'GRANT ALL PRIVILEGES ON {db_name}.* TO \"{db_user}\"@\"localhost\";'",
-            f"mysql -e 'FLUSH PRIVILEGES;'",
-            f"""{wp_cli_path} core download --path=/var/www/{domain}""",
-            f"""{wp_cli_path} config create --dbname={db_name} --dbuser={db_user} --dbpass={db_password} --path=/var/www/{domain}""",
-        ]
+    random_title = generate_random_title(keyword)
+    random_title = random_title.replace("\"", '')
+    admin_user = generate_nickname()
+    admin_password = generate_random_password()
 
-        for command in commands:
-            print(command)
-            stdin, stdout, stderr = ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()  # Дожидаемся завершения команды
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
+    print("Создаю страницу контактов")
+    about_us_content = generate_about_us_page(domain)
+    report_progress(domain, "install_wordpress", "content generated", 2, 3)
 
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
-                continue
-            print(output)  # Логирование вывода команды, можно заменить на логгер
+    clone_golden_site(ssh, domain, random_title, admin_user, admin_password, about_us_content)
+    add_wp_creds(domain, admin_user, admin_password)
+    report_progress(domain, "install_wordpress", "site cloned", 3, 3)
 
-        set_fs_method_command = f"{wp_cli_path} config set FS_METHOD 'direct' --path=/var/www/{domain}"
-        stdin, stdout, stderr = ssh.exec_command(set_fs_method_command)
-        stdout.channel.recv_exit_status()
-        output = stdout.read().decode('utf-8')
-        error = stderr.read().decode('utf-8')
-        print(output)
-        print(error)
 
-        set_disallow_file_edit = f"{wp_cli_path} config set DISALLOW_FILE_EDIT true --raw --path=/var/www/{domain}"
-        stdin, stdout, stderr = ssh.exec_command(set_disallow_file_edit)
-        stdout.channel.recv_exit_status()
-        output = stdout.read().decode('utf-8')
-        error = stderr.read().decode('utf-8')
-        print(output)
-        print(error)
-
-        # Создание файла .htaccess
-        htaccess_content = "# BEGIN WordPress\n<IfModule mod_rewrite.c>\nRewriteEngine On\nRewriteBase /" \
-                           "\nRewriteRule ^index\\.php$ - [L]\nRewriteCond %{REQUEST_FILENAME} !-f" \
-                           "\nRewriteCond %{REQUEST_FILENAME} !-d\nRewriteRule . /index.php [L]" \
-                           "\n</IfModule>\n# END WordPress\n\n<Files wp-config.php>\norder allow,deny\ndeny from all\n" \
-                           "</Files>\n\n<Files .htaccess>\norder allow,deny\ndeny from all\n</Files>"
-
-        ssh.exec_command(f"""bash -c 'echo "{htaccess_content}" > /var/www/{domain}/.htaccess'""")
+@celery.task(base=ServerTask)
+def install_wordpress(domain, keyword, server_ip, server_login, server_password, server_port):
+    change_wp_status(domain, WhitePageStatus.CONFIGURE)
+    ssh = None
+    try:
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
-        # Установка WordPress
-        random_title = generate_random_title(keyword)
-        random_title = random_title.replace("\"", '')
-        admin_user = generate_nickname()
-        admin_password = generate_random_password()
-        add_wp_creds(domain, admin_user, admin_password)
+        step_install_wordpress(ssh, domain, keyword)
 
-        install_command = f"""{wp_cli_path} core install --url={domain} --title="{random_title}" --admin_user={admin_user} --admin_password={admin_password} --admin_email=admin@{domain} --path=/var/www/{domain}"""
-        stdin, stdout, stderr = ssh.exec_command(install_command)
-        stdout.channel.recv_exit_status()
-
-        ssh.exec_command(f'{wp_cli_path} post delete 1 --force --allow-root --path=/var/www/{domain}')
-        ssh.exec_command(f'{wp_cli_path} post delete 2 --force --allow-root --path=/var/www/{domain}')
+        # Плагины уже есть в эталонном сайте
+        print("меняю статус")
+        change_wp_status(domain, WhitePageStatus.DONE, complete_step="plugins_installed")
+    except Exception as e:
+        change_wp_status(domain, WhitePageStatus.ERROR)
+        print(f"Error configuring server {server_ip}: {e}")
+    finally:
+        ssh_pool.release(ssh)
 
-        try:
-            get_category_id_command = f"{wp_cli_path} term list category --name=Uncategorized --field=term_id --allow-root --path=/var/www/{domain}"
-            stdin, stdout, stderr = ssh.exec_command(get_category_id_command)
-            stdout.channel.recv_exit_status()
-            category_id = stdout.read().decode('utf-8').strip()
-
-            if category_id:
-                rename_category_command = f"{wp_cli_path} term update category {category_id} --name='Articles' --slug='articles' --allow-root --path=/var/www/{domain}"
-                stdin, stdout, stderr = ssh.exec_command(rename_category_command)
-                stdout.channel.recv_exit_status()
-                print(f"Category 'Uncategorized' renamed to 'Articles'.")
-            else:
-                print("Category 'Uncategorized' or 'Uncategorised' not found. ")
-        except Exception as e:
-            print(f"Error while renaming category: {e}")
 
-        print("Создаю страницу контактов")
-        about_us_content = generate_about_us_page(domain)
+@celery.task(base=ServerTask)
+def rebuild_golden_site(server_ip, server_login, server_password, server_port):
+    change_server_status(server_ip, ServerStatus.CONFIGURE)
+    ssh = None
+    try:
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
-        stdin, stdout, stderr = ssh.exec_command(f'{wp_cli_path} post create --post_type=page --post_title="About Us" --post_content="{about_us_content}" --post_status=publish --allow-root')
-        stdout.channel.recv_exit_status()
+        build_golden_site(ssh)
+        # Сборка обновляет версии в кэше, старые архивы больше не нужны
+        evict_unused_blobs(ssh)
 
-        print("меняю статус")
-        change_wp_status(domain, WhitePageStatus.DONE)
+        change_server_status(server_ip, ServerStatus.ADDED)
     except Exception as e:
-        change_wp_status(domain, WhitePageStatus.ERROR)
-        print(f"Error configuring server {server_ip}: {e}")
+        change_server_status(server_ip, ServerStatus.ERROR)
+        print(f"Error building golden site on {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def newadmin_wordpress(domain, server_ip, server_login, server_password, server_port):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
         wp_cli_path = "/usr/local/bin/wp"
 
@@ -491,24 +498,15 @@ def newadmin_wordpress(domain, server_ip, server_login, server_password, server_
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def configure_http(domain, server_ip, server_login, server_password, server_port):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
         configure_http_in_apache(ssh, domain)
 
@@ -517,24 +515,15 @@ def configure_http(domain, server_ip, server_login, server_password, server_port
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def restart_apache(server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
         # Перезапуск Apache для применения конфигурации
         stdin, stdout, stderr = ssh.exec_command("systemctl restart httpd")
@@ -555,352 +544,225 @@ def restart_apache(server_ip, server_login, server_password, server_port):
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def install_plugins(domain, server_ip, server_login, server_password, server_port):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
-
-        wp_cli_path = "/usr/local/bin/wp"
-
-        deactivate_all_plugins_command = f"{wp_cli_path} plugin deactivate --all --path=/var/www/{domain} --allow-root"
-        stdin, stdout, stderr = ssh.exec_command(deactivate_all_plugins_command)
-        stdout.channel.recv_exit_status()
-        print("Deactivate all plugins output:", stdout.read().decode('utf-8'))
-
-        # Удаление всех плагинов
-        delete_all_plugins_command = f"{wp_cli_path} plugin delete --all --path=/var/www/{domain} --allow-root"
-        stdin, stdout, stderr = ssh.exec_command(delete_all_plugins_command)
-        stdout.channel.recv_exit_status()
-        print("Delete all plugins output:", stdout.read().decode('utf-8'))
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
         # Установка необходимых плагинов
         plugins = ['wp-smushit', 'wordpress-seo', 'cookie-notice', 'contact-form-7',
                    'jetpack', 'wp-simple-firewall']
-        for plugin in plugins:
-            try:
-                install_plugin_command = f"{wp_cli_path} plugin install {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(install_plugin_command)
-                stdout.channel.recv_exit_status()
-                install_output = stdout.read().decode('utf-8')
-                print(f"Plugin install output for {plugin}:", install_output)
-
-                # Активация плагина
-                activate_plugin_command = f"{wp_cli_path} plugin activate {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(activate_plugin_command)
-                stdout.channel.recv_exit_status()
-                activate_output = stdout.read().decode('utf-8')
-                print(f"Plugin activation output for {plugin}:", activate_output)
-
-                # Проверка активации плагина
-                check_activation_command = f"{wp_cli_path} plugin is-active {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(check_activation_command)
-                stdout.channel.recv_exit_status()
-                is_active = stdout.read().decode('utf-8').strip()
-
-                if "active" not in is_active:
-                    print(f"{plugin} is not active, reactivating...")
-                    stdin, stdout, stderr = ssh.exec_command(activate_plugin_command)
-                    stdout.channel.recv_exit_status()
-                    print(f"Reactivation output for {plugin}:", stdout.read().decode('utf-8'))
-
-                init_plugins = """
-                        wp eval "do_action('init'); do_action('wp_loaded');"
-                        """
-                stdin, stdout, stderr = ssh.exec_command(init_plugins)
-                stdout.channel.recv_exit_status()
-
-            except:
-                print(f"Plugin not activated {plugin}")
-                continue
+        artifacts = ensure_artifacts(ssh, [(PLUGIN, plugin) for plugin in plugins])
+        report_progress(domain, "install_plugins", "plugins downloaded")
+        statuses = install_plugin_set(ssh, f"/var/www/{domain}", artifacts, replace=True)
+        print(f"Plugins on {domain}: {statuses}")
+        for number, plugin in enumerate(plugins, start=1):
+            state = statuses.get(plugin, {}).get("status", "missing")
+            report_progress(domain, "install_plugins", f"plugin {plugin} {state}", number, len(plugins))
+        for plugin in inactive_plugins(statuses):
+            print(f"Plugin not activated {plugin}")
 
         change_wp_status(domain, WhitePageStatus.DONE, complete_step="plugins_installed")
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+@celery.task(base=ServerTask)
 def multi_install_plugin(domains, plugin, server_ip, server_login, server_password, server_port):
-    ssh = paramiko.SSHClient()
-    try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+    result = run_async(multi_install_plugin_async(domains, plugin, server_ip, server_login, server_port))
+    return result.summary()
 
-        wp_cli_path = "/usr/local/bin/wp"
 
-        for domain in domains:
-            change_wp_status(domain, WhitePageStatus.CONFIGURE)
-            try:
-                install_plugin_command = f"{wp_cli_path} plugin install {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(install_plugin_command)
-                stdout.channel.recv_exit_status()
-                install_output = stdout.read().decode('utf-8')
-                print(f"Plugin install output for {plugin}:", install_output)
-
-                # Активация плагина
-                activate_plugin_command = f"{wp_cli_path} plugin activate {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(activate_plugin_command)
-                stdout.channel.recv_exit_status()
-                activate_output = stdout.read().decode('utf-8')
-                print(f"Plugin activation output for {plugin}:", activate_output)
-
-                # Проверка активации плагина
-                check_activation_command = f"{wp_cli_path} plugin is-active {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(check_activation_command)
-                stdout.channel.recv_exit_status()
-                is_active = stdout.read().decode('utf-8').strip()
-
-                if "active" not in is_active:
-                    print(f"{plugin} is not active, reactivating...")
-                    stdin, stdout, stderr = ssh.exec_command(activate_plugin_command)
-                    stdout.channel.recv_exit_status()
-                    print(f"Reactivation output for {plugin}:", stdout.read().decode('utf-8'))
-
-                init_plugins = """
-                                        wp eval "do_action('init'); do_action('wp_loaded');"
-                                        """
-                stdin, stdout, stderr = ssh.exec_command(init_plugins)
-                stdout.channel.recv_exit_status()
-
-            except:
-                print(f"Plugin not installed {plugin}")
-                change_wp_status(domain, WhitePageStatus.ERROR)
-                continue
+async def multi_install_plugin_async(domains, plugin, server_ip, server_login, server_port):
+    # Архив скачивается на сервер один раз, дальше все домены ставят его локально
+    async with AsyncSSH(server_ip, server_login, server_port) as ssh:
+        plugin_source = (await ssh.call(ensure_artifacts, [(PLUGIN, plugin)]))[plugin]
 
-            change_wp_status(domain, WhitePageStatus.DONE)
-    except Exception as e:
+    async def install(domain):
+        await run_in_thread(change_wp_status, domain, WhitePageStatus.CONFIGURE)
+        try:
+            async with AsyncSSH(server_ip, server_login, server_port) as ssh:
+                statuses = await ssh.call(install_plugin_set, f"/var/www/{domain}", {plugin: plugin_source})
+                print(f"Plugin {plugin} on {domain}: {statuses[plugin]}")
+                if inactive_plugins(statuses):
+                    raise Exception(f"{plugin} is {statuses[plugin]['status']}")
+                await run_in_thread(report_progress, domain, "install_plugin", f"plugin {plugin} installed")
+        except Exception:
+            print(f"Plugin not installed {plugin}")
+            await run_in_thread(change_wp_status, domain, WhitePageStatus.ERROR)
+            raise
 
-        print(f"Error configuring server {server_ip}: {e}")
-    finally:
-        ssh.close()
+        await run_in_thread(change_wp_status, domain, WhitePageStatus.DONE)
 
+    result = await fan_out(domains, install, on_progress=print_progress)
+    print(f"Plugin {plugin} on {server_ip}: {result.summary()}")
+    return result
 
-@celery.task
+
+@celery.task(base=ServerTask)
 def multi_delete_plugin(domains, plugin, server_ip, server_login, server_password, server_port):
+    result = run_async(multi_delete_plugin_async(domains, plugin, server_ip, server_login, server_port))
+    return result.summary()
 
-    ssh = paramiko.SSHClient()
-    try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
 
-        wp_cli_path = "/usr/local/bin/wp"
+async def multi_delete_plugin_async(domains, plugin, server_ip, server_login, server_port):
+    wp_cli_path = "/usr/local/bin/wp"
 
-        for domain in domains:
-            change_wp_status(domain, WhitePageStatus.CONFIGURE)
-            try:
+    async def remove(domain):
+        await run_in_thread(change_wp_status, domain, WhitePageStatus.CONFIGURE)
+        try:
+            async with AsyncSSH(server_ip, server_login, server_port) as ssh:
                 deactivate_plugin_command = f"{wp_cli_path} plugin deactivate {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(deactivate_plugin_command)
-                stdout.channel.recv_exit_status()
-                install_output = stdout.read().decode('utf-8')
-                print(f"Plugin deactivate output for {plugin}:", install_output)
+                deactivate_output = (await ssh.exec(deactivate_plugin_command)).stdout
+                print(f"Plugin deactivate output for {plugin}:", deactivate_output)
 
                 delete_plugin_command = f"{wp_cli_path} plugin delete {plugin} --path=/var/www/{domain} --allow-root"
-                stdin, stdout, stderr = ssh.exec_command(delete_plugin_command)
-                stdout.channel.recv_exit_status()
-                activate_output = stdout.read().decode('utf-8')
-                print(f"Plugin delete output for {plugin}:", activate_output)
-
-            except:
-                print(f"Plugin not removed {plugin}")
-                change_wp_status(domain, WhitePageStatus.ERROR)
-                continue
+                delete_output = (await ssh.exec(delete_plugin_command)).stdout
+                print(f"Plugin delete output for {plugin}:", delete_output)
+        except Exception:
+            print(f"Plugin not removed {plugin}")
+            await run_in_thread(change_wp_status, domain, WhitePageStatus.ERROR)
+            raise
 
-            change_wp_status(domain, WhitePageStatus.DONE)
-    except Exception as e:
+        await run_in_thread(change_wp_status, domain, WhitePageStatus.DONE)
 
-        print(f"Error configuring server {server_ip}: {e}")
-    finally:
-        ssh.close()
+    result = await fan_out(domains, remove, on_progress=print_progress)
+    print(f"Plugin {plugin} removal on {server_ip}: {result.summary()}")
+    return result
 
 
-@celery.task
+def step_change_theme(ssh, domain, theme_slug):
+    wp_cli_path = "/usr/local/bin/wp"
+
+    # Установка выбранной темы
+    theme_source = ensure_artifacts(ssh, [(THEME, theme_slug)])[theme_slug]
+    install_theme_command = f"{wp_cli_path} theme install {theme_source} --activate --path=/var/www/{domain} --allow-root"
+    stdin, stdout, stderr = ssh.exec_command(install_theme_command)
+    if stdout.channel.recv_exit_status() != 0:
+        raise Exception(f"Theme {theme_slug} not installed: {stderr.read().decode('utf-8').strip()}")
+
+
+@celery.task(base=ServerTask, idempotency_args=("domain",))
 def change_theme(domain, theme_slug, server_ip, server_login, server_password, server_port):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
-        wp_cli_path = "/usr/local/bin/wp"
-
-        # Установка выбранной темы
-        install_theme_command = f"{wp_cli_path} theme install {theme_slug} --activate --path=/var/www/{domain} --allow-root"
-        stdin, stdout, stderr = ssh.exec_command(install_theme_command)
-        stdout.channel.recv_exit_status()
-        print(stdout, stderr)
+        step_change_theme(ssh, domain, theme_slug)
 
         change_wp_status(domain, WhitePageStatus.DONE, complete_step="theme_changed")
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+async def generate_posts_async(domain, keyword, posts_count, local_dir):
+    """Текст и картинки для всех постов параллельно, не больше POSTS_CONCURRENCY запросов к API одновременно."""
+    async def generate(number):
+        post_title, post_content, image_url = await run_in_thread(generate_post_content, keyword)
+
+        image_path = os.path.join(local_dir, f"{keyword}_{number}_{random.randint(1, 99999)}.jpg")
+        try:
+            await run_in_thread(urllib.request.urlretrieve, image_url, image_path)  # Скачиваем изображение
+        except Exception as e:
+            # Пост все равно публикуем, только без миниатюры
+            print(f"Error downloading image for post {number}: {e}")
+            image_path = None
+
+        return {
+            "title": post_title.replace("\"", '').replace("\'", ''),
+            "content": post_content,
+            "image": image_path,
+        }
+
+    def on_progress(result, number):
+        state = "failed" if number in result.errors else "generated"
+        report_progress(domain, "create_posts", f"post {result.finished}/{result.total} {state}",
+                        result.finished, result.total)
+
+    return await fan_out(range(1, posts_count + 1), generate, per_server=POSTS_CONCURRENCY, on_progress=on_progress)
+
+
+def step_create_posts(ssh, domain, keyword, posts_count):
+    # Генерация почти целиком - ожидание API, поэтому идет параллельно, а на сервер все уходит одной пачкой
+    with tempfile.TemporaryDirectory(prefix="wpg-posts-") as local_dir:
+        generated = run_async(generate_posts_async(domain, keyword, posts_count, local_dir))
+        for number, error in generated.errors.items():
+            print(f"Error while generating post {number}: {error}")
+
+        base_date = datetime.now()
+        posts = []
+        for number in sorted(generated.results):
+            base_date = generate_random_date(base_date, 5)
+            posts.append({**generated.results[number], "date": base_date.strftime('%Y-%m-%d %H:%M:%S')})
+
+        if not posts:
+            raise Exception("No posts generated.")
+
+        results = import_posts(ssh, f"/var/www/{domain}", posts)
+
+    created = 0
+    for result in results:
+        if result["post_id"]:
+            created += 1
+            print(f"Post titled '{result['title']}' created successfully with image ID {result['attachment_id']}.")
+        else:
+            print(f"Failed to create post for '{result['title']}'.")
+        if result["error"]:
+            print(f"Error from wp-cli: {result['error']}")
+
+    report_progress(domain, "create_posts", f"{created}/{posts_count} posts created", created, posts_count)
+    if not created:
+        raise Exception("No posts created.")
+
+
+@celery.task(base=ServerTask)
 def create_posts(domain, keyword, posts_count, server_ip, server_login, server_password, server_port):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
-
-        wp_cli_path = "/usr/local/bin/wp"
-        base_date = datetime.now()
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
-        for _ in range(posts_count):
-            try:
-                post_title, post_content, image_url = generate_post_content(keyword)
-                post_title = post_title.replace("\"", '').replace("\'", '')
-                post_content = post_content.replace("\"", "\'")
-
-                image_name = f"{keyword}_{random.randint(1,99999)}.jpg"
-
-                # Загрузка изображения в WordPress
-                local_image_path = f"/tmp/{image_name}"  # Локальный путь для сохранения изображения
-                urllib.request.urlretrieve(image_url, local_image_path)  # Скачиваем изображение
-
-                # Загружаем изображение на сервер через SSH
-                sftp = ssh.open_sftp()
-                remote_image_path = f"/var/www/{domain}/wp-content/uploads/{image_name}"
-                sftp.put(local_image_path, remote_image_path)
-                sftp.close()
-
-                # Добавление изображения в WordPress
-                upload_image_command = (
-                    f'{wp_cli_path} media import "{remote_image_path}" --path=/var/www/{domain} --porcelain --allow-root'
-                )
-                stdin, stdout, stderr = ssh.exec_command(upload_image_command)
-                stdout.channel.recv_exit_status()
-                attachment_id = stdout.read().decode('utf-8').strip()  # Получаем ID изображения
-
-                base_date = post_date = generate_random_date(base_date, 5)
-                post_date = post_date.strftime('%Y-%m-%d %H:%M:%S')
-
-                # Публикация поста без миниатюры
-                create_post_command = (
-                    f'{wp_cli_path} post create '
-                    f'--post_title="{post_title}" '
-                    f'--post_content="{post_content}" '
-                    f'--post_status=publish '
-                    f'--post_type=post '
-                    f'--path=/var/www/{domain} '
-                    f'--post_date="{post_date}" '
-                    f'--porcelain --allow-root'
-                )
-                stdin, stdout, stderr = ssh.exec_command(create_post_command)
-                stdout.channel.recv_exit_status()
-                error_message = stderr.read().decode('utf-8').strip()
-                if error_message:
-                    print(f"Error from wp-cli: {error_message}")
-
-                post_id = stdout.read().decode('utf-8').strip()  # Получаем ID поста
-                print(post_id)
-
-                if post_id.isdigit():
-                    # Установка миниатюры (featured image) для поста
-                    set_thumbnail_command = (
-                        f'{wp_cli_path} post meta set {post_id} _thumbnail_id {attachment_id} --path=/var/www/{domain} --allow-root'
-                    )
-                    ssh.exec_command(set_thumbnail_command)
-                    print(f"Post titled '{post_title}' created successfully with image ID {attachment_id}.")
-                else:
-                    print(f"Failed to create post for '{post_title}'.")
-            except Exception as e:
-                print(f"Error while creating post: {e}")
-                continue
+        step_create_posts(ssh, domain, keyword, posts_count)
 
         change_wp_status(domain, WhitePageStatus.DONE, complete_step="posts_created")
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
-def add_form(domain, keyword, server_ip, server_login, server_password, server_port):
-    change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
-    try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
-
-        wp_cli_path = "/usr/local/bin/wp"
+def step_add_form(ssh, domain, keyword):
+    wp_cli_path = "/usr/local/bin/wp"
 
-        # Получаем текущий активный файл functions.php
-        get_functions_php_path = (
-            f'{wp_cli_path} eval "echo get_template_directory() . \'/functions.php\';" --path=/var/www/{domain} --allow-root'
-        )
-        stdin, stdout, stderr = ssh.exec_command(get_functions_php_path)
-        stdout.channel.recv_exit_status()
-        functions_php_path = stdout.read().decode('utf-8').strip()
+    # Получаем текущий активный файл functions.php
+    get_functions_php_path = (
+        f'{wp_cli_path} eval "echo get_template_directory() . \'/functions.php\';" --path=/var/www/{domain} --allow-root'
+    )
+    stdin, stdout, stderr = ssh.exec_command(get_functions_php_path)
+    stdout.channel.recv_exit_status()
+    functions_php_path = stdout.read().decode('utf-8').strip()
 
-        if not functions_php_path:
-            print("Error: Could not retrieve the functions.php path.")
-            return
+    if not functions_php_path:
+        raise Exception("Could not retrieve the functions.php path.")
 
-        form_title = generate_random_title(keyword)
-        form_title = form_title.replace("\"", '')
+    form_title = generate_random_title(keyword)
+    form_title = form_title.replace("\"", '')
 
-        # Код для добавления в functions.php
-        functions_php_code = f"""
+    # Код для добавления в functions.php
+    functions_php_code = f"""
 function add_contact_form_to_content($content) {{
     $args = array(
         'post_type'      => 'wpcf7_contact_form',
@@ -938,85 +800,110 @@ function add_contact_form_to_content($content) {{
 add_filter('the_content', 'add_contact_form_to_content');
                     """
 
-        add_code_to_functions_php(ssh, functions_php_path, functions_php_code)
+    add_code_to_functions_php(ssh, functions_php_path, functions_php_code)
+
+
+@celery.task(base=ServerTask)
+def add_form(domain, keyword, server_ip, server_login, server_password, server_port):
+    change_wp_status(domain, WhitePageStatus.CONFIGURE)
+    ssh = None
+    try:
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
+
+        step_add_form(ssh, domain, keyword)
 
         change_wp_status(domain, WhitePageStatus.DONE, complete_step="form_added")
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
-def delete_domain(domain, server_ip, server_login, server_password, server_port):
-    change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
-    try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+def remove_site_files(ssh, domain):
+    db_name = db_user = db_password = domain.replace('.', '_').replace('-', '_')
+    commands = [
+        f"rm -rf /var/www/{domain} 2>&1",
+        f"rm /etc/httpd/conf.d/{domain}.conf 2>&1",
+        f"""mysql -e "DELETE FROM mysql.user WHERE User={db_user};" """,
+        f"""mysql -e "DROP DATABASE {db_name};" """,
+        "systemctl restart httpd >/dev/null 2>&1",
+    ]
 
-        db_name = db_user = db_password = domain.replace('.', '_').replace('-', '_')
-        commands = [
-            f"rm -rf /var/www/{domain} 2>&1",
-            f"rm /etc/httpd/conf.d/{domain}.conf 2>&1",
-            f"""mysql -e "DELETE FROM mysql.user WHERE User={db_user};" """,
-            f"""mysql -e "DROP DATABASE {db_name};" """,
-            "systemctl restart httpd >/dev/null 2>&1",
-        ]
+    # Выполнение команд на сервере
+    for result in run_batch(ssh, commands):
+        print(result.command)
+        if result.stderr:
+            print(f"Error executing command: {result.command}. Error: {result.stderr}")
+            continue
+        print(result.stdout)  # Логирование вывода команды, можно заменить на логгер
 
-        # Выполнение команд на сервере
-        for command in commands:
-            print(command)
-            stdin, stdout, stderr = ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()  # Дожидаемся завершения команды
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
-                continue
-            print(output)  # Логирование вывода команды, можно заменить на логгер
 
+@celery.task(base=ServerTask)
+def delete_domain(domain, server_ip, server_login, server_password, server_port):
+    change_wp_status(domain, WhitePageStatus.CONFIGURE)
+    ssh = None
+    try:
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
+        remove_site_files(ssh, domain)
         change_wp_status(domain, WhitePageStatus.ADDED)
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error deleting {domain}: {e}")
+        raise
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
-@celery.task
+async def delete_domain_async(domain, server_ip, server_login, server_port):
+    await run_in_thread(change_wp_status, domain, WhitePageStatus.CONFIGURE)
+    try:
+        async with AsyncSSH(server_ip, server_login, server_port) as ssh:
+            await ssh.call(remove_site_files, domain)
+
+        await run_in_thread(change_wp_status, domain, WhitePageStatus.ADDED)
+    except Exception as e:
+        await run_in_thread(change_wp_status, domain, WhitePageStatus.ERROR)
+        print(f"Error deleting {domain}: {e}")
+        # fan_out должен засчитать домен как failed
+        raise
+
+
+@celery.task(base=ServerTask)
+def delete_domains(domains, server_ip, server_login, server_password, server_port):
+    result = run_async(fan_out(
+        domains,
+        lambda domain: delete_domain_async(domain, server_ip, server_login, server_port),
+        on_progress=print_progress
+    ))
+    return result.summary()
+
+
+@celery.task(base=ServerTask)
 def create_certs(domains, server_ip, server_login, server_password, server_port):
     change_server_status(server_ip, ServerStatus.CONFIGURE)
-    ssh = paramiko.SSHClient()
+    ssh = None
     try:
-        # Подключение по SSH
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{server_ip}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        ssh.connect(
-            hostname=server_ip,
-            username=server_login,
-            pkey=ssh_key,
-            port=server_port
-        )
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
+
+        # Certbot держит глобальную блокировку, поэтому сертификаты выпускаются по одному
+        failed = []
+        for domain in domains:
+            try:
+                issue_lets_encrypt_cert(ssh, domain, domains[0])
+            except Exception as e:
+                print(f"Error issuing certificate for {domain}: {e}")
+                failed.append(domain)
 
-        generate_lets_encrypt_cert(ssh, domains)
+        allow_https_in_firewall(ssh)
 
-        change_server_status(server_ip, ServerStatus.ADDED)
+        print(f"Certificates on {server_ip}: {len(domains) - len(failed)} done, {len(failed)} failed")
+        change_server_status(server_ip, ServerStatus.ERROR if failed else ServerStatus.ADDED)
     except Exception as e:
         change_server_status(server_ip, ServerStatus.ERROR)
         print(f"Error configuring server {server_ip}: {e}")
     finally:
-        ssh.close()
+        ssh_pool.release(ssh)
 
 
 def add_code_to_functions_php(ssh, functions_php_path, code):
@@ -1191,6 +1078,7 @@ def configure_http_in_apache(ssh, domain):
 
     except Exception as e:
         print(f"Failed to write HTTP configuration: {e}")
+        raise
 
 
 @celery.task
@@ -1264,7 +1152,7 @@ def extract_db_credentials(wp_config_content):
         raise ValueError("Не удалось извлечь учетные данные из wp-config.php.")
 
 
-@celery.task
+@celery.task(base=ServerTask, server_arg="source_server")
 def transfer_wordpress_site(
         domain,
         source_server,
@@ -1277,21 +1165,10 @@ def transfer_wordpress_site(
         dest_ssh_port
 ):
     change_wp_status(domain, WhitePageStatus.CONFIGURE)
-    source_ssh = paramiko.SSHClient()
+    source_ssh = None
     try:
-        # Подключение по SSH
-        source_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{source_server}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        source_ssh.connect(
-            hostname=source_server,
-            username=source_ssh_user,
-            pkey=ssh_key,
-            port=source_ssh_port
-        )
+        source_ssh = ssh_pool.acquire(source_server, source_ssh_user, source_ssh_port)
 
-        stdin, stdout, stderr = source_ssh.exec_command(f"cd /var/www/ && tar -czvf {domain}.tar.gz {domain}")
-        stdout.channel.recv_exit_status()
         domain_archive = f"/var/www/{domain}.tar.gz"
 
         # Извлекаем данные из wp-config.php
@@ -1301,101 +1178,67 @@ def transfer_wordpress_site(
         wp_config_content = wp_config_file.read().decode()
         print(wp_config_content)
         wp_config_file.close()
+        sftp.close()
 
         db_name, db_user, db_password = extract_db_credentials(wp_config_content)
+        report_progress(domain, "transfer_wordpress_site", "database credentials read", 1, 4)
 
-        # Экспортируем базу данных
         db_backup_file = f"/root/{db_name}.sql"
-        stdin, stdout, stderr = source_ssh.exec_command(f"mysqldump {db_name} > {db_backup_file}")
-        stdout.channel.recv_exit_status()
-
-        # Копируем конфигурационный файл Apache
         apache_config_file = f"/etc/httpd/conf.d/{domain}.conf"
 
-        stdin, stdout, stderr = source_ssh.exec_command("dnf install sshpass -y")
-        stdout.channel.recv_exit_status()
-
-        stdin, stdout, stderr = source_ssh.exec_command(
+        # Архив сайта, дамп базы и копирование на новый сервер одним скриптом
+        commands = [
+            f"cd /var/www/ && tar -czvf {domain}.tar.gz {domain}",
+            f"mysqldump {db_name} > {db_backup_file}",
+            "dnf install sshpass -y",
             f"sshpass -p '{dest_ssh_pass}' "
             f"scp -o StrictHostKeyChecking=no "
             f"{domain_archive} "
             f"{db_backup_file} "
             f"{apache_config_file} "
-            f"{dest_ssh_user}@{dest_server}:/tmp/"
-        )
-        stdout.channel.recv_exit_status()
+            f"{dest_ssh_user}@{dest_server}:/tmp/",
+        ]
 
-        # Закрываем соединение с исходным сервером
-        source_ssh.close()
+        for result in run_batch(source_ssh, commands):
+            if not result.ok:
+                # Команду не печатаем - в ней пароль от конечного сервера
+                print(f"Error executing command on {source_server}. Error: {result.stderr}")
+        report_progress(domain, "transfer_wordpress_site", "archive copied to destination", 2, 4)
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error transfer {domain}: {e}")
         raise
+    finally:
+        ssh_pool.release(source_ssh)
 
-    dest_ssh = paramiko.SSHClient()
+    dest_ssh = None
     try:
-        # Подключение по SSH
-        dest_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        private_key_path = f"/home/maksim/.ssh/id_rsa_{dest_server}"
-        ssh_key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        dest_ssh.connect(
-            hostname=dest_server,
-            username=dest_ssh_user,
-            pkey=ssh_key,
-            port=dest_ssh_port
-        )
-
-        stdin, stdout, stderr = dest_ssh.exec_command(f"cd /var/www && tar -xzvf /tmp/{domain}.tar.gz")
-        stdout.channel.recv_exit_status()
+        dest_ssh = ssh_pool.acquire(dest_server, dest_ssh_user, dest_ssh_port)
 
-        sql_commands = [
+        commands = [
+            f"cd /var/www && tar -xzvf /tmp/{domain}.tar.gz",
             f"""mysql -e "CREATE DATABASE {db_name};" """,
             f"""mysql -e "CREATE USER '{db_user}'@'localhost' IDENTIFIED BY '{db_password}';" """,
             f"""mysql -e "GRANT ALL PRIVILEGES ON {db_name}.* TO '{db_user}'@'localhost';" """,
             f"""mysql -e "FLUSH PRIVILEGES;" """,
-            f"mysql {db_name} < /tmp/{db_name}.sql"
-        ]
-
-        for command in sql_commands:
-            print(command)
-            stdin, stdout, stderr = dest_ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
-                continue
-            print(output)
-
-
-
-        stdin, stdout, stderr = dest_ssh.exec_command(f"cp /tmp/{domain}.conf /etc/httpd/conf.d/" )
-        stdout.channel.recv_exit_status()
-
-        stdin, stdout, stderr = dest_ssh.exec_command(f"systemctl restart httpd.service")
-        stdout.channel.recv_exit_status()
-
-        commands = [
+            f"mysql {db_name} < /tmp/{db_name}.sql",
+            f"cp /tmp/{domain}.conf /etc/httpd/conf.d/",
+            "systemctl restart httpd.service",
             "dnf install -y epel-release --nogpgcheck",
             "dnf install -y certbot python3-certbot-apache --nogpgcheck",
             "dnf install mod_ssl -y",
             "firewall-cmd --permanent --add-service=https",
             "firewall-cmd --reload",
+            f"certbot certonly --apache --non-interactive --agree-tos --email admin@{domain} -d {domain}",
         ]
 
-        for command in commands:
-            print(command)
-            stdin, stdout, stderr = dest_ssh.exec_command(f"{command}")
-            stdout.channel.recv_exit_status()
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            if error:
-                print(f"Error executing command: {command}. Error: {error}")
+        for result in run_batch(dest_ssh, commands):
+            print(result.command)
+            if result.stderr:
+                print(f"Error executing command: {result.command}. Error: {result.stderr}")
                 continue
-            print(output)
-
-        stdin, stdout, stderr = dest_ssh.exec_command(f"certbot certonly --apache --non-interactive --agree-tos --email admin@{domain} -d {domain}")
-        stdout.channel.recv_exit_status()
+            print(result.stdout)
+        report_progress(domain, "transfer_wordpress_site", "site restored", 3, 4)
 
         ssl_conf = f"""
 <VirtualHost *:443>
@@ -1424,12 +1267,63 @@ def transfer_wordpress_site(
         # Перезапускаем HTTP сервер в последний раз
         stdin, stdout, stderr = dest_ssh.exec_command(f"systemctl restart httpd.service")
         stdout.channel.recv_exit_status()
+        report_progress(domain, "transfer_wordpress_site", "ssl configured", 4, 4)
 
-        # Закрываем соединение
-        dest_ssh.close()
         change_wp_status(domain, WhitePageStatus.DONE)
     except Exception as e:
         change_wp_status(domain, WhitePageStatus.ERROR)
         print(f"Error transfer {domain}: {e}")
         raise
+    finally:
+        ssh_pool.release(dest_ssh)
+
+
+
+# Сборка сайта целиком: (шаг, флаг Domain для чекпоинта, функция шага), по порядку.
+# WordPress клонируется из эталонного сайта вместе с плагинами, поэтому его чекпоинт - plugins_installed.
+# У HTTP конфига своего флага нет, он просто перезаписывается при каждом запуске.
+SITE_PIPELINE = [
+    ("install_wordpress", "plugins_installed",
+     lambda ssh, domain, params: step_install_wordpress(ssh, domain, params["keyword"])),
+    ("configure_http", None,
+     lambda ssh, domain, params: configure_http_in_apache(ssh, domain)),
+    ("change_theme", "theme_changed",
+     lambda ssh, domain, params: step_change_theme(ssh, domain, params["theme_slug"])),
+    ("create_posts", "posts_created",
+     lambda ssh, domain, params: step_create_posts(ssh, domain, params["keyword"], params["posts_count"])),
+    ("add_form", "form_added",
+     lambda ssh, domain, params: step_add_form(ssh, domain, params["keyword"])),
+]
+
+
+@celery.task(base=ServerTask, bind=True, idempotency_args=("domain",), max_retries=config.getint('PIPELINE', 'max_retries', fallback=3),
+             default_retry_delay=config.getint('PIPELINE', 'retry_delay', fallback=60))
+def build_site(self, domain, params, completed, server_ip, server_login, server_password, server_port):
+    """
+    Все шаги SITE_PIPELINE на одном SSH соединении из пула.
+    completed - флаги уже выполненных шагов, при повторе задача продолжает с первого невыполненного.
+    """
+    completed = list(completed)
+    change_wp_status(domain, WhitePageStatus.CONFIGURE)
+    ssh = None
+    try:
+        ssh = ssh_pool.acquire(server_ip, server_login, server_port)
 
+        for number, (name, checkpoint, step) in enumerate(SITE_PIPELINE, start=1):
+            if checkpoint is not None and checkpoint in completed:
+                continue
+            report_progress(domain, "build_site", f"{name} started", number, len(SITE_PIPELINE))
+            step(ssh, domain, params)
+            if checkpoint is not None:
+                completed.append(checkpoint)
+                change_wp_status(domain, WhitePageStatus.CONFIGURE, complete_step=checkpoint)
+
+        change_wp_status(domain, WhitePageStatus.DONE)
+    except Exception as e:
+        print(f"Error building site {domain} on {server_ip}: {e}")
+        if self.request.retries >= self.max_retries:
+            change_wp_status(domain, WhitePageStatus.ERROR)
+            raise
+        raise self.retry(exc=e, args=(domain, params, completed, server_ip, server_login, server_password, server_port))
+    finally:
+        ssh_pool.release(ssh)
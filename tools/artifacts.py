@@ -0,0 +1,132 @@
+import shlex
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import requests
+
+from tools.config import config_read
+from tools.ssh_batch import run_batch
+
+config = config_read("config.ini")
+
+# Кэш архивов на управляемом сервере:
+#   blobs/<sha256>.<ext>               - содержимое, адресуемое по хэшу
+#   <kind>/<slug>/<version>.<ext>      - ссылка на blob для конкретной версии
+ARTIFACT_ROOT = "/opt/wpg/artifacts"
+RESOLVE_TTL = config.getint('ARTIFACTS', 'resolve_ttl', fallback=3600)
+
+CORE = "core"
+PLUGIN = "plugin"
+THEME = "theme"
+
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+
+def _pinned_version(kind, slug):
+    # В config.ini: [ARTIFACTS] plugin.jetpack = 13.1, core = 6.5.3
+    option = kind if kind == CORE else f"{kind}.{slug}"
+    return config.get('ARTIFACTS', option, fallback=None)
+
+
+def _resolve_remote(kind, slug):
+    pinned = _pinned_version(kind, slug)
+
+    if kind == CORE:
+        if pinned is None:
+            data = requests.get("https://api.wordpress.org/core/version-check/1.7/", timeout=15).json()
+            pinned = data["offers"][0]["current"]
+        return pinned, f"https://wordpress.org/wordpress-{pinned}.tar.gz", "tar.gz"
+
+    if pinned is not None:
+        return pinned, f"https://downloads.wordpress.org/{kind}/{slug}.{pinned}.zip", "zip"
+
+    action = "plugin_information" if kind == PLUGIN else "theme_information"
+    response = requests.get(
+        f"https://api.wordpress.org/{kind}s/info/1.2/",
+        params={"action": action, "request[slug]": slug},
+        timeout=15
+    )
+    data = response.json()
+    if response.status_code != 200 or "version" not in data:
+        raise Exception(f"Unknown {kind} {slug}: {data}")
+    return data["version"], data["download_link"], "zip"
+
+
+def resolve_artifact(kind: str, slug: str) -> Tuple[str, str, str]:
+    """Возвращает (version, url, ext). Результат кэшируется в процессе на RESOLVE_TTL секунд."""
+    key = (kind, slug)
+    with _resolved_lock:
+        cached = _resolved.get(key)
+        if cached is not None and time.monotonic() - cached[0] < RESOLVE_TTL:
+            return cached[1]
+
+    resolved = _resolve_remote(kind, slug)
+    with _resolved_lock:
+        _resolved[key] = (time.monotonic(), resolved)
+    return resolved
+
+
+def artifact_path(kind: str, slug: str, version: str, ext: str) -> str:
+    return f"{ARTIFACT_ROOT}/{kind}/{slug}/{version}.{ext}"
+
+
+def _ensure_command(kind, slug, version, url, ext):
+    link = artifact_path(kind, slug, version, ext)
+    link_dir = f"{ARTIFACT_ROOT}/{kind}/{slug}"
+    return (
+        f"mkdir -p {ARTIFACT_ROOT}/blobs {ARTIFACT_ROOT}/tmp {link_dir} && "
+        f"if [ ! -e {link} ]; then "
+        f"tmp=$(mktemp -p {ARTIFACT_ROOT}/tmp) && "
+        f"curl -fsSL -o \"$tmp\" {shlex.quote(url)} && "
+        f"sum=$(sha256sum \"$tmp\" | cut -d' ' -f1) && "
+        f"mv \"$tmp\" {ARTIFACT_ROOT}/blobs/$sum.{ext} && "
+        f"ln -sfn {ARTIFACT_ROOT}/blobs/$sum.{ext} {link}; "
+        f"fi && "
+        # Старые версии этого артефакта больше не нужны
+        f"find {link_dir} -mindepth 1 -maxdepth 1 ! -name '{version}.{ext}' -delete"
+    )
+
+
+def ensure_artifacts(ssh, artifacts: List[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    Скачивает недостающие архивы в кэш сервера одним скриптом.
+    Возвращает {slug: локальный путь}. Если версию определить не удалось - {slug: slug},
+    тогда wp-cli скачает архив сам.
+    """
+    paths = {}
+    commands = []
+    pending = []
+    for kind, slug in artifacts:
+        try:
+            version, url, ext = resolve_artifact(kind, slug)
+        except Exception as e:
+            print(f"Failed to resolve {kind} {slug}: {e}")
+            paths[slug] = slug
+            continue
+        commands.append(_ensure_command(kind, slug, version, url, ext))
+        pending.append((slug, artifact_path(kind, slug, version, ext)))
+
+    if commands:
+        for (slug, path), result in zip(pending, run_batch(ssh, commands)):
+            if result.ok:
+                paths[slug] = path
+            else:
+                print(f"Failed to cache {slug}: {result.stderr}")
+                paths[slug] = slug
+
+    return paths
+
+
+def evict_unused_blobs(ssh):
+    """Удаляет blobs, на которые больше не ссылается ни одна версия."""
+    command = (
+        f"cd {ARTIFACT_ROOT} 2>/dev/null || exit 0; "
+        f"for blob in blobs/*; do "
+        f"[ -e \"$blob\" ] || continue; "
+        f"[ -n \"$(find . -path ./blobs -prune -o -lname \"*/${{blob##*/}}\" -print -quit)\" ] || rm -f \"$blob\"; "
+        f"done; "
+        f"find {ARTIFACT_ROOT}/tmp -type f -mmin +60 -delete"
+    )
+    run_batch(ssh, [command])
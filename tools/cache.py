@@ -0,0 +1,61 @@
+import hashlib
+import json
+
+from pydantic import BaseModel
+
+from tools.config import config_read
+from tools.redis_client import async_redis, redis_client
+
+config = config_read("config.ini")
+
+# Списки сбрасываются при каждом изменении, поэтому TTL можно держать большим
+CACHE_TTL = config.getint('CACHE', 'ttl', fallback=3600)
+CACHE_PREFIX = "fastapi-cache"
+
+# Теги = namespace ключей fastapi_cache
+DOMAINS = "domains"
+SERVERS = "servers"
+CLOUDFLARE = "cf"
+
+
+def _version_key(tag: str) -> str:
+    return f"wpg:cache:version:{tag}"
+
+
+def _cache_value(value):
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if hasattr(value, "is_active"):
+        # Списки одинаковы для всех пользователей, в ключ входит только is_active:
+        # проверка внутри эндпоинта при попадании в кэш не выполняется, а ответ 403 не кэшируется
+        return f"active:{value.is_active}"
+    # Сессии и прочие зависимости в ключ не входят
+    return None
+
+
+async def cache_key_builder(func, namespace: str = "", request=None, response=None, args=(), kwargs=None):
+    """
+    Ключ зависит только от параметров запроса и версии тега, а не от repr объектов зависимостей.
+    Сброс тега - INCR версии, старые ключи больше не читаются и истекают по TTL.
+    """
+    version = await async_redis.get(_version_key(namespace)) or 0
+    params = {name: _cache_value(value) for name, value in sorted((kwargs or {}).items())}
+    raw = f"{func.__module__}:{func.__name__}:{json.dumps(params, sort_keys=True, default=str)}"
+    return f"{CACHE_PREFIX}:{namespace}:v{version}:{hashlib.md5(raw.encode()).hexdigest()}"
+
+
+async def invalidate_cache(*tags: str):
+    pipe = async_redis.pipeline(transaction=False)
+    for tag in tags:
+        pipe.incr(_version_key(tag))
+    await pipe.execute()
+
+
+def invalidate_cache_sync(*tags: str):
+    """То же для Celery воркеров."""
+    pipe = redis_client.pipeline(transaction=False)
+    for tag in tags:
+        pipe.incr(_version_key(tag))
+    pipe.execute()
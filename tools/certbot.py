@@ -36,45 +36,46 @@ def configure_ssl_in_apache(ssh, domain, cert_path, key_path):
         print(f"Failed to write SSL configuration: {e}")
 
 
-def generate_lets_encrypt_cert(ssh, domains: list):
-    for domain in domains:
-        try:
-            # Генерация сертификата с помощью Certbot
-            print(f"Generating Let's Encrypt certificate...")
-            gen_cert_command = f"""
-            certbot certonly --apache --non-interactive --agree-tos --email admin@{domains[0]} \
-            -d {domain}
-            """
-            stdin, stdout, stderr = ssh.exec_command(gen_cert_command)
-            stdout.channel.recv_exit_status()  # Дождаться завершения команды
-
-            # Логирование вывода и ошибок
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-
-            if "Congratulations" in output:
-                print(f"Let's Encrypt certificate for {domain} has been successfully generated.")
-            elif error:
-                if error.find("debug") != -1:
-                    print(f"DEBUG: {error}")
-                    if error.find("Syntax") != -1:
-                        print(f"Error generating Let's Encrypt certificate for {domain}: {error}")
-                        raise
-            else:
-                print(f"Unexpected output: {output}")
-                raise
-
-            # Путь к сертификатам, сгенерированным Certbot
-            cert_path = f"/etc/letsencrypt/live/{domain}/fullchain.pem"
-            key_path = f"/etc/letsencrypt/live/{domain}/privkey.pem"
-
-            configure_ssl_in_apache(ssh, domain, cert_path, key_path)
-
-        except Exception as e:
-            print(f"Failed {domain}")
-            print(e)
-            raise
+def issue_lets_encrypt_cert(ssh, domain, email_domain):
+    try:
+        # Генерация сертификата с помощью Certbot
+        print(f"Generating Let's Encrypt certificate...")
+        gen_cert_command = f"""
+        certbot certonly --apache --non-interactive --agree-tos --email admin@{email_domain} \
+        -d {domain}
+        """
+        stdin, stdout, stderr = ssh.exec_command(gen_cert_command)
+        stdout.channel.recv_exit_status()  # Дождаться завершения команды
+
+        # Логирование вывода и ошибок
+        output = stdout.read().decode('utf-8')
+        error = stderr.read().decode('utf-8')
+
+        if "Congratulations" in output:
+            print(f"Let's Encrypt certificate for {domain} has been successfully generated.")
+        elif error:
+            if error.find("debug") != -1:
+                print(f"DEBUG: {error}")
+                if error.find("Syntax") != -1:
+                    print(f"Error generating Let's Encrypt certificate for {domain}: {error}")
+                    raise Exception(error)
+        else:
+            print(f"Unexpected output: {output}")
+            raise Exception(output)
+
+        # Путь к сертификатам, сгенерированным Certbot
+        cert_path = f"/etc/letsencrypt/live/{domain}/fullchain.pem"
+        key_path = f"/etc/letsencrypt/live/{domain}/privkey.pem"
+
+        configure_ssl_in_apache(ssh, domain, cert_path, key_path)
+
+    except Exception as e:
+        print(f"Failed {domain}")
+        print(e)
+        raise
 
+
+def allow_https_in_firewall(ssh):
     # Разрешаем трафик по https в фаерволе
     stdin, stdout, stderr = ssh.exec_command("firewall-cmd --permanent --add-service=https >/dev/null 2>&1")
     stdout.channel.recv_exit_status()
@@ -82,3 +83,9 @@ def generate_lets_encrypt_cert(ssh, domains: list):
     stdin, stdout, stderr = ssh.exec_command("systemctl reload firewalld >/dev/null 2>&1")
     stdout.channel.recv_exit_status()
 
+
+def generate_lets_encrypt_cert(ssh, domains: list):
+    for domain in domains:
+        issue_lets_encrypt_cert(ssh, domain, domains[0])
+
+    allow_https_in_firewall(ssh)
@@ -1,25 +1,160 @@
+import asyncio
+import json
+import random
+import re
+import time
+import weakref
+from collections import OrderedDict
+
 import aiohttp
 
+from tools.config import config_read
+from tools.redis_client import async_redis
+
+config = config_read("config.ini")
 
 CLOUDFLARE_API_BASE_URL = "https://api.cloudflare.com/client/v4"
 
+CONNECTIONS_PER_HOST = config.getint('CLOUDFLARE', 'connections', fallback=20)
+MAX_RETRIES = config.getint('CLOUDFLARE', 'max_retries', fallback=5)
+REQUEST_TIMEOUT = config.getint('CLOUDFLARE', 'timeout', fallback=30)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# ID зоны не меняется, пока домен не удален из Cloudflare
+ZONE_CACHE_TTL = config.getint('CLOUDFLARE', 'zone_cache_ttl', fallback=7 * 24 * 3600)
+# Клиенты хранят состояние лимита аккаунта, держим только последние использованные
+CLIENTS_CACHE_SIZE = config.getint('CLOUDFLARE', 'clients', fallback=1000)
+
+# Одна сессия (и один пул keep-alive соединений) на event loop:
+# в API это один loop, в Celery задаче - loop конкретного asyncio.run (закрывается в run_async).
+# Слабые ссылки на loop: завершенный loop не удерживается словарем
+_sessions = weakref.WeakKeyDictionary()
+_clients = OrderedDict()
+
+
+def _get_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=CONNECTIONS_PER_HOST, keepalive_timeout=60)
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    """Закрывает сессию текущего event loop. Вызывается при остановке API и в конце Celery задач."""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def _rate_limit(response):
+    """(remaining, reset) из заголовков лимитов Cloudflare, если они есть."""
+    # Ratelimit: "default";r=50;t=30
+    match = re.search(r"\br=(\d+);t=(\d+)", response.headers.get("Ratelimit", ""))
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    remaining = response.headers.get("Ratelimit-Remaining", "")
+    reset = response.headers.get("Ratelimit-Reset", "")
+    if remaining.isdigit() and reset.isdigit():
+        return int(remaining), int(reset)
+    return None, None
+
+
+def _retry_delay(attempt, response=None):
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return int(retry_after)
+        remaining, reset = _rate_limit(response)
+        if remaining == 0:
+            return reset
+    return min(30.0, 0.5 * 2 ** attempt) + random.uniform(0, 0.5)
+
+
+class CloudflareClient:
+    """Клиент одного аккаунта Cloudflare поверх общей сессии."""
+
+    def __init__(self, email: str, api_key: str):
+        self.headers = {
+            "X-Auth-Email": email,
+            "X-Auth-Key": api_key,
+            "Content-Type": "application/json"
+        }
+        # Момент, до которого аккаунт исчерпал лимит запросов
+        self.blocked_until = 0.0
+
+    async def _wait_rate_limit(self):
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _track_rate_limit(self, response):
+        remaining, reset = _rate_limit(response)
+        if remaining == 0:
+            self.blocked_until = time.monotonic() + reset
+
+    async def request(self, method: str, path: str, **kwargs):
+        """Возвращает (HTTP статус, JSON ответа). 429/5xx и сетевые ошибки повторяются с backoff."""
+        url = f"{CLOUDFLARE_API_BASE_URL}{path}"
+        for attempt in range(MAX_RETRIES + 1):
+            await self._wait_rate_limit()
+            try:
+                async with _get_session().request(method, url, headers=self.headers, **kwargs) as response:
+                    self._track_rate_limit(response)
+                    if response.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                        delay = _retry_delay(attempt, response)
+                        print(f"Cloudflare {method} {path}: {response.status}, retry in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        continue
+                    text = await response.text()
+                    try:
+                        data = json.loads(text)
+                    except ValueError:
+                        data = {"success": False, "errors": [text[:500]], "result": None}
+                    return response.status, data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= MAX_RETRIES:
+                    raise
+                delay = _retry_delay(attempt)
+                print(f"Cloudflare {method} {path}: {e!r}, retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def get(self, path: str, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def patch(self, path: str, **kwargs):
+        return await self.request("PATCH", path, **kwargs)
+
+    async def delete(self, path: str, **kwargs):
+        return await self.request("DELETE", path, **kwargs)
+
+
+def get_client(email: str, api_key: str) -> CloudflareClient:
+    key = (email, api_key)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = CloudflareClient(email, api_key)
+        if len(_clients) > CLIENTS_CACHE_SIZE:
+            _clients.popitem(last=False)
+    else:
+        _clients.move_to_end(key)
+    return client
 
-async def get_account_id(email: str, api_key: str) -> str:
-    url = f"{CLOUDFLARE_API_BASE_URL}/user"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            data = await response.json()
-            if data.get("success"):
-                account_id = data["result"]["id"]
-                return account_id
-            else:
-                raise Exception(f"Error: {data['errors']}")
+async def get_account_id(email: str, api_key: str) -> str:
+    status, data = await get_client(email, api_key).get("/user")
+    if data.get("success"):
+        account_id = data["result"]["id"]
+        return account_id
+    else:
+        raise Exception(f"Error: {data['errors']}")
 
 
 async def validate_credentials(email: str, api_key: str) -> bool:
@@ -33,251 +168,235 @@ async def validate_credentials(email: str, api_key: str) -> bool:
         return False
 
 
-async def delete_all_dns_records(zone_id: str, email: str, api_key: str):
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones/{zone_id}/dns_records"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
+async def list_dns_records(zone_id: str, email: str, api_key: str):
+    """Все DNS записи зоны, со всех страниц."""
+    client = get_client(email, api_key)
+    records = []
+    page = 1
+    while True:
+        status, data = await client.get(f"/zones/{zone_id}/dns_records", params={"page": page, "per_page": 5000})
+        if not data.get("success"):
+            raise Exception(f"Failed to list DNS records: {data['errors']}")
+        records.extend(data["result"])
+        if page >= data.get("result_info", {}).get("total_pages", 1):
+            return records
+        page += 1
+
+
+def _diff_dns_records(records, desired):
+    """Разница между текущими записями и нужными: (deletes, patches, posts) в формате batch API."""
+    deletes, patches, posts = [], [], []
+    matched = {}
+    for record in records:
+        want = desired.get(record["name"])
+        if record["type"] != "A" or want is None or record["name"] in matched:
+            deletes.append({"id": record["id"]})
+            continue
+        matched[record["name"]] = record
+        if record["content"] != want["content"] or record.get("proxied") != want["proxied"]:
+            patches.append({"id": record["id"], "content": want["content"], "proxied": want["proxied"]})
+
+    for name, want in desired.items():
+        if name not in matched:
+            posts.append(want)
+    return deletes, patches, posts
+
+
+async def _apply_dns_changes_one_by_one(client, zone_id, deletes, patches, posts):
+    semaphore = asyncio.Semaphore(4)
+
+    async def call(method, path, **kwargs):
+        async with semaphore:
+            status, data = await client.request(method, path, **kwargs)
+            if not data.get("success"):
+                raise Exception(f"{method} {path} failed: {data['errors']}")
+
+    # Удаляем первыми: CNAME на www мешает создать A запись с тем же именем
+    await asyncio.gather(*(call("DELETE", f"/zones/{zone_id}/dns_records/{record['id']}") for record in deletes))
+    await asyncio.gather(
+        *(call("PATCH", f"/zones/{zone_id}/dns_records/{record['id']}",
+               json={key: value for key, value in record.items() if key != "id"}) for record in patches),
+        *(call("POST", f"/zones/{zone_id}/dns_records", json=record) for record in posts)
+    )
+
+
+async def reconcile_dns_records(zone_id: str, domain: str, server_ip: str, email: str, api_key: str):
+    """
+    Приводит DNS зоны к двум A записям (домен и www) на server_ip.
+    Повторный вызов ничего не меняет. Изменения уходят одним batch запросом.
+    """
+    client = get_client(email, api_key)
+    desired = {
+        name: {"type": "A", "name": name, "content": server_ip, "proxied": True}
+        for name in (domain, f"www.{domain}")
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            data = await response.json()
-            if data.get("success"):
-                records = data["result"]
-                for record in records:
-                    record_id = record["id"]
-                    delete_url = f"{url}/{record_id}"
-                    async with session.delete(delete_url, headers=headers) as delete_response:
-                        delete_data = await delete_response.json()
-                        if delete_data.get("success"):
-                            print(f"Deleted DNS record {record_id}")
-                        else:
-                            print(f"Failed to delete DNS record {record_id}: {delete_data['errors']}")
-            else:
-                print(f"Failed to list DNS records: {data['errors']}")
-
-
-async def add_a_records(zone_id: str, server_ip: str, email: str, api_key: str):
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones/{zone_id}/dns_records"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
-    records = [
-        {"type": "A", "name": "@", "content": server_ip, "proxied": True},
-        {"type": "A", "name": "www", "content": server_ip, "proxied": True}
-    ]
+    records = await list_dns_records(zone_id, email, api_key)
+    deletes, patches, posts = _diff_dns_records(records, desired)
+    changes = {"deleted": len(deletes), "updated": len(patches), "created": len(posts)}
+    if not (deletes or patches or posts):
+        return changes
 
-    async with aiohttp.ClientSession() as session:
-        for record in records:
-            async with session.post(url, headers=headers, json=record) as response:
-                data = await response.json()
-                if data.get("success"):
-                    print(f"Added DNS record: {record['name']} -> {server_ip}")
-                else:
-                    print(f"Failed to add DNS record: {record['name']} -> {server_ip}: {data['errors']}")
+    status, data = await client.post(f"/zones/{zone_id}/dns_records/batch",
+                                     json={"deletes": deletes, "patches": patches, "posts": posts})
+    if status in (404, 405):
+        await _apply_dns_changes_one_by_one(client, zone_id, deletes, patches, posts)
+    elif not data.get("success"):
+        raise Exception(f"Failed to update DNS records: {data['errors']}")
+
+    print(f"DNS records of {domain} -> {server_ip}: {changes}")
+    return changes
 
 
 async def get_zone_id(domain: str, email: str, api_key: str) -> str:
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
-    params = {"name": domain}
+    status, data = await get_client(email, api_key).get("/zones", params={"name": domain})
+    if data.get("success") and data["result"]:
+        zone_id = data["result"][0]["id"]
+        return zone_id
+    else:
+        raise Exception(f"Error: {data['errors']}")
+
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers, params=params) as response:
-            data = await response.json()
-            if data.get("success") and data["result"]:
-                zone_id = data["result"][0]["id"]
-                return zone_id
-            else:
-                raise Exception(f"Error: {data['errors']}")
+async def list_active_zones(email: str, api_key: str) -> dict:
+    """{домен: zone_id} для всех активных зон аккаунта."""
+    client = get_client(email, api_key)
+    zones = {}
+    page = 1
+    while True:
+        status, data = await client.get("/zones", params={"status": "active", "per_page": 50, "page": page})
+        if not data.get("success"):
+            raise Exception(f"Failed to list zones: {data['errors']}")
+        for zone in data["result"]:
+            zones[zone["name"]] = zone["id"]
+        if page >= data.get("result_info", {}).get("total_pages", 1):
+            return zones
+        page += 1
+
+
+def _zone_cache_key(domain: str) -> str:
+    return f"wpg:cf:zone:{domain}"
+
+
+async def cache_zone_id(domain: str, zone_id: str, redis=async_redis):
+    await redis.set(_zone_cache_key(domain), zone_id, ex=ZONE_CACHE_TTL)
+
+
+async def get_cached_zone_id(domain: str, email: str, api_key: str, redis=async_redis) -> str:
+    zone_id = await redis.get(_zone_cache_key(domain))
+    if zone_id is None:
+        zone_id = await get_zone_id(domain, email, api_key)
+        await cache_zone_id(domain, zone_id, redis)
+    return zone_id
 
 
 async def check_ns_records(zone_id: str, email: str, api_key: str):
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones/{zone_id}"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            result = await response.json()
-            if response.status == 200 and result["success"]:
-                current_ns = result["result"]["name_servers"]
-                expected_ns = result["result"]["original_name_servers"]
+    status, result = await get_client(email, api_key).get(f"/zones/{zone_id}")
+    if status == 200 and result["success"]:
+        current_ns = result["result"]["name_servers"]
+        expected_ns = result["result"]["original_name_servers"]
 
-                print(f"Cloudflare NS records: {current_ns}")
-                print(f"Expected NS records: {expected_ns}")
+        print(f"Cloudflare NS records: {current_ns}")
+        print(f"Expected NS records: {expected_ns}")
 
-                return sorted(current_ns) == sorted(expected_ns)
-            else:
-                print(f"Failed to check NS records: {result['errors']}")
-                return False
+        return sorted(current_ns) == sorted(expected_ns)
+    else:
+        print(f"Failed to check NS records: {result['errors']}")
+        return False
 
 
 async def check_zone_status(zone_id: str, email: str, api_key: str):
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones/{zone_id}"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            result = await response.json()
-            if response.status == 200 and result["success"]:
-                status = result["result"]["status"]
-                print(f"Cloudflare Zone Status: {status}")
-                return status == "active"
-            else:
-                print(f"Failed to check zone status: {result['errors']}")
-                return False
+    status, result = await get_client(email, api_key).get(f"/zones/{zone_id}")
+    if status == 200 and result["success"]:
+        zone_status = result["result"]["status"]
+        print(f"Cloudflare Zone Status: {zone_status}")
+        return zone_status == "active"
+    else:
+        print(f"Failed to check zone status: {result['errors']}")
+        return False
 
 
 async def get_ns_records(zone_id: str, email: str, api_key: str):
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones/{zone_id}"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            result = await response.json()
-            if response.status == 200 and result["success"]:
-                expected_ns = result["result"]["original_name_servers"]
-                return expected_ns
-            else:
-                print(f"Failed to check NS records: {result['errors']}")
-                return None
+    status, result = await get_client(email, api_key).get(f"/zones/{zone_id}")
+    if status == 200 and result["success"]:
+        expected_ns = result["result"]["original_name_servers"]
+        return expected_ns
+    else:
+        print(f"Failed to check NS records: {result['errors']}")
+        return None
 
 
 async def add_domain_cf(domain: str, email: str, api_key: str):
-    url = f"{CLOUDFLARE_API_BASE_URL}/zones"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_key,
-        "Content-Type": "application/json"
-    }
-
+    """Создает зону. Возвращает объект зоны Cloudflare (id, name_servers, ...) или None."""
     data = {
         "name": domain,
         "jump_start": True
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            result = await response.json()
-            try:
-                if result["success"]:
-                    ns_records = result["result"]["name_servers"]
-                    return ns_records
-                else:
-                    print(f"Failed to add domain: {result['errors']}")
-                    return None
-            except:
-                return None
+    status, result = await get_client(email, api_key).post("/zones", json=data)
+    try:
+        if result["success"]:
+            zone = result["result"]
+            await cache_zone_id(domain, zone["id"])
+            return zone
+        else:
+            print(f"Failed to add domain: {result['errors']}")
+            return None
+    except:
+        return None
+
+
+async def delete_zone(domain: str, zone_id: str, email: str, api_key: str) -> bool:
+    """Удаляет зону домена из аккаунта и ее ID из кэша."""
+    status, result = await get_client(email, api_key).delete(f"/zones/{zone_id}")
+    if not result.get("success") and status != 404:
+        print(f"Failed to delete zone {zone_id}: {result['errors']}")
+        return False
+    await async_redis.delete(_zone_cache_key(domain))
+    return True
 
 
-async def set_ssl_full(zone_id, email, api_token):
-    url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/settings/ssl"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_token,
-        "Content-Type": "application/json"
-    }
-    data = {
-        "value": "full"
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.patch(url, headers=headers, json=data) as response:
-            result = await response.json()
-            try:
-                if result["success"]:
-                    return True
-                else:
-                    return None
-            except:
-                return None
+async def _set_ssl_mode(zone_id, email, api_token, value):
+    status, result = await get_client(email, api_token).patch(f"/zones/{zone_id}/settings/ssl", json={"value": value})
+    try:
+        if result["success"]:
+            return True
+        else:
+            return None
+    except:
+        return None
 
 
-async def set_ssl_flex(zone_id, email, api_token):
-    url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/settings/ssl"
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_token,
-        "Content-Type": "application/json"
-    }
-    data = {
-        "value": "flexible"
-    }
+async def set_ssl_full(zone_id, email, api_token):
+    return await _set_ssl_mode(zone_id, email, api_token, "full")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.patch(url, headers=headers, json=data) as response:
-            result = await response.json()
-            try:
-                if result["success"]:
-                    return True
-                else:
-                    return None
-            except:
-                return None
 
+async def set_ssl_flex(zone_id, email, api_token):
+    return await _set_ssl_mode(zone_id, email, api_token, "flexible")
 
 
 async def get_certificate_id(domain: str, zone_id: str, email: str, api_token: str):
-    async with aiohttp.ClientSession() as session:
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/custom_certificates"
-        headers = {
-            "X-Auth-Email": email,
-            "X-Auth-Key": api_token,
-            "Content-Type": "application/json"
-        }
-
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                certificates = data["result"]
-                if certificates:
-                    for cert in certificates:
-                        # Проверяем, соответствует ли сертификат домену
-                        if domain in cert['hosts']:
-                            print(f"Found certificate for domain: {domain}")
-                            print(f"Certificate ID: {cert['id']}, Issuer: {cert['issuer']}")
-                            return cert["id"]
-                    raise Exception(f"No certificate found for domain {domain}.")
-                else:
-                    raise Exception("No certificates found for this zone.")
-            else:
-                error_message = await response.text()
-                raise Exception(f"Error fetching certificates: {response.status} \n{error_message}")
+    status, data = await get_client(email, api_token).get(f"/zones/{zone_id}/custom_certificates")
+    if status == 200:
+        certificates = data["result"]
+        if certificates:
+            for cert in certificates:
+                # Проверяем, соответствует ли сертификат домену
+                if domain in cert['hosts']:
+                    print(f"Found certificate for domain: {domain}")
+                    print(f"Certificate ID: {cert['id']}, Issuer: {cert['issuer']}")
+                    return cert["id"]
+            raise Exception(f"No certificate found for domain {domain}.")
+        else:
+            raise Exception("No certificates found for this zone.")
+    else:
+        raise Exception(f"Error fetching certificates: {status} \n{data}")
 
 
 async def get_ssl_certificate(zone_id: str, certificate_id: str, email: str, api_token: str):
-    url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/custom_certificates/{certificate_id}"
-
-    headers = {
-        "X-Auth-Email": email,
-        "X-Auth-Key": api_token,
-        "Content-Type": "application/json"
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                certificate = data["result"]["certificate"]
-                private_key = data["result"]["private_key"]
-                return certificate, private_key
-            else:
-                error_message = await response.text()
-                raise Exception(f"Error fetching certificate: {response.status} \n{error_message}")
\ No newline at end of file
+    status, data = await get_client(email, api_token).get(f"/zones/{zone_id}/custom_certificates/{certificate_id}")
+    if status == 200:
+        certificate = data["result"]["certificate"]
+        private_key = data["result"]["private_key"]
+        return certificate, private_key
+    else:
+        raise Exception(f"Error fetching certificate: {status} \n{data}")
@@ -0,0 +1,72 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+
+from tools.config import config_read
+
+config = config_read("config.ini")
+
+# Apache/MySQL на одном сервере нормально держат 4-8 параллельных wp-cli
+PER_SERVER_LIMIT = config.getint('FANOUT', 'per_server', fallback=6)
+
+
+@dataclass
+class FanOutResult:
+    total: int
+    done: int = 0
+    failed: int = 0
+    results: Dict[Hashable, Any] = field(default_factory=dict)
+    errors: Dict[Hashable, str] = field(default_factory=dict)
+
+    @property
+    def finished(self):
+        return self.done + self.failed
+
+    @property
+    def progress(self):
+        return self.finished / self.total if self.total else 1.0
+
+    def summary(self):
+        return {
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "errors": {str(key): value for key, value in self.errors.items()},
+        }
+
+
+def print_progress(result: FanOutResult, item: Hashable):
+    status = "error" if item in result.errors else "done"
+    print(f"[{result.finished}/{result.total}] {item}: {status}")
+
+
+async def fan_out(
+        items: Iterable[Hashable],
+        worker: Callable[[Hashable], Awaitable[Any]],
+        server_of: Callable[[Hashable], Hashable] = lambda item: None,
+        per_server: int = PER_SERVER_LIMIT,
+        on_progress: Optional[Callable[[FanOutResult, Hashable], None]] = None,
+) -> FanOutResult:
+    """
+    Запускает worker для каждого элемента параллельно.
+    Внутри одного сервера не больше per_server задач, между серверами ограничений нет.
+    """
+    items = list(items)
+    result = FanOutResult(total=len(items))
+    semaphores = {}
+
+    async def run(item):
+        server = server_of(item)
+        semaphore = semaphores.setdefault(server, asyncio.Semaphore(per_server))
+        async with semaphore:
+            try:
+                result.results[item] = await worker(item)
+                result.done += 1
+            except Exception as e:
+                result.errors[item] = str(e)
+                result.failed += 1
+        if on_progress is not None:
+            on_progress(result, item)
+
+    await asyncio.gather(*(run(item) for item in items))
+    return result
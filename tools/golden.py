@@ -0,0 +1,188 @@
+import random
+import shlex
+import string
+from contextlib import contextmanager
+
+from tools.artifacts import CORE, PLUGIN, ensure_artifacts
+from tools.ssh_batch import run_batch
+
+WP_CLI_PATH = "/usr/local/bin/wp"
+
+# Эталонный сайт сервера: дерево WordPress и дамп базы, из которых клонируются новые домены.
+# current - симлинк на последнюю сборку build_<id>/{site,site.sql}, переключается атомарно.
+GOLDEN_ROOT = "/opt/wpg/golden"
+GOLDEN_CURRENT = f"{GOLDEN_ROOT}/current"
+GOLDEN_PATH = f"{GOLDEN_CURRENT}/site"
+GOLDEN_DUMP = f"{GOLDEN_CURRENT}/site.sql"
+# Клонирование держит общую блокировку, переключение current - эксклюзивную
+GOLDEN_LOCK = f"{GOLDEN_ROOT}/.lock"
+# Одна сборка на сервер одновременно
+GOLDEN_BUILD_LOCK = f"{GOLDEN_ROOT}/.build.lock"
+LOCK_TIMEOUT = 1800
+GOLDEN_URL = "golden.wpg.local"
+GOLDEN_ADMIN = "wpg_golden_admin"
+
+GOLDEN_PLUGINS = ['wp-smushit', 'wordpress-seo', 'cookie-notice', 'contact-form-7',
+                  'jetpack', 'wp-simple-firewall']
+
+HTACCESS_CONTENT = "# BEGIN WordPress\n<IfModule mod_rewrite.c>\nRewriteEngine On\nRewriteBase /" \
+                   "\nRewriteRule ^index\\.php$ - [L]\nRewriteCond %{REQUEST_FILENAME} !-f" \
+                   "\nRewriteCond %{REQUEST_FILENAME} !-d\nRewriteRule . /index.php [L]" \
+                   "\n</IfModule>\n# END WordPress\n\n<Files wp-config.php>\norder allow,deny\ndeny from all\n" \
+                   "</Files>\n\n<Files .htaccess>\norder allow,deny\ndeny from all\n</Files>"
+
+
+def _random_string(length):
+    characters = string.ascii_letters + string.digits
+    return ''.join(random.choice(characters) for i in range(length))
+
+
+def _check(results):
+    for result in results:
+        if result.exit_code is not None and not result.ok:
+            raise Exception(f"Command failed: {result.command}. Error: {result.stderr}")
+
+
+@contextmanager
+def remote_lock(ssh, path, shared=False, timeout=LOCK_TIMEOUT):
+    """
+    flock на сервере. Блокировку держит процесс flock, пока открыт канал:
+    cat ждет EOF на stdin. При обрыве SSH процесс завершается и блокировка снимается.
+    """
+    mode = "-s" if shared else "-x"
+    stdin, stdout, stderr = ssh.exec_command(
+        f"mkdir -p {GOLDEN_ROOT} && exec flock {mode} -w {timeout} {path} -c 'echo locked && exec cat >/dev/null'"
+    )
+    if stdout.readline().strip() != "locked":
+        stdin.channel.close()
+        raise Exception(f"Could not lock {path}: {stderr.read().decode('utf-8').strip()}")
+    try:
+        yield
+    finally:
+        stdin.channel.shutdown_write()
+        stdout.channel.recv_exit_status()
+
+
+def golden_site_exists(ssh) -> bool:
+    stdin, stdout, stderr = ssh.exec_command(f"test -f {GOLDEN_DUMP} && test -d {GOLDEN_PATH}")
+    return stdout.channel.recv_exit_status() == 0
+
+
+def build_golden_site(ssh):
+    """Собирает эталонный сайт: ядро, базовые настройки и плагины, затем дамп базы."""
+    with remote_lock(ssh, GOLDEN_BUILD_LOCK):
+        _build_golden_site(ssh)
+
+
+def _build_golden_site(ssh):
+    build_id = _random_string(8).lower()
+    build_root = f"{GOLDEN_ROOT}/build_{build_id}"
+    build_path = f"{build_root}/site"
+    build_dump = f"{build_root}/site.sql"
+    db_name = db_user = f"wpg_golden_{build_id}"
+    db_password = _random_string(24)
+    wp = f"{WP_CLI_PATH} --path={build_path} --allow-root"
+
+    # Ядро и плагины берутся из кэша сервера, если он доступен
+    artifacts = ensure_artifacts(ssh, [(CORE, "wordpress")] + [(PLUGIN, plugin) for plugin in GOLDEN_PLUGINS])
+    core = artifacts["wordpress"]
+    if core == "wordpress":
+        core_download = f"{wp} core download"
+    else:
+        core_download = f"mkdir -p {build_path} && tar -xzf {core} -C {build_path} --strip-components=1"
+    plugins = ' '.join(artifacts[plugin] for plugin in GOLDEN_PLUGINS)
+
+    commands = [
+        f"mkdir -p {build_root}",
+        f"mysql -e 'CREATE DATABASE {db_name};'",
+        f"mysql -e 'CREATE USER \"{db_user}\"@\"localhost\" IDENTIFIED BY \"{db_password}\";'",
+        f"mysql -e 'GRANT ALL PRIVILEGES ON {db_name}.* TO \"{db_user}\"@\"localhost\";'",
+        f"mysql -e 'FLUSH PRIVILEGES;'",
+        core_download,
+        f"{wp} config create --dbname={db_name} --dbuser={db_user} --dbpass={db_password}",
+        f"{wp} config set FS_METHOD 'direct'",
+        f"{wp} config set DISALLOW_FILE_EDIT true --raw",
+        f"{wp} core install --url={GOLDEN_URL} --title=WordPress --admin_user={GOLDEN_ADMIN} "
+        f"--admin_password={_random_string(24)} --admin_email=admin@{GOLDEN_URL} --skip-email",
+        f"{wp} post delete 1 2 --force",
+        f"{wp} term update category $({wp} term list category --name=Uncategorized --field=term_id) "
+        f"--name='Articles' --slug='articles'",
+        f"{wp} plugin install {plugins} --activate",
+        f"mysqldump {db_name} > {build_dump}",
+    ]
+
+    try:
+        _check(run_batch(ssh, commands, stop_on_error=True))
+
+        sftp = ssh.open_sftp()
+        with sftp.open(f"{build_path}/.htaccess", 'w') as htaccess_file:
+            htaccess_file.write(HTACCESS_CONTENT)
+        sftp.close()
+
+        # Переключаем симлинк rename-ом, старую сборку удаляем, когда ее никто не клонирует.
+        # site и site.sql лежат в старом месте у серверов, собранных до перехода на current.
+        with remote_lock(ssh, GOLDEN_LOCK):
+            _check(run_batch(ssh, [
+                f"previous=$(readlink {GOLDEN_CURRENT} || true) && "
+                f"ln -sfn {build_root} {GOLDEN_CURRENT}.new && mv -T {GOLDEN_CURRENT}.new {GOLDEN_CURRENT} && "
+                f"if [ -n \"$previous\" ] && [ \"$previous\" != {build_root} ]; then rm -rf \"$previous\"; fi",
+                f"rm -rf {GOLDEN_ROOT}/site {GOLDEN_ROOT}/site.sql {GOLDEN_ROOT}/site.old",
+            ], stop_on_error=True))
+        print(f"Golden site built in {build_path}")
+    except Exception:
+        run_batch(ssh, [f"rm -rf {build_root}"])
+        raise
+    finally:
+        # Временная база нужна только для дампа
+        run_batch(ssh, [
+            f"mysql -e 'DROP DATABASE IF EXISTS {db_name};'",
+            f"mysql -e 'DROP USER IF EXISTS \"{db_user}\"@\"localhost\";'",
+        ])
+
+
+def ensure_golden_site(ssh):
+    if golden_site_exists(ssh):
+        return
+    # Несколько задач на свежем сервере ждут одну сборку, а не запускают свои
+    with remote_lock(ssh, GOLDEN_BUILD_LOCK):
+        if not golden_site_exists(ssh):
+            _build_golden_site(ssh)
+
+
+def clone_golden_site(ssh, domain, title, admin_user, admin_password, about_us_content):
+    """Разворачивает домен из эталонного сайта: копия файлов, импорт базы и search-replace."""
+    db_name = db_user = domain.replace('.', '_').replace('-', '_')
+    db_password = _random_string(24)
+    site_path = f"/var/www/{domain}"
+    wp = f"{WP_CLI_PATH} --path={site_path} --allow-root"
+
+    # Копия файлов и импорт дампа под общей блокировкой: пересборка не переключит current посреди копирования
+    copy = (
+        f"flock -s -w {LOCK_TIMEOUT} {GOLDEN_LOCK} -c "
+        f"'mkdir -p {site_path} && cp -a {GOLDEN_PATH}/. {site_path}/ && mysql {db_name} < {GOLDEN_DUMP}'"
+    )
+    commands = [
+        f"mysql -e 'CREATE DATABASE IF NOT EXISTS {db_name};'",
+        f"mysql -e 'CREATE USER IF NOT EXISTS \"{db_user}\"@\"localhost\" IDENTIFIED BY \"{db_password}\";'",
+        f"mysql -e 'ALTER USER \"{db_user}\"@\"localhost\" IDENTIFIED BY \"{db_password}\";'",
+        f"mysql -e 'GRANT ALL PRIVILEGES ON {db_name}.* TO \"{db_user}\"@\"localhost\";'",
+        f"mysql -e 'FLUSH PRIVILEGES;'",
+        copy,
+        f"{wp} config set DB_NAME {db_name}",
+        f"{wp} config set DB_USER {db_user}",
+        f"{wp} config set DB_PASSWORD {db_password}",
+        f"{wp} config shuffle-salts",
+        f"{wp} search-replace {GOLDEN_URL} {domain} --all-tables",
+        f"{wp} option update blogname {shlex.quote(title)}",
+        f"{wp} option update admin_email admin@{domain}",
+        f"{wp} user create {admin_user} admin@{domain} --role=administrator --user_pass={admin_password}",
+        f"{wp} user delete {GOLDEN_ADMIN} --reassign={admin_user} --yes",
+        f"{wp} post create --post_type=page --post_title='About Us' "
+        f"--post_content={shlex.quote(about_us_content)} --post_status=publish",
+    ]
+
+    results = run_batch(ssh, commands, stop_on_error=True)
+    for result in results:
+        print(result.command)
+        print(result.stdout)
+    _check(results)
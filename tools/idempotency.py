@@ -0,0 +1,91 @@
+import hashlib
+import inspect
+import json
+import uuid
+from typing import Iterable, Optional, Tuple
+
+from tools.config import config_read
+from tools.redis_client import async_redis, redis_client
+
+config = config_read("config.ini")
+
+# Ключ живет, пока задача в очереди, ждет слот или выполняется (продлевается tools/server_slots.py),
+# TTL - на случай падения воркера
+IDEMPOTENCY_TTL = config.getint('IDEMPOTENCY', 'ttl', fallback=3600)
+
+# Удаляем ключ, только если он все еще принадлежит этой задаче
+_release_script = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# Продлеваем ключ, только если он все еще принадлежит этой задаче
+_refresh_script = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+def idempotency_key(task, args, kwargs) -> Optional[str]:
+    """
+    wpg:once:<задача>:<hash параметров>. Учитываются аргументы из task.idempotency_args,
+    если он задан, иначе все аргументы задачи.
+    """
+    try:
+        arguments = inspect.signature(task.run).bind_partial(*args, **kwargs).arguments
+    except TypeError:
+        return None
+
+    names = getattr(task, "idempotency_args", None)
+    if names is not None:
+        arguments = {name: arguments.get(name) for name in names}
+
+    raw = json.dumps(arguments, sort_keys=True, default=str)
+    return f"wpg:once:{task.name}:{hashlib.sha1(raw.encode()).hexdigest()}"
+
+
+async def enqueue_once(task, *args, **kwargs) -> Tuple[str, bool]:
+    """
+    Ставит задачу в очередь, если такая же еще не стоит в очереди и не выполняется.
+    Возвращает (task_id, True) для новой задачи и (task_id уже запущенной, False) для дубля.
+    Если аргументы не подходят к сигнатуре задачи, ключа нет - задача ставится без проверки.
+    """
+    key = idempotency_key(task, args, kwargs)
+    if key is None:
+        return task.apply_async(args=args, kwargs=kwargs).id, True
+    task_id = uuid.uuid4().hex
+
+    if not await async_redis.set(key, task_id, nx=True, ex=IDEMPOTENCY_TTL):
+        return await async_redis.get(key), False
+
+    try:
+        task.apply_async(args=args, kwargs=kwargs, task_id=task_id)
+    except Exception:
+        await async_redis.delete(key)
+        raise
+    return task_id, True
+
+
+def refresh_idempotency_keys(keys: Iterable[Tuple[Optional[str], str]]):
+    """Продлевает ключи (key, task_id) ожидающих и выполняющихся задач, чтобы TTL не истек до конца задачи."""
+    keys = [(key, task_id) for key, task_id in keys if key is not None]
+    if not keys:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for key, task_id in keys:
+        _refresh_script(keys=[key], args=[task_id, IDEMPOTENCY_TTL], client=pipe)
+    pipe.execute()
+
+
+def release_idempotency_key(task, task_id, args, kwargs):
+    key = idempotency_key(task, args, kwargs)
+    if key is not None:
+        _release_script(keys=[key], args=[task_id])
+
+
+def duplicate_response(task_id: str) -> dict:
+    return {"status": "failed", "data": {"task_id": task_id}, "msg": "Такая задача уже в очереди или выполняется."}
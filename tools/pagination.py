@@ -0,0 +1,57 @@
+import json
+from typing import Generic, List, Optional, TypeVar
+
+from pydantic.generics import GenericModel
+from sqlalchemy import desc, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+T = TypeVar("T")
+
+MAX_PAGE_SIZE = 500
+
+
+class CursorPage(GenericModel, Generic[T]):
+    items: List[T]
+    size: int
+    next_cursor: Optional[int] = None
+    approximate_total: Optional[int] = None
+
+
+async def approximate_count(session: AsyncSession, query) -> int:
+    """Оценка количества строк из плана запроса, без COUNT(*) по всей таблице."""
+    # Параметры (в том числе шаблон поиска от пользователя) передаются как bind-параметры, а не литералы
+    compiled = query.compile(dialect=postgresql.dialect(paramstyle="named"), compile_kwargs={"render_postcompile": True})
+    result = await session.execute(text("EXPLAIN (FORMAT JSON) " + str(compiled)), compiled.params)
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+async def paginate_by_id(session: AsyncSession, query, id_column, cursor: Optional[int], size: int,
+                         with_total: bool = False) -> dict:
+    """
+    Keyset пагинация по убыванию id: страница - это id < cursor LIMIT size.
+    Стоимость страницы не зависит от глубины, в отличие от OFFSET.
+    """
+    size = max(1, min(size, MAX_PAGE_SIZE))
+
+    approximate_total = await approximate_count(session, query) if with_total else None
+
+    if cursor is not None:
+        query = query.where(id_column < cursor)
+    result = await session.execute(query.order_by(desc(id_column)).limit(size + 1))
+    items = result.scalars().all()
+
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        next_cursor = items[-1].id
+
+    return {
+        "items": items,
+        "size": size,
+        "next_cursor": next_cursor,
+        "approximate_total": approximate_total,
+    }
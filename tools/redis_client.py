@@ -0,0 +1,14 @@
+import aioredis
+import redis
+
+from tools.config import config_read
+
+config = config_read("config.ini")
+
+REDIS_URL = config.get('REDIS', 'url', fallback="redis://localhost:6379")
+
+# Синхронный клиент для Celery воркеров
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+
+# Асинхронный клиент для API (соединения создаются при первом запросе)
+async_redis = aioredis.from_url(REDIS_URL, encoding="utf8", decode_responses=True)
@@ -0,0 +1,273 @@
+import inspect
+import json
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from celery import Task, current_app, states
+from celery.exceptions import Ignore
+
+from tools.config import config_read
+from tools.idempotency import idempotency_key, refresh_idempotency_keys, release_idempotency_key
+from tools.redis_client import redis_client
+
+config = config_read("config.ini")
+
+# Сколько задач одновременно может работать с одним сервером во всем кластере воркеров.
+# Для отдельного сервера лимит можно переопределить в [SERVER_LIMITS]: 1.2.3.4=2
+SERVER_MAX_TASKS = config.getint('SERVERS', 'max_tasks', fallback=4)
+# Слот освобождается сам, если воркер умер, не вернув его
+SLOT_TTL = config.getint('SERVERS', 'slot_ttl', fallback=3600)
+# Сколько держится слот, зарезервированный за разбуженной задачей, пока она не начала выполняться
+RESERVE_TTL = config.getint('SERVERS', 'reserve_ttl', fallback=600)
+# Как часто выполняющаяся задача продлевает свои слоты и ключ идемпотентности
+HEARTBEAT_INTERVAL = config.getfloat('SERVERS', 'heartbeat', fallback=60.0)
+# Как часто beat будит ожидающие задачи, если слот освободился без вызова wake_waiting (воркер умер)
+WAKE_INTERVAL = config.getfloat('SERVERS', 'wake_interval', fallback=30.0)
+
+# Заголовок публикации ожидавшей задачи: время в очереди считается от первой публикации
+WAKE_HEADER = "wpg_wake"
+
+# Ресурсы с очередями ожидания: server:<ip> и domain:<домен>
+WAITING_KEY = "wpg:waiting"
+
+# Ресурс - семафор (ZSET токенов со временем истечения) и FIFO очередь ожидания к нему.
+# Задача занимает все свои ресурсы сразу или встает в очередь первого занятого: держать часть
+# ресурсов, ожидая остальные, нельзя. Новая задача не обгоняет ожидающие, а встает за ними,
+# разбуженная задача находит слот уже зарезервированным за ее токеном.
+# Если задачу разбудил один ресурс, а занят другой, резервы снимаются и она встает в начало очереди.
+# Проверка и постановка в очередь в одном вызове: освобождение слота между ними не теряет задачу.
+# Возвращает 0 или номер ресурса, в очередь которого встала задача.
+_acquire_script = redis_client.register_script("""
+local n = (#KEYS - 1) / 2
+local blocked = 0
+for i = 1, n do
+    local slots, waiting = KEYS[2 * i - 1], KEYS[2 * i]
+    redis.call('ZREMRANGEBYSCORE', slots, '-inf', ARGV[1])
+    if not redis.call('ZSCORE', slots, ARGV[3]) and
+            (redis.call('LLEN', waiting) > 0 or redis.call('ZCARD', slots) >= tonumber(ARGV[4 + 2 * i])) then
+        blocked = i
+        break
+    end
+end
+if blocked == 0 then
+    for i = 1, n do
+        redis.call('ZADD', KEYS[2 * i - 1], ARGV[2], ARGV[3])
+        redis.call('EXPIRE', KEYS[2 * i - 1], ARGV[4])
+    end
+    return 0
+end
+local woken = false
+for i = 1, n do
+    if redis.call('ZREM', KEYS[2 * i - 1], ARGV[3]) == 1 then
+        woken = true
+    end
+end
+if woken then
+    redis.call('LPUSH', KEYS[2 * blocked], ARGV[5])
+else
+    redis.call('RPUSH', KEYS[2 * blocked], ARGV[5])
+end
+redis.call('SADD', KEYS[#KEYS], ARGV[5 + 2 * blocked])
+return blocked
+""")
+
+# Снимает с головы очереди ожидания столько задач, сколько у ресурса свободных слотов,
+# и резервирует за каждой слот: новые задачи его уже не займут
+_wake_script = redis_client.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local free = tonumber(ARGV[2]) - redis.call('ZCARD', KEYS[1])
+local entries = {}
+for i = 1, free do
+    local entry = redis.call('LPOP', KEYS[2])
+    if not entry then
+        break
+    end
+    redis.call('ZADD', KEYS[1], ARGV[4], cjson.decode(entry)['id'])
+    entries[#entries + 1] = entry
+end
+if #entries > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+end
+if redis.call('LLEN', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[3])
+end
+return entries
+""")
+
+
+def server_limit(server_ip: str) -> int:
+    return config.getint('SERVER_LIMITS', server_ip, fallback=SERVER_MAX_TASKS)
+
+
+def server_resource(server_ip: str) -> str:
+    return f"server:{server_ip}"
+
+
+def domain_resource(domain: str) -> str:
+    return f"domain:{domain}"
+
+
+def _resource_keys(resource: str) -> Tuple[str, str, int]:
+    """(ключ семафора, ключ очереди ожидания, лимит). Домен - блокировка на одну задачу."""
+    kind, name = resource.split(":", 1)
+    if kind == "domain":
+        return f"wpg:lock:domain:{name}", f"wpg:lock:domain:{name}:waiting", 1
+    return f"wpg:server:{name}:slots", f"wpg:server:{name}:waiting", server_limit(name)
+
+
+def acquire_resources(resources: List[str], token: str, entry: str) -> Optional[str]:
+    """
+    Занимает (или подтверждает зарезервированные) слоты всех ресурсов.
+    Иначе ставит entry в очередь первого занятого ресурса и возвращает этот ресурс.
+    """
+    now = time.time()
+    keys, limits = [], []
+    for resource in resources:
+        slots_key, waiting_key, limit = _resource_keys(resource)
+        keys += [slots_key, waiting_key]
+        limits += [limit, resource]
+    blocked = _acquire_script(keys=keys + [WAITING_KEY], args=[now, now + SLOT_TTL, token, SLOT_TTL, entry] + limits)
+    return resources[blocked - 1] if blocked else None
+
+
+def release_resources(resources: List[str], token: str):
+    pipe = redis_client.pipeline(transaction=False)
+    for resource in resources:
+        pipe.zrem(_resource_keys(resource)[0], token)
+    pipe.execute()
+
+
+def wake_waiting(resource: str):
+    """Публикует ожидающие задачи ресурса по числу свободных слотов."""
+    slots_key, waiting_key, limit = _resource_keys(resource)
+    now = time.time()
+    entries = _wake_script(
+        keys=[slots_key, waiting_key, WAITING_KEY],
+        args=[now, limit, resource, now + RESERVE_TTL, SLOT_TTL],
+    )
+    for index, raw in enumerate(entries):
+        entry = json.loads(raw)
+        try:
+            current_app.tasks[entry["task"]].apply_async(
+                args=entry["args"], kwargs=entry["kwargs"], task_id=entry["id"], retries=entry["retries"],
+                headers={WAKE_HEADER: True},
+            )
+        except Exception as e:
+            print(f"Error waking tasks of {resource}: {e}")
+            # Неопубликованные задачи возвращаем в начало очереди в прежнем порядке вместе со слотами
+            pipe = redis_client.pipeline()
+            pipe.zrem(slots_key, *[json.loads(raw)["id"] for raw in entries[index:]])
+            pipe.lpush(waiting_key, *reversed(entries[index:]))
+            pipe.sadd(WAITING_KEY, resource)
+            pipe.execute()
+            return
+
+
+def wake_all_waiting():
+    for resource in redis_client.smembers(WAITING_KEY):
+        wake_waiting(resource)
+        # Ключи идемпотентности тех, кто остался ждать
+        waiting = redis_client.lrange(_resource_keys(resource)[1], 0, -1)
+        refresh_idempotency_keys([(entry["once"], entry["id"]) for entry in map(json.loads, waiting)])
+
+
+class _Heartbeat(threading.Thread):
+    """Пока задача выполняется, продлевает ее слоты и ключ идемпотентности: TTL не истекает посреди работы."""
+
+    def __init__(self, resources, token, once):
+        super().__init__(name=f"wpg-heartbeat-{token}", daemon=True)
+        self.resources = resources
+        self.token = token
+        self.once = once
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        expires = time.time() + SLOT_TTL
+        pipe = redis_client.pipeline(transaction=False)
+        for resource in self.resources:
+            pipe.zadd(_resource_keys(resource)[0], {self.token: expires}, xx=True)
+        pipe.execute()
+        refresh_idempotency_keys([(self.once, self.token)])
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing task {self.token}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+class ServerTask(Task):
+    """
+    База для задач, работающих с сервером по SSH.
+    Задача занимает слот сервера и блокировку своего домена (если у нее есть аргумент domain):
+    задачи одного домена не работают с /var/www/<домен> одновременно.
+    Если ресурс занят или к нему уже есть очередь, задача не ждет внутри воркера и не крутится
+    в брокере: она встает в конец очереди ожидания и публикуется снова со слотом,
+    зарезервированным при освобождении.
+    """
+    # Имя аргумента задачи с IP сервера
+    server_arg = "server_ip"
+    # Имя аргумента с доменом, задачи одного домена выполняются по очереди
+    domain_arg = "domain"
+    # Аргументы, по которым enqueue_once считает задачи одинаковыми (None - все)
+    idempotency_args = None
+
+    def _resources_of(self, args, kwargs) -> List[str]:
+        try:
+            arguments = inspect.signature(self.run).bind_partial(*args, **kwargs).arguments
+        except TypeError:
+            return []
+        resources = []
+        if isinstance(arguments.get(self.domain_arg), str):
+            resources.append(domain_resource(arguments[self.domain_arg]))
+        if arguments.get(self.server_arg) is not None:
+            resources.append(server_resource(arguments[self.server_arg]))
+        return resources
+
+    def __call__(self, *args, **kwargs):
+        # run вызываем напрямую: контекст запроса (id, retries) воркер уже выставил
+        resources = self._resources_of(args, kwargs)
+        token = self.request.id or uuid.uuid4().hex
+        once = idempotency_key(self, args, kwargs)
+
+        if resources:
+            # Тот же task_id и счетчик повторов: ожидание слота не считается попыткой
+            entry = json.dumps({
+                "task": self.name,
+                "id": token,
+                "args": list(args),
+                "kwargs": kwargs,
+                "retries": self.request.retries,
+                "once": once,
+            })
+            if acquire_resources(resources, token, entry) is not None:
+                # task_track_started уже записал STARTED, задача снова ждет
+                self.backend.store_result(token, None, states.PENDING)
+                refresh_idempotency_keys([(once, token)])
+                # Снятые резервы разбуженной задачи достаются следующим в очереди
+                for resource in resources:
+                    wake_waiting(resource)
+                raise Ignore()
+
+        heartbeat = _Heartbeat(resources, token, once)
+        try:
+            heartbeat.refresh()
+            heartbeat.start()
+            return self.run(*args, **kwargs)
+        finally:
+            heartbeat.stop()
+            if resources:
+                release_resources(resources, token)
+                for resource in resources:
+                    wake_waiting(resource)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        # RETRY и ожидание слота - задача еще не закончена
+        if status in states.READY_STATES:
+            release_idempotency_key(self, task_id, args, kwargs)
@@ -0,0 +1,83 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from tools.cloudflare import close_session as close_cloudflare_session
+from tools.config import config_read
+from tools.redis_client import async_redis
+from tools.ssh_batch import CommandResult, run_batch
+from tools.ssh_pool import ssh_pool
+
+config = config_read("config.ini")
+
+# Блокирующие вызовы paramiko выполняются в общем пуле потоков.
+# Это не асинхронный SSH: поток занят на все время команды, а слот воркера - на все время задачи.
+# Выигрыш только в fan-out внутри одной задачи (много доменов одного сервера параллельно).
+# Параллельность между задачами и серверами задается concurrency воркера Celery и слотами ServerTask.
+_executor = ThreadPoolExecutor(
+    max_workers=config.getint('SSH', 'async_threads', fallback=64),
+    thread_name_prefix="wpg-ssh"
+)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    # Контекст вызывающей корутины (id задачи для record_step) переносим в поток пула
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def run_async(coro):
+    """
+    Запуск fan-out корутины из синхронной Celery задачи.
+    Слот воркера занят до конца задачи. Задачи, которые работают последовательно, остаются синхронными.
+    Сессия Cloudflare и соединения async_redis привязаны к loop этого asyncio.run, поэтому закрываются вместе с ним.
+    """
+    async def main():
+        try:
+            return await coro
+        finally:
+            await close_cloudflare_session()
+            await async_redis.connection_pool.disconnect()
+
+    return asyncio.run(main())
+
+
+class AsyncSSH:
+    """Асинхронная обертка над соединением из ssh_pool."""
+
+    def __init__(self, server_ip, server_login, server_port):
+        self.server_ip = server_ip
+        self.server_login = server_login
+        self.server_port = server_port
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await run_in_thread(ssh_pool.acquire, self.server_ip, self.server_login, self.server_port)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        ssh_pool.release(self.conn)
+        self.conn = None
+
+    async def exec(self, command: str) -> CommandResult:
+        results = await self.run_batch([command])
+        return results[0]
+
+    async def run_batch(self, commands: List[str], stop_on_error: bool = False) -> List[CommandResult]:
+        return await run_in_thread(run_batch, self.conn, commands, stop_on_error)
+
+    async def put(self, local_path: str, remote_path: str):
+        def _put():
+            sftp = self.conn.open_sftp()
+            try:
+                sftp.put(local_path, remote_path)
+            finally:
+                sftp.close()
+        await run_in_thread(_put)
+
+    async def call(self, func, *args, **kwargs):
+        """Вызов синхронного хелпера, принимающего ssh первым аргументом."""
+        return await run_in_thread(func, self.conn, *args, **kwargs)
@@ -0,0 +1,93 @@
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class CommandResult:
+    command: str
+    exit_code: Optional[int]
+    stdout: str
+    stderr: str
+    duration: float
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+
+def build_batch_script(commands: List[str], marker: str, stop_on_error: bool = False) -> str:
+    lines = []
+    for index, command in enumerate(commands):
+        lines.append(f"printf '%s BEGIN %d\\n' '{marker}' {index}; printf '%s BEGIN %d\\n' '{marker}' {index} >&2")
+        lines.append("__wpg_start=$(date +%s%N)")
+        # stdin отдаем /dev/null, иначе команда может прочитать остаток скрипта
+        lines.append(f"(\n{command}\n) </dev/null")
+        lines.append("__wpg_rc=$?")
+        lines.append(
+            f"printf '\\n%s END %d %d %d\\n' '{marker}' {index} $__wpg_rc $(( ($(date +%s%N) - __wpg_start) / 1000000 )); "
+            f"printf '\\n%s END %d\\n' '{marker}' {index} >&2"
+        )
+        if stop_on_error:
+            lines.append("[ $__wpg_rc -eq 0 ] || exit $__wpg_rc")
+    return "\n".join(lines) + "\n"
+
+
+def _read_channel(channel):
+    out, err = [], []
+    while True:
+        if channel.recv_ready():
+            out.append(channel.recv(65536))
+        elif channel.recv_stderr_ready():
+            err.append(channel.recv_stderr(65536))
+        elif channel.exit_status_ready():
+            # Дочитываем то, что пришло вместе со статусом
+            while channel.recv_ready():
+                out.append(channel.recv(65536))
+            while channel.recv_stderr_ready():
+                err.append(channel.recv_stderr(65536))
+            break
+        else:
+            time.sleep(0.05)
+    return b"".join(out).decode('utf-8', 'replace'), b"".join(err).decode('utf-8', 'replace')
+
+
+def _split_stream(text: str, marker: str, with_status: bool):
+    pattern = re.compile(rf"^{marker} BEGIN (\d+)\n(.*?)\n{marker} END \1"
+                         + (r" (\d+) (\d+)" if with_status else "") + r"$",
+                         re.S | re.M)
+    return {int(match.group(1)): match for match in pattern.finditer(text)}
+
+
+def run_batch(ssh, commands: List[str], stop_on_error: bool = False) -> List[CommandResult]:
+    """Выполняет список команд одним скриптом в одном SSH канале."""
+    marker = f"__WPG_{uuid.uuid4().hex}__"
+    script = build_batch_script(commands, marker, stop_on_error)
+
+    stdin, stdout, stderr = ssh.exec_command("bash -s")
+    stdin.write(script)
+    stdin.flush()
+    stdin.channel.shutdown_write()
+
+    output, error = _read_channel(stdout.channel)
+    stdout_parts = _split_stream(output, marker, with_status=True)
+    stderr_parts = _split_stream(error, marker, with_status=False)
+
+    results = []
+    for index, command in enumerate(commands):
+        out_match = stdout_parts.get(index)
+        err_match = stderr_parts.get(index)
+        if out_match is None:
+            # Команда не выполнялась (скрипт остановлен на предыдущей ошибке)
+            results.append(CommandResult(command, None, "", "", 0.0))
+            continue
+        results.append(CommandResult(
+            command=command,
+            exit_code=int(out_match.group(3)),
+            stdout=out_match.group(2),
+            stderr=err_match.group(2) if err_match else "",
+            duration=int(out_match.group(4)) / 1000,
+        ))
+    return results
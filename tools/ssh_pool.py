@@ -0,0 +1,188 @@
+import threading
+import time
+
+import paramiko
+
+from tools.config import config_read
+
+config = config_read("config.ini")
+
+SSH_KEY_PATH = "/home/maksim/.ssh/id_rsa_{}"
+
+
+class PooledConnection:
+    """SSH соединение из пула. Проксирует exec_command/open_sftp к paramiko.SSHClient."""
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def is_alive(self):
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        # Закрытием соединения управляет пул
+        pass
+
+    def _close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHPool:
+    """
+    Пул SSH соединений на процесс воркера, ключ - (ip, port, login).
+    На один ключ не больше max_connections соединений: когда все каналы заняты, acquire ждет release.
+    """
+
+    def __init__(self, max_channels=8, max_connections=4, keepalive=30, idle_timeout=300, connect_timeout=15,
+                 acquire_timeout=600):
+        self.max_channels = max_channels
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self._connections = {}
+        # Соединения, которые сейчас открываются (учитываются в лимите max_connections)
+        self._opening = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def acquire(self, server_ip, server_login, server_port):
+        key = (server_ip, int(server_port or 22), server_login)
+        deadline = time.monotonic() + self.acquire_timeout
+
+        with self._lock:
+            while True:
+                self._evict_idle()
+                for conn in list(self._connections.get(key, [])):
+                    if conn.leases >= self.max_channels:
+                        continue
+                    if not conn.is_alive():
+                        self._drop(conn)
+                        continue
+                    conn.leases += 1
+                    conn.last_used = time.monotonic()
+                    return conn
+
+                if len(self._connections.get(key, [])) + self._opening.get(key, 0) < self.max_connections:
+                    self._opening[key] = self._opening.get(key, 0) + 1
+                    break
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError(f"No free SSH channel to {server_ip} in {self.acquire_timeout}s")
+                self._released.wait(timeout)
+
+        # Соединение открываем вне блокировки, чтобы не тормозить другие серверы
+        try:
+            client = self._connect(key)
+        except Exception:
+            with self._lock:
+                self._finish_opening(key)
+                self._released.notify_all()
+            raise
+        conn = PooledConnection(key, client)
+        conn.leases = 1
+
+        with self._lock:
+            self._finish_opening(key)
+            self._connections.setdefault(key, []).append(conn)
+        return conn
+
+    def release(self, conn):
+        if conn is None:
+            return
+        with self._lock:
+            conn.leases = max(conn.leases - 1, 0)
+            conn.last_used = time.monotonic()
+            self._released.notify_all()
+
+    def close_all(self):
+        with self._lock:
+            for connections in self._connections.values():
+                for conn in connections:
+                    conn._close()
+            self._connections.clear()
+
+    def _connect(self, key):
+        server_ip, server_port, server_login = key
+        try:
+            ssh = self._open(server_ip, server_port, server_login)
+        except paramiko.AuthenticationException:
+            # Сервер переустановлен и ключ на диске заменен: закэшированный ключ больше не подходит
+            with self._lock:
+                self._keys.pop(server_ip, None)
+            ssh = self._open(server_ip, server_port, server_login)
+        ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def _open(self, server_ip, server_port, server_login):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(
+                hostname=server_ip,
+                username=server_login,
+                pkey=self._load_key(server_ip),
+                port=server_port,
+                timeout=self.connect_timeout
+            )
+        except Exception:
+            ssh.close()
+            raise
+        return ssh
+
+    def _load_key(self, server_ip):
+        # Ключ читаем с диска один раз на процесс
+        pkey = self._keys.get(server_ip)
+        if pkey is None:
+            pkey = paramiko.RSAKey.from_private_key_file(SSH_KEY_PATH.format(server_ip))
+            self._keys[server_ip] = pkey
+        return pkey
+
+    def _finish_opening(self, key):
+        self._opening[key] -= 1
+        if not self._opening[key]:
+            del self._opening[key]
+
+    def _drop(self, conn):
+        connections = self._connections.get(conn.key, [])
+        if conn in connections:
+            connections.remove(conn)
+        if not connections:
+            self._connections.pop(conn.key, None)
+        conn._close()
+        self._released.notify_all()
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for connections in list(self._connections.values()):
+            for conn in list(connections):
+                if conn.leases == 0 and now - conn.last_used > self.idle_timeout:
+                    self._drop(conn)
+
+
+ssh_pool = SSHPool(
+    max_channels=config.getint('SSH', 'max_channels', fallback=8),
+    max_connections=config.getint('SSH', 'max_connections', fallback=4),
+    keepalive=config.getint('SSH', 'keepalive', fallback=30),
+    idle_timeout=config.getint('SSH', 'idle_timeout', fallback=300),
+    acquire_timeout=config.getint('SSH', 'acquire_timeout', fallback=600),
+)
@@ -0,0 +1,110 @@
+import asyncio
+
+from sqlalchemy import select
+
+from database import async_session_maker
+from models import Domain, Server, ServerStatus, WhitePageStatus
+from tools.cache import DOMAINS, SERVERS, invalidate_cache
+from tools.config import config_read
+from tools.system_func import STATUS_PENDING_KEY, status_key
+
+config = config_read("config.ini")
+
+FLUSH_INTERVAL = config.getfloat('STATUS', 'flush_interval', fallback=1.0)
+FLUSH_BATCH = config.getint('STATUS', 'flush_batch', fallback=500)
+
+STEP_FIELDS = {"plugins_installed", "theme_changed", "posts_created", "form_added"}
+
+
+async def _take_pending(redis, limit):
+    members = await redis.spop(STATUS_PENDING_KEY, limit)
+    if not members:
+        return {}
+
+    # Читаем и удаляем хэши атомарно: запись воркера после этого создаст новый хэш
+    # и снова добавит домен в pending
+    pipe = redis.pipeline(transaction=True)
+    for member in members:
+        pipe.hgetall(status_key(member))
+        pipe.delete(status_key(member))
+    values = await pipe.execute()
+
+    return {member: fields for member, fields in zip(members, values[::2]) if fields}
+
+
+async def _requeue(redis, updates):
+    # Более свежие значения, которые успели записать воркеры, не перетираем
+    pipe = redis.pipeline(transaction=False)
+    for member, fields in updates.items():
+        for field, value in fields.items():
+            pipe.hsetnx(status_key(member), field, value)
+        pipe.sadd(STATUS_PENDING_KEY, member)
+    await pipe.execute()
+
+
+def _apply_domain(domain: Domain, fields: dict):
+    for field, value in fields.items():
+        if field == "status":
+            domain.status = WhitePageStatus(value)
+        elif field in ("wp_login", "wp_pass"):
+            setattr(domain, field, value)
+        elif field.startswith("step:") and field[5:] in STEP_FIELDS:
+            setattr(domain, field[5:], True)
+
+
+async def _apply(updates):
+    domains, servers = {}, {}
+    for member, fields in updates.items():
+        kind, name = member.split(":", 1)
+        if kind == "domain":
+            domains[name] = fields
+        elif kind == "server":
+            servers[name] = fields
+
+    async with async_session_maker() as session:
+        if domains:
+            result = await session.execute(select(Domain).where(Domain.domain.in_(domains)))
+            for domain in result.scalars().all():
+                _apply_domain(domain, domains[domain.domain])
+
+        if servers:
+            result = await session.execute(select(Server).where(Server.ip.in_(servers)))
+            for server in result.scalars().all():
+                if "status" in servers[server.ip]:
+                    server.status = ServerStatus(servers[server.ip]["status"])
+
+        await session.commit()
+
+    tags = [DOMAINS] if domains else []
+    if servers:
+        tags.append(SERVERS)
+    await invalidate_cache(*tags)
+
+
+async def flush_status_updates(redis, limit: int = FLUSH_BATCH) -> int:
+    """Применяет накопленные статусы одной транзакцией. Возвращает количество обновленных объектов."""
+    updates = await _take_pending(redis, limit)
+    if not updates:
+        return 0
+
+    try:
+        await _apply(updates)
+    except BaseException:
+        await _requeue(redis, updates)
+        raise
+
+    return len(updates)
+
+
+async def run_status_consumer(redis):
+    while True:
+        try:
+            applied = await flush_status_updates(redis)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error applying status updates: {e}")
+            applied = 0
+
+        if applied < FLUSH_BATCH:
+            await asyncio.sleep(FLUSH_INTERVAL)
@@ -1,33 +1,65 @@
-import requests
+import json
 
 from models import ServerStatus, WhitePageStatus
+from tools.redis_client import redis_client
+from tools.task_tracking import record_step
+
+# Воркеры пишут статусы в Redis, API забирает их пачками (tools/status_consumer.py).
+# Хэш на каждый домен/сервер хранит только последнее значение, поэтому
+# CONFIGURE -> DONE за время между сбросами превращается в одно обновление.
+STATUS_PENDING_KEY = "wpg:status:pending"
+# Канал для живого прогресса (modules/events/router.py), в БД не пишется
+EVENTS_CHANNEL = "wpg:events"
+
+
+def status_key(member: str) -> str:
+    return f"wpg:status:{member}"
+
+
+def _event(kind: str, name: str, event: str, **data) -> str:
+    return json.dumps({"kind": kind, "name": name, "event": event, **data}, ensure_ascii=False)
+
+
+def push_status(kind: str, name: str, fields: dict):
+    member = f"{kind}:{name}"
+    pipe = redis_client.pipeline()
+    pipe.hset(status_key(member), mapping=fields)
+    pipe.sadd(STATUS_PENDING_KEY, member)
+    if "status" in fields:
+        # Креды и прочие поля в канал не отправляем, только смену статуса
+        pipe.publish(EVENTS_CHANNEL, _event(kind, name, "status", status=fields["status"]))
+    pipe.execute()
+
+
+def report_progress(domain: str, task: str, step: str, current: int = None, total: int = None, kind: str = "domain"):
+    """Шаг задачи для /events и /tasks, например "plugin 3/6 installed". Ошибки Redis задачу не прерывают."""
+    try:
+        redis_client.publish(EVENTS_CHANNEL, _event(kind, domain, "progress", task=task, step=step,
+                                                    current=current, total=total))
+        record_step(step)
+    except Exception as e:
+        print(f"Error publishing progress for {domain}: {e}")
 
 
 def change_server_status(server_ip: str, status: ServerStatus):
-    data = {
-        "server_ip": server_ip,
-        "status": status
-    }
-    requests.patch(url="https://api.wp-generate.site/server/change_status", json=data)
+    push_status("server", server_ip, {"status": getattr(status, "value", status)})
 
 
 def change_wp_status(domain: str, status: WhitePageStatus, complete_step=None):
     data = {
-        "domain": domain,
-        "status": status
+        "status": getattr(status, "value", status)
     }
 
     if complete_step is not None:
-        data['complete_step'] = complete_step
+        data[f"step:{complete_step}"] = 1
 
-    requests.patch(url="https://api.wp-generate.site/domains/change_status", json=data)
+    push_status("domain", domain, data)
 
 
 def add_wp_creds(domain: str, login: str, password: str):
     data = {
-        "domain": domain,
-        "login": login,
-        "password": password,
+        "wp_login": login,
+        "wp_pass": password,
     }
 
-    requests.patch(url="https://api.wp-generate.site/domains/wp/add_creds", json=data)
\ No newline at end of file
+    push_status("domain", domain, data)
@@ -0,0 +1,173 @@
+import inspect
+import json
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from celery import current_app, current_task
+from celery.signals import before_task_publish, task_prerun, task_postrun
+
+from tools.config import config_read
+from tools.redis_client import redis_client
+
+config = config_read("config.ini")
+
+# Сколько последних задач держим в индексе и сколько живет запись о задаче
+TASKS_KEEP = config.getint('TASKS', 'keep', fallback=10000)
+TASK_TTL = config.getint('TASKS', 'ttl', fallback=7 * 24 * 3600)
+
+TASKS_INDEX_KEY = "wpg:tasks"
+
+# id выполняющейся задачи. В отличие от current_task (thread-local) доходит до корутин fan-out
+# и до потоков run_in_thread (tools/ssh_async.py копирует контекст при запуске)
+current_task_id: ContextVar[Optional[str]] = ContextVar("wpg_task_id", default=None)
+
+
+def task_key(task_id: str) -> str:
+    return f"wpg:task:{task_id}"
+
+
+def steps_key(task_id: str) -> str:
+    return f"wpg:task:{task_id}:steps"
+
+
+def _timestamp(eta) -> float:
+    if eta:
+        try:
+            return datetime.fromisoformat(eta).timestamp()
+        except ValueError:
+            pass
+    return time.time()
+
+
+def _target(task_name, args, kwargs) -> dict:
+    """Домен и сервер задачи - по ним потом группируется статистика."""
+    task = current_app.tasks.get(task_name)
+    if task is None:
+        return {}
+    try:
+        arguments = inspect.signature(task.run).bind_partial(*args, **kwargs).arguments
+    except TypeError:
+        return {}
+    target = {}
+    server = arguments.get(getattr(task, "server_arg", "server_ip"))
+    if server is not None:
+        target["server"] = server
+    if isinstance(arguments.get("domain"), str):
+        target["domain"] = arguments["domain"]
+    return target
+
+
+@before_task_publish.connect
+def track_published(sender=None, headers=None, body=None, **kwargs):
+    task_id = (headers or {}).get("id")
+    if task_id is None:
+        return
+    args, task_kwargs = (body[0], body[1]) if isinstance(body, (list, tuple)) else ((), {})
+
+    now = time.time()
+    fields = {"name": sender, "state": "QUEUED", **_target(sender, args, task_kwargs)}
+    # При повторе время ожидания считается от новой публикации,
+    # после ожидания слота сервера (tools/server_slots.py) - от первой
+    if not headers.get("wpg_wake"):
+        fields["queued_at"] = _timestamp(headers.get("eta"))
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hsetnx(task_key(task_id), "created_at", now)
+        pipe.hset(task_key(task_id), mapping=fields)
+        pipe.hincrby(task_key(task_id), "publishes", 1)
+        pipe.expire(task_key(task_id), TASK_TTL)
+        pipe.zadd(TASKS_INDEX_KEY, {task_id: now}, nx=True)
+        pipe.zremrangebyrank(TASKS_INDEX_KEY, 0, -TASKS_KEEP - 1)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error tracking task {task_id}: {e}")
+
+
+@task_prerun.connect
+def track_started(task_id=None, task=None, **kwargs):
+    current_task_id.set(task_id)
+    try:
+        redis_client.hset(task_key(task_id), mapping={
+            "state": "STARTED",
+            "started_at": time.time(),
+            "worker": task.request.hostname or "",
+        })
+    except Exception as e:
+        print(f"Error tracking task {task_id}: {e}")
+
+
+@task_postrun.connect
+def track_finished(task_id=None, retval=None, state=None, **kwargs):
+    current_task_id.set(None)
+    fields = {"finished_at": time.time()}
+    if state == "IGNORED":
+        # Задача ждет слот занятого сервера (tools/server_slots.py)
+        fields = {"state": "WAITING"}
+    else:
+        fields["state"] = state
+        if state in ("FAILURE", "RETRY"):
+            fields["error"] = str(retval)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(task_key(task_id), mapping=fields)
+        pipe.expire(task_key(task_id), TASK_TTL)
+        pipe.expire(steps_key(task_id), TASK_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error tracking task {task_id}: {e}")
+
+
+def record_step(step: str, task_id: Optional[str] = None):
+    """Отметка шага задачи (по умолчанию текущей), длительность шага - время до следующей отметки."""
+    if task_id is None:
+        task_id = current_task_id.get()
+    if task_id is None and current_task:
+        task_id = current_task.request.id
+    if task_id is None:
+        return
+    redis_client.rpush(steps_key(task_id), json.dumps({"step": step, "at": time.time()}, ensure_ascii=False))
+
+
+def _float(value):
+    return float(value) if value else None
+
+
+def task_timings(task: dict, steps: list) -> dict:
+    """Сырые поля из Redis -> ожидание в очереди, время выполнения и длительность шагов в секундах."""
+    queued_at, started_at, finished_at = (_float(task.get(field)) for field in ("queued_at", "started_at", "finished_at"))
+    # Поля от прошлой попытки, если задача снова в очереди или выполняется
+    if finished_at is not None and started_at is not None and finished_at < started_at:
+        finished_at = None
+    if started_at is not None and queued_at is not None and started_at < queued_at:
+        started_at = finished_at = None
+    # Запуск, на котором задача встала в ожидание слота сервера, не считается
+    if task.get("state") == "WAITING":
+        started_at = finished_at = None
+
+    timed_steps = []
+    for index, step in enumerate(steps):
+        ends_at = steps[index + 1]["at"] if index + 1 < len(steps) else finished_at
+        timed_steps.append({
+            "step": step["step"],
+            "at": step["at"],
+            "duration": ends_at - step["at"] if ends_at is not None else None,
+        })
+
+    return {
+        "task_id": task.get("task_id"),
+        "name": task.get("name"),
+        "state": task.get("state"),
+        "server": task.get("server"),
+        "domain": task.get("domain"),
+        "worker": task.get("worker"),
+        "error": task.get("error"),
+        "publishes": int(task.get("publishes", 0)),
+        "queued_at": queued_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "wait": started_at - queued_at if started_at is not None and queued_at is not None else None,
+        "runtime": finished_at - started_at if finished_at is not None and started_at is not None else None,
+        "steps": timed_steps,
+    }
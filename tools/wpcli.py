@@ -0,0 +1,140 @@
+import json
+import os
+import uuid
+from typing import Dict, List
+
+from tools.ssh_batch import run_batch
+
+WP_CLI_PATH = "/usr/local/bin/wp"
+
+# Выполняется через wp eval-file: $args[0] - путь к posts.json, картинки лежат рядом с ним
+IMPORT_POSTS_PHP = r"""<?php
+require_once ABSPATH . 'wp-admin/includes/image.php';
+require_once ABSPATH . 'wp-admin/includes/file.php';
+require_once ABSPATH . 'wp-admin/includes/media.php';
+
+$dir = dirname($args[0]);
+$results = array();
+foreach (json_decode(file_get_contents($args[0]), true) as $post) {
+    $result = array('title' => $post['title'], 'post_id' => null, 'attachment_id' => null, 'error' => null);
+
+    $post_id = wp_insert_post(array(
+        'post_title'   => $post['title'],
+        'post_content' => $post['content'],
+        'post_status'  => 'publish',
+        'post_type'    => 'post',
+        'post_date'    => $post['date'],
+    ), true);
+    if (is_wp_error($post_id)) {
+        $result['error'] = $post_id->get_error_message();
+        $results[] = $result;
+        continue;
+    }
+    $result['post_id'] = $post_id;
+
+    if (!empty($post['image'])) {
+        $file = array('name' => $post['image'], 'tmp_name' => $dir . '/' . $post['image']);
+        $attachment_id = media_handle_sideload($file, $post_id);
+        if (is_wp_error($attachment_id)) {
+            $result['error'] = $attachment_id->get_error_message();
+        } else {
+            set_post_thumbnail($post_id, $attachment_id);
+            $result['attachment_id'] = $attachment_id;
+        }
+    }
+    $results[] = $result;
+}
+echo "\n" . json_encode($results) . "\n";
+"""
+
+
+def wp_command(site_path: str) -> str:
+    return f"{WP_CLI_PATH} --path={site_path} --allow-root"
+
+
+def install_plugin_set(ssh, site_path: str, sources: Dict[str, str], replace: bool = False) -> Dict[str, dict]:
+    """
+    Ставит и активирует набор плагинов за один запуск wp-cli вместо 4-5 на каждый плагин.
+    sources - {slug: slug или путь к zip}. replace=True сначала удаляет все установленные плагины.
+    Возвращает {slug: {"status": active|inactive|missing, "version": ...}}.
+    """
+    wp = wp_command(site_path)
+    commands = []
+    if replace:
+        # delete, а не uninstall: uninstall-хуки плагинов стирают их данные в базе
+        commands.append(f"{wp} plugin deactivate --all")
+        commands.append(f"{wp} plugin delete --all")
+    # wp plugin list загружает WordPress с активными плагинами, init/wp_loaded отрабатывают там же
+    commands.append(f"{wp} plugin install {' '.join(sources.values())} --activate --force")
+    commands.append(f"{wp} plugin list --format=json --fields=name,status,version")
+
+    results = run_batch(ssh, commands)
+    for result in results[:-1]:
+        print(result.command)
+        print(result.stdout)
+        if result.stderr:
+            print(f"Error: {result.stderr}")
+
+    listing = results[-1]
+    if not listing.ok:
+        raise Exception(f"Command failed: {listing.command}. Error: {listing.stderr}")
+
+    installed = {plugin["name"]: plugin for plugin in json.loads(listing.stdout)}
+    statuses = {}
+    for slug in sources:
+        plugin = installed.get(slug)
+        if plugin is None:
+            statuses[slug] = {"status": "missing", "version": None}
+        else:
+            statuses[slug] = {"status": plugin["status"], "version": plugin["version"]}
+    return statuses
+
+
+def inactive_plugins(statuses: Dict[str, dict]):
+    return [slug for slug, plugin in statuses.items() if plugin["status"] != "active"]
+
+
+def import_posts(ssh, site_path: str, posts: List[dict]) -> List[dict]:
+    """
+    Создает посты с миниатюрами одним запуском wp-cli вместо media import/post create/post meta на каждый пост.
+    posts - [{"title", "content", "date", "image": локальный путь к картинке или None}].
+    Возвращает [{"title", "post_id", "attachment_id", "error"}] в том же порядке.
+    """
+    remote_dir = f"/tmp/wpg-posts-{uuid.uuid4().hex}"
+    manifest = []
+
+    # Картинки, список постов и скрипт - одной SFTP сессией
+    sftp = ssh.open_sftp()
+    try:
+        sftp.mkdir(remote_dir)
+        for post in posts:
+            image = None
+            if post.get("image"):
+                image = os.path.basename(post["image"])
+                sftp.put(post["image"], f"{remote_dir}/{image}")
+            manifest.append({"title": post["title"], "content": post["content"], "date": post["date"], "image": image})
+        with sftp.open(f"{remote_dir}/posts.json", "w") as manifest_file:
+            manifest_file.write(json.dumps(manifest, ensure_ascii=False))
+        with sftp.open(f"{remote_dir}/import.php", "w") as script_file:
+            script_file.write(IMPORT_POSTS_PHP)
+    finally:
+        sftp.close()
+
+    results = run_batch(ssh, [
+        f"{wp_command(site_path)} eval-file {remote_dir}/import.php {remote_dir}/posts.json",
+        f"rm -rf {remote_dir}",
+    ])
+    imported = results[0]
+    if not imported.ok:
+        raise Exception(f"Command failed: {imported.command}. Error: {imported.stderr}")
+    if imported.stderr:
+        print(f"Error: {imported.stderr}")
+
+    # Предупреждения PHP могут попасть в stdout раньше результата
+    lines = imported.stdout.strip().splitlines()
+    if not lines:
+        raise Exception(f"Command returned no output: {imported.command}. Error: {imported.stderr}")
+    try:
+        return json.loads(lines[-1])
+    except ValueError:
+        raise Exception(f"Unexpected output of {imported.command}: {lines[-1][:500]}. Error: {imported.stderr}")